@@ -30,6 +30,18 @@ def find_multiple(n: int, k: int) -> int:
     return n + k - (n % k)
 
 
+def bucket_kv_len(length: int, max_seq_len: int, min_len: int = 128) -> int:
+    """
+    Number of KV positions attended for a sequence of `length` tokens,
+    rounded up to a power of two to keep the number of compiled shapes small.
+    """
+    kv_len = min_len
+    while kv_len < length:
+        kv_len *= 2
+
+    return min(kv_len, max_seq_len)
+
+
 @dataclass
 class BaseModelArgs:
     model_type: str = "base"
@@ -139,16 +151,341 @@ class KVCache(nn.Module):
         self.register_buffer("k_cache", torch.zeros(cache_shape, dtype=dtype))
         self.register_buffer("v_cache", torch.zeros(cache_shape, dtype=dtype))
 
-    def update(self, input_pos, k_val, v_val):
-        # input_pos: [S], k_val: [B, H, S, D]
-        assert input_pos.shape[0] == k_val.shape[2]
+    def update(self, input_pos, k_val, v_val, batch_idx=None, kv_len=None):
+        # input_pos: [S] or [B, S], k_val: [B, H, S, D], batch_idx: [B] or None
+        # Only the first kv_len positions are returned, all of them if None
+        assert input_pos.shape[-1] == k_val.shape[2]
+
+        if batch_idx is None and input_pos.ndim == 1:
+            # Shared positions, the batch occupies the first B rows of the cache
+            k_out = self.k_cache[: k_val.shape[0]]
+            v_out = self.v_cache[: k_val.shape[0]]
+            k_out[:, :, input_pos] = k_val
+            v_out[:, :, input_pos] = v_val
+
+            return k_out[:, :, :kv_len], v_out[:, :, :kv_len]
+
+        rows = (
+            torch.arange(k_val.shape[0], device=k_val.device)
+            if batch_idx is None
+            else batch_idx
+        )
+        if input_pos.ndim == 1:
+            input_pos = input_pos[None].expand(k_val.shape[0], -1)
+
+        # Advanced indexing puts the [B, S] index dims first: [B, S, H, D]
+        self.k_cache[rows[:, None], :, input_pos] = k_val.transpose(1, 2)
+        self.v_cache[rows[:, None], :, input_pos] = v_val.transpose(1, 2)
+
+        if batch_idx is None:
+            return (
+                self.k_cache[: k_val.shape[0], :, :kv_len],
+                self.v_cache[: k_val.shape[0], :, :kv_len],
+            )
+
+        return self.k_cache[batch_idx, :, :kv_len], self.v_cache[batch_idx, :, :kv_len]
+
+    def move_row(self, src: int, dst: int):
+        self.k_cache[dst] = self.k_cache[src]
+        self.v_cache[dst] = self.v_cache[src]
+
+    def fork_row(self, src: int, dsts: list[int], length: int):
+        self.k_cache[dsts, :, :length] = self.k_cache[src, :, :length]
+        self.v_cache[dsts, :, :length] = self.v_cache[src, :, :length]
+
+    def snapshot(self, row: int, length: int) -> tuple[Tensor, Tensor]:
+        return (
+            self.k_cache[row, :, :length].clone(),
+            self.v_cache[row, :, :length].clone(),
+        )
+
+    def restore(self, row: int, k: Tensor, v: Tensor):
+        length = k.size(1)
+        self.k_cache[row, :, :length] = k
+        self.v_cache[row, :, :length] = v
+
+
+def quantize_int8(x: Tensor) -> tuple[Tensor, Tensor]:
+    # Symmetric quantization with one scale per head and token, over the head dimension
+    scale = (x.abs().amax(dim=-1, keepdim=True) / 127).clamp(min=1e-8).to(x.dtype)
+    q = torch.round(x.float() / scale.float()).clamp(-127, 127).to(torch.int8)
+    return q, scale
+
+
+class QuantizedKVCache(nn.Module):
+    """
+    Same as KVCache, but the entries are stored as int8 with a scale per head and token,
+    which halves the memory of the cache. `update` returns the int8 entries and their
+    scales as they are, Attention.quantized_attention applies the scales to the scores
+    and the probabilities so that no scaled copy of the cache is written.
+    The int8 -> compute dtype cast of K/V remains: eager mode still materializes it
+    for the matmuls, the read bandwidth is only halved where the compiler fuses it.
+    """
+
+    def __init__(
+        self, max_batch_size, max_seq_len, n_heads, head_dim, dtype=torch.bfloat16
+    ):
+        super().__init__()
+        cache_shape = (max_batch_size, n_heads, max_seq_len, head_dim)
+        scale_shape = (max_batch_size, n_heads, max_seq_len, 1)
+        self.register_buffer("k_cache", torch.zeros(cache_shape, dtype=torch.int8))
+        self.register_buffer("v_cache", torch.zeros(cache_shape, dtype=torch.int8))
+        self.register_buffer("k_scale", torch.zeros(scale_shape, dtype=dtype))
+        self.register_buffer("v_scale", torch.zeros(scale_shape, dtype=dtype))
+
+    def update(self, input_pos, k_val, v_val, batch_idx=None, kv_len=None):
+        # Same arguments and layout as KVCache.update
+        assert input_pos.shape[-1] == k_val.shape[2]
+
+        k_q, k_s = quantize_int8(k_val)
+        v_q, v_s = quantize_int8(v_val)
+        values = (
+            (self.k_cache, k_q),
+            (self.k_scale, k_s),
+            (self.v_cache, v_q),
+            (self.v_scale, v_s),
+        )
+
+        if batch_idx is None and input_pos.ndim == 1:
+            for cache, value in values:
+                cache[: k_val.shape[0], :, input_pos] = value
+        else:
+            rows = (
+                torch.arange(k_val.shape[0], device=k_val.device)
+                if batch_idx is None
+                else batch_idx
+            )
+            if input_pos.ndim == 1:
+                input_pos = input_pos[None].expand(k_val.shape[0], -1)
+
+            # Advanced indexing puts the [B, S] index dims first: [B, S, H, D]
+            for cache, value in values:
+                cache[rows[:, None], :, input_pos] = value.transpose(1, 2)
+
+        # (k, k_scale, v, v_scale), see Attention.quantized_attention
+        rows = slice(None, k_val.shape[0]) if batch_idx is None else batch_idx
+        return (
+            self.k_cache[rows, :, :kv_len],
+            self.k_scale[rows, :, :kv_len],
+            self.v_cache[rows, :, :kv_len],
+            self.v_scale[rows, :, :kv_len],
+        )
+
+    def move_row(self, src: int, dst: int):
+        for cache in (self.k_cache, self.k_scale, self.v_cache, self.v_scale):
+            cache[dst] = cache[src]
+
+    def fork_row(self, src: int, dsts: list[int], length: int):
+        for cache in (self.k_cache, self.k_scale, self.v_cache, self.v_scale):
+            cache[dsts, :, :length] = cache[src, :, :length]
+
+    def snapshot(self, row: int, length: int) -> tuple[Tensor, Tensor]:
+        # The int8 entries are kept as they are, with the bytes of their scale appended
+        # to the head dimension: [H, length, head_dim + scale bytes]
+        return tuple(
+            torch.cat(
+                [cache[row, :, :length], scale[row, :, :length].view(torch.int8)],
+                dim=-1,
+            )
+            for cache, scale in (
+                (self.k_cache, self.k_scale),
+                (self.v_cache, self.v_scale),
+            )
+        )
+
+    def restore(self, row: int, k: Tensor, v: Tensor):
+        length = k.size(1)
+        head_dim = self.k_cache.size(-1)
+
+        for cache, scale, packed in (
+            (self.k_cache, self.k_scale, k),
+            (self.v_cache, self.v_scale, v),
+        ):
+            cache[row, :, :length] = packed[..., :head_dim]
+            scale[row, :, :length] = packed[..., head_dim:].view(scale.dtype)
+
+
+class KVBlockAllocator:
+    """
+    Free-list allocator of fixed size KV blocks, shared by the paged caches of all layers.
+    Every batch row owns a block table, block 0 is never handed out so that unused
+    table entries can point to it. The block pools grow on demand.
+    Forked rows share the full blocks of their prefix, a block is freed with its last reference.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        max_seq_len: int,
+        block_size: int,
+        num_blocks: int,
+    ):
+        self.block_size = block_size
+        self.max_blocks_per_seq = -(-max_seq_len // block_size)
+        self.max_num_blocks = max_batch_size * self.max_blocks_per_seq + 1
+        self.num_blocks = min(max(num_blocks, 2), self.max_num_blocks)
+
+        self.free_blocks = list(range(self.num_blocks - 1, 0, -1))
+        self.ref_counts = [0] * self.num_blocks
+        self.row_blocks: list[list[int]] = [[] for _ in range(max_batch_size)]
+        self.block_tables = torch.zeros(
+            (max_batch_size, self.max_blocks_per_seq), dtype=torch.long
+        )
+        self.caches: list["PagedKVCache"] = []
+
+    def reserve(self, row: int, length: int):
+        blocks = self.row_blocks[row]
+        needed = -(-length // self.block_size)
+        if needed <= len(blocks):
+            return
+
+        assert (
+            needed <= self.max_blocks_per_seq
+        ), f"Sequence length {length} exceeds the KV cache"
+
+        new_blocks = []
+        while len(blocks) + len(new_blocks) < needed:
+            if not self.free_blocks:
+                self.grow()
+
+            new_blocks.append(self.free_blocks.pop())
+            self.ref_counts[new_blocks[-1]] = 1
+
+        self.block_tables[row, len(blocks) : needed] = torch.tensor(
+            new_blocks, dtype=torch.long, device=self.block_tables.device
+        )
+        blocks.extend(new_blocks)
+
+    def release(self, row: int):
+        for block in reversed(self.row_blocks[row]):
+            self.ref_counts[block] -= 1
+            if self.ref_counts[block] == 0:
+                self.free_blocks.append(block)
+
+        self.row_blocks[row] = []
+        self.block_tables[row] = 0
+
+    def move(self, src: int, dst: int):
+        self.release(dst)
+        self.row_blocks[dst] = self.row_blocks[src]
+        self.row_blocks[src] = []
+        self.block_tables[dst] = self.block_tables[src]
+        self.block_tables[src] = 0
+
+    def fork(self, src: int, dst: int, length: int):
+        """
+        Make row `dst` start with the first `length` positions of row `src`.
+        The full blocks are shared, they are never written again since both rows only
+        append after `length`. The partially filled last block is copied.
+        """
+        self.release(dst)
+
+        num_shared = length // self.block_size
+        shared = self.row_blocks[src][:num_shared]
+        for block in shared:
+            self.ref_counts[block] += 1
+
+        self.row_blocks[dst] = list(shared)
+        self.block_tables[dst, :num_shared] = self.block_tables[src, :num_shared]
+
+        if length % self.block_size:
+            self.reserve(dst, length)
+            for cache in self.caches:
+                cache.copy_block(
+                    self.row_blocks[src][num_shared], self.row_blocks[dst][num_shared]
+                )
+
+    def grow(self):
+        num_blocks = min(self.num_blocks * 2, self.max_num_blocks)
+        assert num_blocks > self.num_blocks, "KV cache is full"
+
+        for cache in self.caches:
+            cache.grow(num_blocks)
+
+        self.free_blocks.extend(range(num_blocks - 1, self.num_blocks - 1, -1))
+        self.ref_counts.extend([0] * (num_blocks - self.num_blocks))
+        self.num_blocks = num_blocks
+
+
+class PagedKVCache(nn.Module):
+    def __init__(
+        self,
+        allocator: KVBlockAllocator,
+        n_heads: int,
+        head_dim: int,
+        dtype=torch.bfloat16,
+    ):
+        super().__init__()
+        pool_shape = (allocator.num_blocks, n_heads, allocator.block_size, head_dim)
+        self.register_buffer("k_pool", torch.zeros(pool_shape, dtype=dtype))
+        self.register_buffer("v_pool", torch.zeros(pool_shape, dtype=dtype))
+        self.allocator = allocator
+        allocator.caches.append(self)
+
+    def grow(self, num_blocks: int):
+        extra = num_blocks - self.k_pool.size(0)
+        self.k_pool = torch.cat(
+            [self.k_pool, self.k_pool.new_zeros((extra, *self.k_pool.shape[1:]))]
+        )
+        self.v_pool = torch.cat(
+            [self.v_pool, self.v_pool.new_zeros((extra, *self.v_pool.shape[1:]))]
+        )
+
+    def copy_block(self, src: int, dst: int):
+        self.k_pool[dst] = self.k_pool[src]
+        self.v_pool[dst] = self.v_pool[src]
+
+    def update(self, input_pos, k_val, v_val, batch_idx=None, kv_len=None):
+        # input_pos: [S] or [B, S], k_val: [B, H, S, D], batch_idx: [B] or None
+        assert input_pos.shape[-1] == k_val.shape[2]
+
+        bsz, n_heads, _, head_dim = k_val.shape
+        block_size = self.allocator.block_size
+        rows = (
+            torch.arange(bsz, device=k_val.device) if batch_idx is None else batch_idx
+        )
+        input_pos = input_pos.long()
+        if input_pos.ndim == 1:
+            input_pos = input_pos[None].expand(bsz, -1)
+
+        # The blocks must have been reserved before the forward pass
+        tables = self.allocator.block_tables[rows]
+        blocks = torch.gather(tables, 1, input_pos // block_size)
+        offsets = input_pos % block_size
+
+        # Advanced indexing puts the [B, S] index dims first: [B, S, H, D]
+        self.k_pool[blocks, :, offsets] = k_val.transpose(1, 2)
+        self.v_pool[blocks, :, offsets] = v_val.transpose(1, 2)
+
+        # Gather the blocks covering the first kv_len positions into [B, H, kv_len, D]
+        if kv_len is None:
+            read_blocks = self.allocator.max_blocks_per_seq
+        else:
+            read_blocks = -(-kv_len // block_size)
+
+        tables = tables[:, :read_blocks]
+        k_out = self.k_pool[tables].transpose(1, 2)
+        v_out = self.v_pool[tables].transpose(1, 2)
+        k_out = k_out.reshape(bsz, n_heads, read_blocks * block_size, head_dim)
+        v_out = v_out.reshape(bsz, n_heads, read_blocks * block_size, head_dim)
+
+        return k_out[:, :, :kv_len], v_out[:, :, :kv_len]
 
-        k_out = self.k_cache
-        v_out = self.v_cache
-        k_out[:, :, input_pos] = k_val
-        v_out[:, :, input_pos] = v_val
+    def snapshot(self, row: int, length: int) -> tuple[Tensor, Tensor]:
+        num_blocks = -(-length // self.allocator.block_size)
+        blocks = self.allocator.row_blocks[row][:num_blocks]
+        k = self.k_pool[blocks].transpose(0, 1).flatten(1, 2)
+        v = self.v_pool[blocks].transpose(0, 1).flatten(1, 2)
 
-        return k_out, v_out
+        return k[:, :length].clone(), v[:, :length].clone()
+
+    def restore(self, row: int, k: Tensor, v: Tensor):
+        block_size = self.allocator.block_size
+        positions = torch.arange(k.size(1), device=k.device)
+        blocks = self.allocator.block_tables[row, positions // block_size]
+        offsets = positions % block_size
+        self.k_pool[blocks, :, offsets] = k.transpose(0, 1)
+        self.v_pool[blocks, :, offsets] = v.transpose(0, 1)
 
 
 @dataclass
@@ -176,6 +513,11 @@ class BaseTransformer(nn.Module):
         self.semantic_token_ids = [
             tokenizer.get_token_id(SEMANTIC_TOKEN) for SEMANTIC_TOKEN in SEMANTIC_TOKENS
         ]
+        self.register_buffer(
+            "semantic_token_ids_tensor",
+            torch.tensor(self.semantic_token_ids, dtype=torch.long),
+            persistent=False,
+        )
 
         # Slow transformer
         self.embeddings = nn.Embedding(
@@ -207,50 +549,192 @@ class BaseTransformer(nn.Module):
             ),
             persistent=False,
         )
-        self.register_buffer(
-            "causal_mask",
-            torch.tril(
-                torch.ones(
-                    config.max_seq_len,
-                    config.max_seq_len,
-                    dtype=torch.bool,
-                )
-            ),
-            persistent=False,
-        )
-
         # For kv cache
         self.max_batch_size = -1
         self.max_seq_len = -1
+        self.kv_allocator = None
+        # Layout of the KV caches, kept so that they can be grown without changing it
+        self.kv_block_size = 0
+        self.kv_num_blocks = 0
+        self.kv_cache_int8 = False
+
+        # For constrained vocabulary decoding, see setup_output_subset
+        self.register_buffer("output_subset_ids", None, persistent=False)
+        self.register_buffer("output_subset_weight", None, persistent=False)
+        self.register_buffer("token_to_subset", None, persistent=False)
 
         if init_weights:
             self.apply(self._init_weights)
 
     def setup_caches(
-        self, max_batch_size: int, max_seq_len: int, dtype: torch.dtype = torch.bfloat16
+        self,
+        max_batch_size: int,
+        max_seq_len: int,
+        dtype: torch.dtype = torch.bfloat16,
+        kv_block_size: int = 0,
+        kv_num_blocks: int = 0,
+        kv_cache_int8: bool = False,
     ):
-        if self.max_seq_len >= max_seq_len and self.max_batch_size >= max_batch_size:
+        """
+        Allocate the KV caches. With `kv_block_size` > 0 the caches are paged:
+        blocks are taken from a shared pool of `kv_num_blocks` blocks (grown on demand)
+        and must be reserved with `reserve_kv` before every forward pass.
+        With `kv_cache_int8`, the dense caches are stored as int8, see QuantizedKVCache.
+        The caches are only kept if they are large enough and have the same layout,
+        the paged pool grows on demand so its size is not compared.
+        """
+        if (
+            self.max_seq_len >= max_seq_len
+            and self.max_batch_size >= max_batch_size
+            and self.kv_block_size == kv_block_size
+            and self.kv_cache_int8 == kv_cache_int8
+        ):
             return
 
+        if kv_cache_int8 and kv_block_size > 0:
+            raise ValueError("The int8 KV cache does not support paging")
+
         head_dim = self.config.dim // self.config.n_head
         max_seq_len = find_multiple(max_seq_len, 8)
         self.max_seq_len = max_seq_len
         self.max_batch_size = max_batch_size
+        self.kv_block_size = kv_block_size
+        self.kv_num_blocks = kv_num_blocks
+        self.kv_cache_int8 = kv_cache_int8
 
-        for b in self.layers:
-            b.attention.kv_cache = KVCache(
+        if kv_block_size > 0:
+            self.kv_allocator = KVBlockAllocator(
                 max_batch_size,
                 max_seq_len,
-                self.config.n_local_heads,
-                head_dim,
-                dtype=dtype,
+                kv_block_size,
+                kv_num_blocks or -(-max_seq_len // kv_block_size) + 1,
             )
+        else:
+            self.kv_allocator = None
+
+        for b in self.layers:
+            if self.kv_allocator is not None:
+                b.attention.kv_cache = PagedKVCache(
+                    self.kv_allocator,
+                    self.config.n_local_heads,
+                    head_dim,
+                    dtype=dtype,
+                )
+            else:
+                b.attention.kv_cache = (QuantizedKVCache if kv_cache_int8 else KVCache)(
+                    max_batch_size,
+                    max_seq_len,
+                    self.config.n_local_heads,
+                    head_dim,
+                    dtype=dtype,
+                )
+
+    def get_output_weight(self, token_ids: Tensor) -> Tensor:
+        """
+        Rows of the output projection for `token_ids`, dequantized if needed.
+        """
+        if self.config.tie_word_embeddings:
+            return self.embeddings.weight[token_ids]
+
+        if hasattr(self.output, "scales") and self.output.scales.dim() == 1:
+            # Int8 weight-only quantization, one scale per output channel
+            weight = self.output.weight[token_ids].to(self.output.scales.dtype)
+            return weight * self.output.scales[token_ids, None]
+
+        if isinstance(self.output, nn.Linear):
+            return self.output.weight[token_ids]
+
+        raise ValueError(
+            f"Vocabulary subset is not supported for {type(self.output).__name__}"
+        )
+
+    def setup_output_subset(self, token_ids: Optional[list[int]]):
+        """
+        Compute the logits of forward_generate only over `token_ids`, the logits are then
+        indexed by the position in `token_ids`. An extra -inf column is appended, tokens
+        outside of the subset map to it in `token_to_subset`. None restores the full vocabulary.
+        """
+        if token_ids is None:
+            self.output_subset_ids = None
+            self.output_subset_weight = None
+            self.token_to_subset = None
+            return
+
+        device = self.embeddings.weight.device
+        ids = torch.tensor(token_ids, dtype=torch.long, device=device)
+        token_to_subset = torch.full(
+            (self.config.vocab_size,), len(token_ids), dtype=torch.long, device=device
+        )
+        token_to_subset[ids] = torch.arange(len(token_ids), device=device)
+
+        self.output_subset_ids = ids
+        self.output_subset_weight = self.get_output_weight(ids).contiguous()
+        self.token_to_subset = token_to_subset
+
+    def reserve_kv(self, length: int, row: int = 0):
+        """
+        Make sure the first `length` positions of batch row `row` can be written.
+        No-op for dense caches.
+        """
+        if self.kv_allocator is not None:
+            self.kv_allocator.reserve(row, length)
+
+    def release_cache_row(self, row: int):
+        """
+        Return the KV blocks of batch row `row` to the pool. No-op for dense caches.
+        """
+        if self.kv_allocator is not None:
+            self.kv_allocator.release(row)
+
+    def move_cache_row(self, src: int, dst: int):
+        """
+        Move the KV cache of batch row `src` to row `dst`.
+        Used by the batching scheduler to keep active sequences packed at the front.
+        """
+        if src == dst:
+            return
+
+        if self.kv_allocator is not None:
+            # Paged caches only swap the block tables
+            self.kv_allocator.move(src, dst)
+            return
+
+        for b in self.layers:
+            b.attention.kv_cache.move_row(src, dst)
+
+    def fork_cache_row(self, src: int, dsts: list[int], length: int):
+        """
+        Give the batch rows `dsts` the KV entries of the first `length` positions of row `src`,
+        so that a prompt prefilled once can be continued by several sequences.
+        Paged caches share the prefix blocks instead of copying them.
+        """
+        if self.kv_allocator is not None:
+            for dst in dsts:
+                self.kv_allocator.fork(src, dst, length)
+            return
+
+        for b in self.layers:
+            b.attention.kv_cache.fork_row(src, dsts, length)
+
+    def snapshot_kv_prefix(
+        self, length: int, row: int = 0
+    ) -> list[tuple[Tensor, Tensor]]:
+        """
+        Copy the KV entries of the first `length` positions of batch row `row`.
+        """
+        return [b.attention.kv_cache.snapshot(row, length) for b in self.layers]
+
+    def restore_kv_prefix(self, kv: list[tuple[Tensor, Tensor]], row: int = 0):
+        """
+        Write a snapshot taken by `snapshot_kv_prefix` back into batch row `row`.
+        """
+        self.reserve_kv(kv[0][0].size(1), row)
+
+        for b, (k, v) in zip(self.layers, kv):
+            b.attention.kv_cache.restore(row, k, v)
 
     def embed(self, inp: Tensor, share_codebook_embeddings=True) -> Tensor:
         embeds = []
-        semantic_token_ids_tensor = torch.tensor(
-            self.semantic_token_ids, device=inp.device
-        )
 
         for i in range(self.config.num_codebooks):
             if share_codebook_embeddings:
@@ -262,7 +746,7 @@ class BaseTransformer(nn.Module):
             embeds.append(emb)
 
         vq_embeds_sum = torch.stack(embeds, dim=1).sum(dim=1)
-        vq_embeds_sum[~torch.isin(inp[:, 0], semantic_token_ids_tensor)] = 0
+        vq_embeds_sum[~torch.isin(inp[:, 0], self.semantic_token_ids_tensor)] = 0
         x = self.embeddings(inp[:, 0]) + vq_embeds_sum
 
         return x
@@ -284,7 +768,9 @@ class BaseTransformer(nn.Module):
         # To maintain consistency, key_padding_mask use TRUE to mask out
         mask = None
         if key_padding_mask is not None:
-            causal = self.causal_mask[:seq_len, :seq_len]
+            causal = torch.ones(
+                seq_len, seq_len, dtype=torch.bool, device=inp.device
+            ).tril()
             causal = rearrange(causal, "q k -> 1 1 q k")
 
             atten_mask = rearrange(key_padding_mask, "b s -> b 1 1 s")
@@ -317,7 +803,12 @@ class BaseTransformer(nn.Module):
         inp: Tensor,
         input_pos: Optional[Tensor] = None,
         return_all: bool = False,
+        batch_idx: Optional[Tensor] = None,
+        kv_len: Optional[int] = None,
     ) -> BaseTransformerForwardResult:
+        # input_pos is either shared by the whole batch ([S]) or given per sequence ([B, S])
+        # batch_idx selects the KV cache rows used by the batch, defaults to the first B rows
+        # kv_len bounds the attended KV positions, it must cover every position in input_pos
         x = self.embed(
             inp, share_codebook_embeddings=self.config.share_codebook_embeddings
         )
@@ -328,11 +819,19 @@ class BaseTransformer(nn.Module):
         else:
             max_seq_len = self.max_seq_len
 
-        mask = self.causal_mask[None, None, input_pos, :max_seq_len]  # (B, N, Q, K)
+        if kv_len is None:
+            kv_len = max_seq_len
+
+        # FALSE means masked out, same as in forward
+        mask = input_pos[..., None] >= torch.arange(kv_len, device=x.device)
+        if input_pos.ndim == 1:
+            mask = mask[None, None]  # (B, N, Q, K)
+        else:
+            mask = mask[:, None]
         freqs_cis = self.freqs_cis[input_pos]
 
         for layer in self.layers:
-            x = layer(x, freqs_cis, mask, input_pos=input_pos)
+            x = layer(x, freqs_cis, mask, input_pos=input_pos, batch_idx=batch_idx)
 
         # If prefill, we only calculate the logits of last token
         if x.size(1) > 1 and not return_all:
@@ -343,6 +842,10 @@ class BaseTransformer(nn.Module):
 
         if self.config.is_reward_model:
             token_logits = self.score_output(slow_out)
+        elif self.output_subset_weight is not None:
+            token_logits = F.linear(slow_out, self.output_subset_weight)
+            # Sink column for the tokens outside of the subset
+            token_logits = F.pad(token_logits, (0, 1), value=float("-inf"))
         elif self.config.tie_word_embeddings:
             token_logits = F.linear(slow_out, self.embeddings.weight)
         else:
@@ -517,9 +1020,15 @@ class NaiveTransformer(BaseTransformer):
         return self.decode(result)
 
     def forward_generate(
-        self, x: Tensor, input_pos: Optional[Tensor] = None
+        self,
+        x: Tensor,
+        input_pos: Optional[Tensor] = None,
+        batch_idx: Optional[Tensor] = None,
+        kv_len: Optional[int] = None,
     ) -> TransformerForwardResult:
-        result = super().forward_generate(x, input_pos)
+        result = super().forward_generate(
+            x, input_pos, batch_idx=batch_idx, kv_len=kv_len
+        )
         return self.decode(result)
 
 
@@ -570,9 +1079,22 @@ class DualARTransformer(BaseTransformer):
         self.apply(self._init_weights)
 
     def setup_caches(
-        self, max_batch_size: int, max_seq_len: int, dtype: torch.dtype = torch.bfloat16
+        self,
+        max_batch_size: int,
+        max_seq_len: int,
+        dtype: torch.dtype = torch.bfloat16,
+        kv_block_size: int = 0,
+        kv_num_blocks: int = 0,
+        kv_cache_int8: bool = False,
     ):
-        super().setup_caches(max_batch_size, max_seq_len, dtype)
+        super().setup_caches(
+            max_batch_size,
+            max_seq_len,
+            dtype,
+            kv_block_size,
+            kv_num_blocks,
+            kv_cache_int8,
+        )
 
         head_dim = self.config.fast_dim // self.config.fast_n_head
 
@@ -599,9 +1121,10 @@ class DualARTransformer(BaseTransformer):
 
         # Fast transformer
         fast_seq_len = self.config.num_codebooks
-        fast_mask = self.causal_mask[
-            None, None, :fast_seq_len, :fast_seq_len
-        ]  # (B, N, Q, K)
+        fast_mask = torch.ones(
+            fast_seq_len, fast_seq_len, dtype=torch.bool, device=inp.device
+        ).tril()
+        fast_mask = fast_mask[None, None]  # (B, N, Q, K)
 
         # Drop the last token and rotate left
         codebooks = inp[:, 1:-1, 1:]
@@ -662,12 +1185,12 @@ class DualARTransformer(BaseTransformer):
     def forward_generate_fast(
         self, x: Tensor, input_pos: Optional[Tensor] = None
     ) -> Tensor:
-        # Fast transformer
-        x = x.view(1, 1, -1)
+        # Fast transformer, one codebook position for every sequence of the batch
+        x = x.view(-1, 1, x.size(-1))
 
-        fast_mask = self.causal_mask[
-            None, None, input_pos, : self.config.num_codebooks
-        ]  # (B, N, Q, K)
+        fast_pos = torch.arange(self.config.num_codebooks, device=input_pos.device)
+        fast_mask = input_pos[:, None] >= fast_pos
+        fast_mask = fast_mask[None, None]  # (B, N, Q, K)
         fast_freqs_cis = self.fast_freqs_cis[input_pos]
 
         for layer in self.fast_layers:
@@ -684,8 +1207,13 @@ class DualARTransformer(BaseTransformer):
         x: Tensor,
         input_pos: Optional[Tensor] = None,
         vq_masks: Optional[Tensor] = None,
+        batch_idx: Optional[Tensor] = None,
+        kv_len: Optional[int] = None,
+        return_all: bool = False,
     ) -> TransformerForwardResult:
-        x = super().forward_generate(x, input_pos, vq_masks)
+        x = super().forward_generate(
+            x, input_pos, return_all, batch_idx=batch_idx, kv_len=kv_len
+        )
         x.hidden_states = self.fast_project_in(x.hidden_states)
         return x
 
@@ -699,9 +1227,16 @@ class TransformerBlock(nn.Module):
         self.attention_norm = RMSNorm(config.dim, config.norm_eps)
 
     def forward(
-        self, x: Tensor, freqs_cis: Tensor, mask: Tensor, input_pos: Tensor = None
+        self,
+        x: Tensor,
+        freqs_cis: Tensor,
+        mask: Tensor,
+        input_pos: Tensor = None,
+        batch_idx: Optional[Tensor] = None,
     ) -> Tensor:
-        h = x + self.attention(self.attention_norm(x), freqs_cis, mask, input_pos)
+        h = x + self.attention(
+            self.attention_norm(x), freqs_cis, mask, input_pos, batch_idx
+        )
         out = h + self.feed_forward(self.ffn_norm(h))
         return out
 
@@ -740,6 +1275,7 @@ class Attention(nn.Module):
         freqs_cis: Tensor,
         mask: Tensor,
         input_pos: Optional[Tensor] = None,
+        batch_idx: Optional[Tensor] = None,
     ) -> Tensor:
         bsz, seqlen, _ = x.shape
 
@@ -755,11 +1291,32 @@ class Attention(nn.Module):
 
         q, k, v = map(lambda x: x.transpose(1, 2), (q, k, v))
 
+        if isinstance(self.kv_cache, QuantizedKVCache):
+            y = self.quantized_attention(
+                q,
+                *self.kv_cache.update(input_pos, k, v, batch_idx, kv_len=mask.size(-1)),
+                mask,
+            )
+            y = y.reshape(bsz, self.n_head, seqlen, self.head_dim)
+            y = y.transpose(1, 2).contiguous().view(bsz, seqlen, self.dim)
+
+            return self.wo(y)
+
         if self.kv_cache is not None:
-            k, v = self.kv_cache.update(input_pos, k, v)
+            # Only the positions covered by the mask are read back
+            k, v = self.kv_cache.update(
+                input_pos, k, v, batch_idx, kv_len=mask.size(-1)
+            )
 
-        k = k.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
-        v = v.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
+        n_rep = self.n_head // self.n_local_heads
+        if mask is not None and n_rep > 1:
+            # Grouped-query attention: fold the query heads sharing a KV head into
+            # the query length, so that K/V are used as they are instead of repeated
+            q = q.reshape(bsz, self.n_local_heads, n_rep * seqlen, self.head_dim)
+            mask = mask.repeat(1, 1, n_rep, 1)
+        else:
+            k = k.repeat_interleave(n_rep, dim=1)
+            v = v.repeat_interleave(n_rep, dim=1)
 
         if self.use_sdpa:
             if mask is None:
@@ -789,10 +1346,38 @@ class Attention(nn.Module):
                 dropout_p=self.dropout if self.training else 0.0,
             )
 
+        y = y.reshape(bsz, self.n_head, seqlen, self.head_dim)
         y = y.transpose(1, 2).contiguous().view(bsz, seqlen, self.dim)
 
         return self.wo(y)
 
+    def quantized_attention(
+        self,
+        query: Tensor,
+        key: Tensor,
+        key_scale: Tensor,
+        value: Tensor,
+        value_scale: Tensor,
+        attn_mask: Tensor,
+    ) -> Tensor:
+        # Attention over the int8 entries of QuantizedKVCache, the per-token scales are
+        # folded into the scores and the probabilities:
+        # q.(s_k * k)^T = (q.k^T) * s_k^T and p.(s_v * v) = (p * s_v^T).v
+
+        bsz, _, seqlen, _ = query.shape
+        n_rep = self.n_head // self.n_local_heads
+
+        # Grouped-query attention, the query heads sharing a KV head are folded as in forward
+        query = query.reshape(bsz, self.n_local_heads, n_rep * seqlen, self.head_dim)
+        attn_mask = attn_mask.repeat(1, 1, n_rep, 1)
+
+        scores = query @ key.transpose(-2, -1).to(query.dtype)
+        scores = scores * (key_scale.transpose(-2, -1) / math.sqrt(self.head_dim))
+        scores = scores.masked_fill(attn_mask.logical_not(), float("-inf"))
+        probs = torch.softmax(scores.float(), dim=-1).to(query.dtype)
+
+        return (probs * value_scale.transpose(-2, -1)) @ value.to(query.dtype)
+
     def eq_scaled_dot_product_attention(
         self,
         query,
@@ -871,7 +1456,8 @@ def precompute_freqs_cis(seq_len: int, n_elem: int, base: int = 10000) -> Tensor
 
 def apply_rotary_emb(x: Tensor, freqs_cis: Tensor) -> Tensor:
     xshaped = x.float().reshape(*x.shape[:-1], -1, 2)
-    freqs_cis = freqs_cis.view(1, xshaped.size(1), 1, xshaped.size(3), 2)
+    # freqs_cis is [S, ...] when shared by the batch, or [B, S, ...] per sequence
+    freqs_cis = freqs_cis.view(-1, xshaped.size(1), 1, xshaped.size(3), 2)
     x_out2 = torch.stack(
         [
             xshaped[..., 0] * freqs_cis[..., 0] - xshaped[..., 1] * freqs_cis[..., 1],
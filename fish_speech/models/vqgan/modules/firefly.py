@@ -98,6 +98,25 @@ class FishConvNet(nn.Module):
         x = pad1d(x, (pad, extra_padding), mode="constant", value=0)
         return self.conv(x).contiguous()
 
+    def forward_stream(self, x, state: dict):
+        """
+        Incremental version of `forward`, `state` keeps the left context that
+        the next chunk needs (initially the zero padding of `forward`).
+        """
+
+        context = state.get(self)
+        if context is None:
+            context = x.new_zeros(*x.shape[:-1], self.kernel_size - self.stride)
+
+        x = torch.cat([context, x], dim=-1)
+        n_frames = (x.shape[-1] - self.kernel_size) // self.stride + 1
+        state[self] = x[..., n_frames * self.stride :]
+
+        if n_frames <= 0:
+            return x.new_zeros(*x.shape[:-2], self.conv.out_channels, 0)
+
+        return self.conv(x[..., : (n_frames - 1) * self.stride + self.kernel_size])
+
     def weight_norm(self, name="weight", dim=0):
         self.conv = weight_norm(self.conv, name=name, dim=dim)
         return self
@@ -124,6 +143,33 @@ class FishTransConvNet(nn.Module):
         x = unpad1d(x, (padding_left, padding_right))
         return x.contiguous()
 
+    def forward_stream(self, x, state: dict):
+        """
+        Incremental version of `forward`, the outputs of neighbouring frames overlap,
+        so the part that still depends on future frames is kept in `state` and added
+        to the next chunk.
+        """
+
+        length = x.shape[-1] * self.stride
+        x = F.conv_transpose1d(
+            x,
+            self.conv.weight,
+            stride=self.conv.stride,
+            dilation=self.conv.dilation,
+        )
+
+        tail = state.get(self)
+        if tail is not None:
+            x[..., : tail.shape[-1]] += tail
+
+        state[self] = x[..., length:]
+        x = x[..., :length]
+
+        if self.conv.bias is not None:
+            x = x + self.conv.bias[:, None].to(x.dtype)
+
+        return x
+
     def weight_norm(self, name="weight", dim=0):
         self.conv = weight_norm(self.conv, name=name, dim=dim)
         return self
@@ -176,6 +222,15 @@ class ResBlock1(torch.nn.Module):
             x = xt + x
         return x
 
+    def forward_stream(self, x, state: dict):
+        for c1, c2 in zip(self.convs1, self.convs2):
+            xt = F.silu(x)
+            xt = c1.forward_stream(xt, state)
+            xt = F.silu(xt)
+            xt = c2.forward_stream(xt, state)
+            x = xt + x
+        return x
+
     def remove_parametrizations(self):
         for conv in self.convs1:
             conv.remove_parametrizations()
@@ -199,7 +254,17 @@ class ParallelBlock(nn.Module):
             self.blocks.append(ResBlock1(channels, k, d))
 
     def forward(self, x):
-        return torch.stack([block(x) for block in self.blocks], dim=0).mean(dim=0)
+        # Accumulate in place instead of stacking the outputs of all the blocks
+        out = self.blocks[0](x)
+        for block in self.blocks[1:]:
+            out += block(x)
+        return out / len(self.blocks)
+
+    def forward_stream(self, x, state: dict):
+        out = self.blocks[0].forward_stream(x, state)
+        for block in self.blocks[1:]:
+            out += block.forward_stream(x, state)
+        return out / len(self.blocks)
 
     def remove_parametrizations(self):
         for block in self.blocks:
@@ -286,6 +351,25 @@ class HiFiGANGenerator(nn.Module):
 
         return x
 
+    def forward_stream(self, x, state: dict):
+        """
+        Decode a chunk of mel frames, `state` holds the left context of every layer
+        and must be passed again with the following chunk of the same sequence.
+        """
+
+        x = self.conv_pre.forward_stream(x, state)
+
+        for i in range(self.num_upsamples):
+            x = F.silu(x)
+            x = self.ups[i].forward_stream(x, state)
+            x = self.resblocks[i].forward_stream(x, state)
+
+        x = self.activation_post(x)
+        x = self.conv_post.forward_stream(x, state)
+        x = torch.tanh(x)
+
+        return x
+
     def remove_parametrizations(self):
         for up in self.ups:
             up.remove_parametrizations()
@@ -434,6 +518,39 @@ class ConvNeXtBlock(nn.Module):
 
         return x
 
+    @torch.no_grad()
+    def fuse_layer_scale(self):
+        """
+        Fold the layer scale into the last pointwise conv, it is a per-channel scale of its output.
+        """
+
+        if self.gamma is None:
+            return
+
+        self.pwconv2.weight.mul_(self.gamma[:, None])
+        self.pwconv2.bias.mul_(self.gamma)
+        self.gamma = None
+
+    def forward_stream(self, x, state: dict, apply_residual: bool = True):
+        input = x
+
+        x = self.dwconv.forward_stream(x, state)
+        x = x.permute(0, 2, 1)  # (N, C, L) -> (N, L, C)
+        x = self.norm(x)
+        x = self.pwconv1(x)
+        x = self.act(x)
+        x = self.pwconv2(x)
+
+        if self.gamma is not None:
+            x = self.gamma * x
+
+        x = x.permute(0, 2, 1)  # (N, L, C) -> (N, C, L)
+
+        if apply_residual:
+            x = input + x
+
+        return x
+
 
 class ConvNeXtEncoder(nn.Module):
     def __init__(
@@ -584,6 +701,51 @@ class FireflyArchitecture(nn.Module):
 
         return x, audio_lengths
 
+    def decode_stream(self, indices, state: dict) -> torch.Tensor:
+        """
+        Decode the next frames `indices` (B, N, T) of a sequence whose previous frames were
+        decoded with the same `state` dict (start with an empty one).
+        Concatenating the outputs gives the same audio as `decode` on the whole sequence.
+        """
+
+        z = self.quantizer.decode_stream(indices, state)
+        return self.head.forward_stream(z, state)
+
+    def optimize_for_inference(self, compile: bool = False):
+        """
+        Rewrite the model for decoding: the weight norm parametrizations are removed so the
+        weights are no longer recomputed on every forward, the ConvNeXt layer scales are
+        folded into the convs and the quantizer codebooks are turned into lookup tables.
+        With `compile`, the decoder is compiled with torch.compile, which also fuses the
+        activations into the convs; the compiled kernels go to the inductor cache
+        (TORCHINDUCTOR_CACHE_DIR) so that the next loads skip most of the compilation.
+        """
+
+        self.remove_parametrizations()
+
+        for module in self.modules():
+            if isinstance(module, ConvNeXtBlock):
+                module.fuse_layer_scale()
+
+        if hasattr(self.quantizer, "build_lookup_tables"):
+            self.quantizer.build_lookup_tables()
+
+        if compile:
+            import torch._inductor.config
+
+            torch._inductor.config.fx_graph_cache = True
+
+            # The upsample stages are compiled one module at a time: `decode_stream`
+            # iterates the stages, which a compiled container can't do
+            for stage in self.quantizer.upsample:
+                for i, module in enumerate(stage):
+                    stage[i] = torch.compile(module, dynamic=True)
+
+            # `forward_stream` is forwarded to the uncompiled head
+            self.head = torch.compile(self.head, dynamic=True)
+
+        return self
+
     def remove_parametrizations(self):
         if hasattr(self.backbone, "remove_parametrizations"):
             self.backbone.remove_parametrizations()
@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
+from loguru import logger
 from vector_quantize_pytorch import GroupedResidualFSQ
 
 from .firefly import ConvNeXtBlock, FishConvNet, FishTransConvNet
@@ -75,6 +76,12 @@ class DownsampleFiniteScalarQuantize(nn.Module):
 
         self.apply(self._init_weights)
 
+        # Built from the trained projections by `build_lookup_tables`
+        self.register_buffer("decode_table", None, persistent=False)
+        self.register_buffer("decode_offsets", None, persistent=False)
+        self.register_buffer("encode_weight", None, persistent=False)
+        self.register_buffer("encode_bias", None, persistent=False)
+
     def _init_weights(self, m):
         if isinstance(m, (nn.Conv1d, nn.Linear)):
             nn.init.trunc_normal_(m.weight, std=0.02)
@@ -105,12 +112,158 @@ class DownsampleFiniteScalarQuantize(nn.Module):
 
     def encode(self, z):
         z = self.downsample(z)
+
+        if self.encode_weight is not None:
+            return self.quantize_indices(z)
+
         _, indices = self.residual_fsq(z.mT)
         indices = rearrange(indices, "g b l r -> b (g r) l")
         return indices
 
     def decode(self, indices: torch.Tensor):
-        indices = rearrange(indices, "b (g r) l -> g b l r", g=self.residual_fsq.groups)
-        z_q = self.residual_fsq.get_output_from_indices(indices)
-        z_q = self.upsample(z_q.mT)
+        z_q = self.lookup(indices)
+        z_q = self.upsample(z_q)
+        return z_q
+
+    @torch.no_grad()
+    def build_lookup_tables(self, check: bool = True):
+        """
+        The quantizer has a small fixed codebook per group and residual level, so the output
+        projection of every code is precomputed into a single table, decoding becomes a gather.
+        The table depends on the trained weights, call it after loading them.
+        """
+
+        rvqs = self.residual_fsq.rvqs
+        codebook_size = self.residual_fsq.codebook_size
+
+        tables = []
+        for rvq in rvqs:
+            # (R, C, d) codes of each residual level, scaled like `get_codes_from_indices`
+            codes = rvq.codebooks * rvq.scales[:, None, :]
+            # The bias of the projection is only added once, with the first level
+            weight = rvq.project_out.weight
+            bias = rvq.project_out.bias
+            table = codes @ weight.T
+            table[0] += bias
+            tables.append(table)
+
+        # (G * R * C, D)
+        self.decode_table = torch.stack(tables).flatten(0, 2)
+        self.decode_offsets = (
+            torch.arange(
+                len(rvqs) * rvqs[0].num_quantizers, device=self.decode_table.device
+            )
+            * codebook_size
+        )
+
+        # (G, d, D) and (G, d) input projections for the vectorized encoder
+        self.encode_weight = torch.stack([rvq.project_in.weight for rvq in rvqs])
+        self.encode_bias = torch.stack([rvq.project_in.bias for rvq in rvqs])
+
+        if not check:
+            return
+
+        decode_diff, encode_match = self.check_lookup_tables()
+        if decode_diff >= 1e-5:
+            logger.warning(
+                f"FSQ decode table differs from the quantizer by {decode_diff:.2e}, "
+                "decoding falls back to GroupedResidualFSQ"
+            )
+            self.decode_table = None
+        if encode_match < 1.0:
+            logger.warning(
+                f"FSQ vectorized encode matches the quantizer on {encode_match:.2%} "
+                "of the codes, encoding falls back to GroupedResidualFSQ"
+            )
+            self.encode_weight = None
+
+    @torch.no_grad()
+    def check_lookup_tables(self) -> tuple[float, float]:
+        """
+        Compare the table decode and the vectorized encode with `GroupedResidualFSQ`,
+        returns the max decode difference and the fraction of matching encoded codes.
+        The inputs are drawn from a fixed seed so that the outcome is the same on every load.
+        """
+
+        groups = self.residual_fsq.groups
+        num_quantizers = self.residual_fsq.rvqs[0].num_quantizers
+        device = self.decode_table.device
+        generator = torch.Generator().manual_seed(0)
+
+        indices = torch.randint(
+            0,
+            self.residual_fsq.codebook_size,
+            (2, groups * num_quantizers, 64),
+            generator=generator,
+        ).to(device)
+        expected = self.residual_fsq.get_output_from_indices(
+            rearrange(indices, "b (g r) l -> g b l r", g=groups)
+        ).mT
+        decode_diff = (self.lookup(indices) - expected).abs().max().item()
+
+        z = torch.randn(2, self.residual_fsq.dim, 64, generator=generator).to(device)
+        _, expected = self.residual_fsq(z.mT)
+        expected = rearrange(expected, "g b l r -> b (g r) l")
+        encode_match = (self.quantize_indices(z) == expected).float().mean().item()
+
+        logger.info(
+            f"FSQ lookup tables: max decode diff {decode_diff:.2e}, encode match {encode_match:.2%}"
+        )
+
+        return decode_diff, encode_match
+
+    def lookup(self, indices: torch.Tensor):
+        """
+        Indices (B, G * R, L) to latents (B, D, L).
+        """
+
+        if self.decode_table is None:
+            indices = rearrange(
+                indices, "b (g r) l -> g b l r", g=self.residual_fsq.groups
+            )
+            return self.residual_fsq.get_output_from_indices(indices).mT
+
+        groups = self.residual_fsq.groups
+        z_q = F.embedding(
+            indices.long() + self.decode_offsets[:, None], self.decode_table
+        )
+        # (B, G * R, L, d) -> (B, G * d, L), summing the residual levels
+        z_q = rearrange(z_q, "b (g r) l d -> b r (g d) l", g=groups).sum(dim=1)
+        return z_q
+
+    def quantize_indices(self, z: torch.Tensor):
+        """
+        Latents (B, D, L) to indices (B, G * R, L), all the groups are rounded at once.
+        Same computation as `GroupedResidualFSQ.forward`.
+        """
+
+        rvq = self.residual_fsq.rvqs[0]
+        fsq = rvq.layers[0]
+        half_width = fsq._levels // 2
+
+        z = rearrange(z, "b (g d) l -> b l g d", g=self.residual_fsq.groups)
+        x = torch.einsum("blgd,gcd->blgc", z, self.encode_weight) + self.encode_bias
+        residual = fsq.bound(x)
+
+        all_indices = []
+        with torch.autocast(device_type=z.device.type, enabled=False):
+            for scale in rvq.scales:
+                level = fsq.bound((residual / scale).float()).round()
+                residual = residual - level / half_width * scale
+                all_indices.append(((level + half_width) * fsq._basis).sum(dim=-1))
+
+        indices = torch.stack(all_indices, dim=-1).to(torch.int32)
+        return rearrange(indices, "b l g r -> b (g r) l")
+
+    def decode_stream(self, indices: torch.Tensor, state: dict):
+        """
+        Incremental version of `decode`, see `FireflyArchitecture.decode_stream`.
+        """
+
+        z_q = self.lookup(indices)
+
+        for upsample, block in self.upsample:
+            z_q = upsample.forward_stream(z_q, state)
+            z_q = block.forward_stream(z_q, state)
+
         return z_q
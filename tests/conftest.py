@@ -0,0 +1,102 @@
+import base64
+
+import pytest
+
+# The models are imported by the fixtures, so that the test modules can skip
+# themselves when torch is not installed
+
+
+@pytest.fixture
+def tokenizer(tmp_path):
+    """
+    Byte-level tokenizer with the special tokens of the released models.
+    """
+
+    from fish_speech.tokenizer import FishTokenizer
+
+    path = tmp_path / "tokenizer.tiktoken"
+    path.write_text(
+        "\n".join(f"{base64.b64encode(bytes([i])).decode()} {i}" for i in range(256))
+    )
+
+    return FishTokenizer(str(path))
+
+
+@pytest.fixture
+def llama(tokenizer):
+    """
+    Randomly initialized DualAR model, small enough for the CPU.
+    """
+
+    import torch
+
+    from fish_speech.models.text2semantic.llama import (
+        DualARModelArgs,
+        DualARTransformer,
+    )
+    from fish_speech.tokenizer import ALL_SPECIAL_TOKENS
+
+    torch.manual_seed(0)
+
+    config = DualARModelArgs(
+        vocab_size=256 + len(ALL_SPECIAL_TOKENS),
+        n_layer=2,
+        n_head=4,
+        n_local_heads=2,
+        dim=64,
+        max_seq_len=64,
+        codebook_size=32,
+        num_codebooks=2,
+        n_fast_layer=1,
+        use_gradient_checkpointing=False,
+    )
+
+    return DualARTransformer(config, tokenizer).eval()
+
+
+@pytest.fixture
+def vocoder():
+    """
+    Randomly initialized vocoder with the layout of firefly_gan_vq.yaml, scaled down.
+    """
+
+    import torch
+
+    from fish_speech.models.vqgan.modules.firefly import (
+        ConvNeXtEncoder,
+        FireflyArchitecture,
+        HiFiGANGenerator,
+    )
+    from fish_speech.models.vqgan.modules.fsq import DownsampleFiniteScalarQuantize
+    from fish_speech.utils.spectrogram import LogMelSpectrogram
+
+    torch.manual_seed(0)
+
+    model = FireflyArchitecture(
+        spec_transform=LogMelSpectrogram(
+            sample_rate=8000, n_mels=32, n_fft=128, hop_length=32, win_length=128
+        ),
+        backbone=ConvNeXtEncoder(
+            input_channels=32, depths=[1, 1], dims=[32, 64], kernel_size=7
+        ),
+        head=HiFiGANGenerator(
+            hop_length=32,
+            upsample_rates=[4, 4, 2],
+            upsample_kernel_sizes=[8, 8, 4],
+            resblock_kernel_sizes=[3, 7],
+            resblock_dilation_sizes=[[1, 3], [1, 3]],
+            num_mels=64,
+            upsample_initial_channel=64,
+            pre_conv_kernel_size=7,
+            post_conv_kernel_size=7,
+        ),
+        quantizer=DownsampleFiniteScalarQuantize(
+            input_dim=64,
+            n_groups=2,
+            n_codebooks=1,
+            levels=[8, 5, 5, 5],
+            downsample_factor=[2, 2],
+        ),
+    )
+
+    return model.eval()
@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from einops import rearrange
+
+from fish_speech.models.vqgan.modules.fsq import DownsampleFiniteScalarQuantize
+
+
+@pytest.fixture(params=[1, 2], ids=["1-level", "2-levels"])
+def quantizer(request) -> DownsampleFiniteScalarQuantize:
+    torch.manual_seed(0)
+
+    quantizer = DownsampleFiniteScalarQuantize(
+        input_dim=64,
+        n_groups=2,
+        n_codebooks=request.param,
+        levels=[8, 5, 5, 5],
+        downsample_factor=[2, 2],
+    ).eval()
+
+    # The biases are zero at init, make the projections look trained
+    for name, param in quantizer.residual_fsq.named_parameters():
+        if name.endswith("bias"):
+            torch.nn.init.normal_(param, std=0.1)
+
+    quantizer.build_lookup_tables(check=False)
+    return quantizer
+
+
+@torch.inference_mode()
+def test_lookup_matches_quantizer(quantizer):
+    fsq = quantizer.residual_fsq
+    num_rows = fsq.groups * fsq.rvqs[0].num_quantizers
+
+    # Every code of every group and residual level, in a different order on each row
+    indices = torch.stack([torch.randperm(fsq.codebook_size) for _ in range(num_rows)])[
+        None
+    ]
+    expected = fsq.get_output_from_indices(
+        rearrange(indices, "b (g r) l -> g b l r", g=fsq.groups)
+    ).mT
+
+    # Same products, only the residual levels are summed in another order
+    torch.testing.assert_close(quantizer.lookup(indices), expected)
+
+
+@torch.inference_mode()
+def test_quantize_indices_matches_quantizer(quantizer):
+    fsq = quantizer.residual_fsq
+    generator = torch.Generator().manual_seed(0)
+    z = torch.randn(4, fsq.dim, 256, generator=generator) * 2
+
+    _, expected = fsq(z.mT)
+    expected = rearrange(expected, "g b l r -> b (g r) l")
+
+    # The codes are integers, they must be identical
+    assert torch.equal(quantizer.quantize_indices(z).long(), expected.long())
+
+
+@torch.inference_mode()
+def test_lookup_tables_kept_after_check(quantizer):
+    quantizer.build_lookup_tables()
+
+    assert quantizer.decode_table is not None
+    assert quantizer.encode_weight is not None
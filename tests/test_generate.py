@@ -0,0 +1,56 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from tools.llama.generate import generate_agent
+
+
+def run_agent(model, prompt, num_samples: int, **cache_kwargs):
+    with torch.device("cpu"):
+        model.setup_caches(
+            max_batch_size=1,
+            max_seq_len=model.config.max_seq_len,
+            dtype=torch.float32,
+            **cache_kwargs,
+        )
+
+    torch.manual_seed(0)
+    return list(
+        generate_agent(
+            model=model,
+            prompt=prompt,
+            max_new_tokens=24,
+            semantic_ids=model.semantic_token_ids,
+            num_samples=num_samples,
+            early_stop_threshold=0,
+            temperature=0.7,
+            top_p=0.9,
+            repetition_penalty=1.1,
+        )
+    )
+
+
+def test_generate_agent_paged(llama):
+    codebook_size = llama.config.codebook_size
+    semantic_ids = torch.tensor(llama.semantic_token_ids[:codebook_size])
+
+    # A prompt of semantic tokens, long enough to cover several KV blocks
+    torch.manual_seed(1)
+    length = 10
+    prompt = torch.cat(
+        [
+            semantic_ids[torch.randint(0, codebook_size, (1, length))],
+            torch.randint(0, codebook_size, (llama.config.num_codebooks, length)),
+        ]
+    )
+
+    dense = run_agent(llama, prompt, num_samples=3)
+    paged = run_agent(llama, prompt, num_samples=3, kv_block_size=4, kv_num_blocks=4)
+
+    # The decoded positions go well past the prompt, they must land in reserved blocks
+    assert len(paged) == len(dense) > 1
+    for dense_tokens, paged_tokens in zip(dense, paged):
+        assert torch.equal(dense_tokens, paged_tokens)
+
+    # Only the first row keeps its blocks
+    assert all(not blocks for blocks in llama.kv_allocator.row_blocks[1:])
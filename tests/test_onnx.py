@@ -0,0 +1,40 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from tools.vqgan.export_onnx import export
+from tools.vqgan.onnx_model import OnnxFireflyModel
+
+
+@torch.inference_mode()
+def test_onnx_matches_pytorch(vocoder, tmp_path):
+    model = vocoder.optimize_for_inference()
+    export(model, tmp_path)
+    onnx_model = OnnxFireflyModel(tmp_path)
+
+    fsq = model.quantizer.residual_fsq
+    generator = torch.Generator().manual_seed(0)
+    indices = torch.randint(
+        0,
+        fsq.codebook_size,
+        (1, fsq.groups * fsq.rvqs[0].num_quantizers, 50),
+        generator=generator,
+    )
+    lengths = torch.tensor([indices.size(-1)])
+
+    expected, expected_lengths = model.decode(indices, lengths)
+    actual, actual_lengths = onnx_model.decode(indices, lengths)
+
+    assert torch.equal(actual_lengths, expected_lengths)
+    torch.testing.assert_close(actual, expected, rtol=1e-3, atol=1e-3)
+
+    audios = expected[:, :, : expected.size(-1) // 2]
+    audio_lengths = torch.tensor([audios.size(-1)])
+    expected_codes, _ = model.encode(audios, audio_lengths)
+    actual_codes, _ = onnx_model.encode(audios, audio_lengths)
+
+    # Values close to a rounding boundary may land in a neighbouring level
+    assert actual_codes.shape == expected_codes.shape
+    assert (actual_codes == expected_codes).float().mean().item() > 0.99
@@ -0,0 +1,40 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def random_codes(model, length: int, batch_size: int = 1):
+    quantizer = model.quantizer.residual_fsq
+    return torch.randint(
+        0,
+        quantizer.codebook_size,
+        (batch_size, quantizer.groups * quantizer.rvqs[0].num_quantizers, length),
+    )
+
+
+@torch.inference_mode()
+def test_decode_stream_compiled(vocoder):
+    reference = copy.deepcopy(vocoder).optimize_for_inference()
+    compiled = vocoder.optimize_for_inference(compile=True)
+
+    codes = random_codes(vocoder, 12)
+    reference_state, compiled_state = {}, {}
+
+    for chunk in codes.split(4, dim=-1):
+        torch.testing.assert_close(
+            compiled.decode_stream(chunk, compiled_state),
+            reference.decode_stream(chunk, reference_state),
+            rtol=1e-4,
+            atol=1e-4,
+        )
+
+    # The batch decode goes through the compiled modules
+    lengths = torch.tensor([codes.size(-1)])
+    torch.testing.assert_close(
+        compiled.decode(codes, lengths)[0],
+        reference.decode(codes, lengths)[0],
+        rtol=1e-4,
+        atol=1e-4,
+    )
@@ -67,7 +67,10 @@ def parse_args():
     )
     parser.add_argument("--normalize", type=bool, default=True)
     parser.add_argument(
-        "--format", type=str, choices=["wav", "mp3", "flac"], default="wav"
+        "--format",
+        type=str,
+        choices=["wav", "pcm", "mp3", "flac", "opus"],
+        default="wav",
     )
     parser.add_argument(
         "--latency",
@@ -1,3 +1,4 @@
+import os
 from threading import Lock
 
 import pyrootutils
@@ -30,6 +31,10 @@ class API(ExceptionHandler):
         self.args = parse_args()
         self.routes = routes
 
+        # Process-wide: the llama and decoder compiled kernels share the inductor cache
+        if self.args.compile_cache_dir is not None:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.args.compile_cache_dir
+
         def api_auth(endpoint):
             async def verify(token: Annotated[str, Depends(bearer_auth)]):
                 if token != self.args.api_key:
@@ -83,6 +88,25 @@ class API(ExceptionHandler):
             llama_checkpoint_path=self.args.llama_checkpoint_path,
             decoder_checkpoint_path=self.args.decoder_checkpoint_path,
             decoder_config_name=self.args.decoder_config_name,
+            max_batch_size=self.args.max_batch_size,
+            prefill_chunk_size=self.args.prefill_chunk_size,
+            prefix_cache_size=self.args.prefix_cache_size,
+            kv_block_size=self.args.kv_block_size,
+            kv_num_blocks=self.args.kv_num_blocks,
+            kv_cache_int8=self.args.kv_cache_int8,
+            semantic_only=self.args.semantic_only,
+            draft_checkpoint_path=self.args.draft_checkpoint_path,
+            num_draft_tokens=self.args.num_draft_tokens,
+            decode_context_frames=self.args.decode_context_frames,
+            vocoder_batch_size=self.args.vocoder_batch_size,
+            vocoder_batch_wait=self.args.vocoder_batch_wait,
+            compile_decoder=self.args.compile_decoder,
+            decoder_backend=self.args.decoder_backend,
+            decoder_onnx_dir=self.args.decoder_onnx_dir,
+            onnx_threads=self.args.onnx_threads,
+            reference_cache_size=self.args.reference_cache_size,
+            reference_cache_dir=self.args.reference_cache_dir,
+            request_timeout=self.args.request_timeout,
         )
 
         logger.info(f"Startup done, listening server at http://{self.args.listen}")
@@ -1,5 +1,7 @@
 import gc
 import queue
+import threading
+import time
 from typing import Generator
 
 import numpy as np
@@ -9,9 +11,11 @@ from loguru import logger
 from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
 from fish_speech.text.chn_text_norm.text import Text as ChnNormedText
 from fish_speech.utils import autocast_exclude_mps, set_seed
+from tools.inference_engine.reference_cache import ReferenceCodeCache
 from tools.inference_engine.reference_loader import ReferenceLoader
 from tools.inference_engine.utils import InferenceResult, wav_chunk_header
-from tools.inference_engine.vq_manager import VQManager
+from tools.inference_engine.vocoder_service import VocoderService
+from tools.inference_engine.vq_manager import OverlapDecodeState, VQManager
 from tools.llama.generate import (
     GenerateRequest,
     GenerateResponse,
@@ -28,22 +32,46 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
         decoder_model: FireflyArchitecture,
         precision: torch.dtype,
         compile: bool,
+        decode_context_frames: int = 0,
+        vocoder_batch_size: int = 1,
+        vocoder_batch_wait: float = 0.005,
+        reference_cache: ReferenceCodeCache | None = None,
+        request_timeout: float = 0,
     ) -> None:
 
-        super().__init__()
+        super().__init__(reference_cache)
 
         self.llama_queue = llama_queue
         self.decoder_model = decoder_model
         self.precision = precision
         self.compile = compile
+        # Frames of the previous chunk decoded again as context, 0 decodes chunks independently
+        self.decode_context_frames = decode_context_frames
+        # Seconds after which the generation of a request is abandoned, 0 disables it
+        self.request_timeout = request_timeout
+
+        # Share the vocoder passes between concurrent requests
+        self.vocoder_service = (
+            VocoderService(
+                decoder_model,
+                precision,
+                max_batch_size=vocoder_batch_size,
+                batch_wait=vocoder_batch_wait,
+            )
+            if vocoder_batch_size > 1
+            else None
+        )
 
     @torch.inference_mode()
-    def inference(self, req: ServeTTSRequest) -> Generator[InferenceResult, None, None]:
+    def inference(
+        self, req: ServeTTSRequest, cancel_event: threading.Event | None = None
+    ) -> Generator[InferenceResult, None, None]:
         """
         Main inference function:
         - Loads the reference audio and text.
         - Calls the LLAMA model for inference.
         - Decodes the VQ tokens to audio.
+        Setting `cancel_event` stops the generation, e.g. when the client disconnects.
         """
 
         ref_id: str | None = req.reference_id
@@ -63,7 +91,9 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
             logger.warning(f"set seed: {req.seed}")
 
         # Get the symbolic tokens from the LLAMA model
-        response_queue = self.send_Llama_request(req, prompt_tokens, prompt_texts)
+        response_queue = self.send_Llama_request(
+            req, prompt_tokens, prompt_texts, cancel_event
+        )
 
         # Get the sample rate from the decoder model
         sample_rate = self.decoder_model.spec_transform.sample_rate
@@ -77,6 +107,13 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
             )
 
         segments = []
+        # Vocoder context of the streamed audio, so that chunks join without seams
+        stream_state = {} if req.streaming else None
+        overlap_state = (
+            OverlapDecodeState()
+            if not req.streaming and self.decode_context_frames > 0
+            else None
+        )
 
         while True:
             # Get the response from the LLAMA model
@@ -101,7 +138,7 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
 
             result: GenerateResponse = wrapped_result.response
             if result.action != "next":
-                segment = self.get_audio_segment(result)
+                segment = self.get_audio_segment(result, stream_state, overlap_state)
 
                 if req.streaming:  # Used only by the API server
                     yield InferenceResult(
@@ -113,6 +150,10 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
             else:
                 break
 
+        # The end of the last chunk was held back for a crossfade
+        if overlap_state is not None and overlap_state.tail is not None:
+            segments.append(overlap_state.tail)
+
         # Clean up the memory
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
@@ -137,7 +178,11 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
         return None
 
     def send_Llama_request(
-        self, req: ServeTTSRequest, prompt_tokens: list, prompt_texts: list
+        self,
+        req: ServeTTSRequest,
+        prompt_tokens: list,
+        prompt_texts: list,
+        cancel_event: threading.Event | None = None,
     ) -> queue.Queue:
         """
         Send a request to the LLAMA model to generate the symbolic tokens.
@@ -161,6 +206,7 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
             max_length=4096,
             prompt_tokens=prompt_tokens,
             prompt_text=prompt_texts,
+            stream_frames=req.stream_frames if req.streaming else 0,
         )
 
         # Create a queue to get the response
@@ -171,14 +217,27 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
             GenerateRequest(
                 request=request,
                 response_queue=response_queue,
+                cancel_event=cancel_event,
+                deadline=(
+                    time.monotonic() + self.request_timeout
+                    if self.request_timeout > 0
+                    else None
+                ),
             )
         )
 
         return response_queue
 
-    def get_audio_segment(self, result: GenerateResponse) -> np.ndarray:
+    def get_audio_segment(
+        self,
+        result: GenerateResponse,
+        stream_state: dict | None = None,
+        overlap_state: OverlapDecodeState | None = None,
+    ) -> np.ndarray:
         """
         Decode the VQ tokens to audio.
+        With `stream_state`, the tokens continue the previously decoded ones.
+        With `overlap_state`, the chunk is decoded with the end of the previous one as context.
         """
 
         # Don't use autocast on MPS devices
@@ -186,7 +245,18 @@ class TTSInferenceEngine(ReferenceLoader, VQManager):
             device_type=self.decoder_model.device.type, dtype=self.precision
         ):
             # Decode the symbolic tokens to audio
-            segment = self.decode_vq_tokens(codes=result.codes)
+            if overlap_state is not None:
+                return self.decode_vq_tokens_overlap(
+                    codes=result.codes,
+                    state=overlap_state,
+                    context_frames=self.decode_context_frames,
+                )
+            elif stream_state is None:
+                segment = self.decode_vq_tokens(codes=result.codes)
+            else:
+                segment = self.decode_vq_tokens_stream(
+                    codes=result.codes, state=stream_state
+                )
 
         # Convert the audio to numpy
         return segment.float().cpu().numpy()
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+from loguru import logger
+
+
+def checkpoint_id(*paths: str | Path) -> str:
+    """
+    Identify a set of checkpoint files without hashing their content, the codes of a
+    reference are only reused with the checkpoints that encoded them.
+    A missing file is part of the identity, so that exporting it later changes the id.
+    """
+
+    keys = []
+    for path in paths:
+        path = Path(path).resolve()
+        if path.exists():
+            stat = path.stat()
+            keys.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+        else:
+            keys.append(f"{path}:missing")
+
+    return hashlib.sha256("|".join(keys).encode()).hexdigest()[:16]
+
+
+class ReferenceCodeCache:
+    """
+    Two-tier cache of the encoded reference audios, keyed by the sha256 of the audio bytes.
+    An in-process LRU of `max_entries` codes sits in front of an optional directory of `.npy`
+    files, which survives restarts and is shared by all the workers using the same directory.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        cache_dir: str | Path | None = None,
+        model_id: str = "default",
+        log_interval: int = 100,
+    ) -> None:
+        self.max_entries = max_entries
+        # The stats are logged every `log_interval` lookups, 0 disables them
+        self.log_interval = log_interval
+        self.model_id = model_id
+        self.cache_dir = Path(cache_dir) / model_id if cache_dir is not None else None
+        self.entries: OrderedDict[str, torch.Tensor] = OrderedDict()
+        # Requests are served from several threads
+        self.lock = threading.Lock()
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(audio: bytes) -> str:
+        return hashlib.sha256(audio).hexdigest()
+
+    def get(self, key: str) -> torch.Tensor | None:
+        codes = self.lookup(key)
+        self.maybe_log_stats()
+        return codes
+
+    def lookup(self, key: str) -> torch.Tensor | None:
+        with self.lock:
+            codes = self.entries.get(key)
+            if codes is not None:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return codes
+
+        path = self.path(key)
+        if path is not None and path.exists():
+            codes = torch.from_numpy(np.load(path))
+            self.remember(key, codes)
+            with self.lock:
+                self.disk_hits += 1
+            return codes
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, codes: torch.Tensor):
+        codes = codes.cpu()
+        self.remember(key, codes)
+
+        path = self.path(key)
+        if path is None or path.exists():
+            return
+
+        # Write then rename, so that other workers never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, codes.numpy())
+        os.replace(tmp_path, path)
+
+    def remember(self, key: str, codes: torch.Tensor):
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = codes
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def path(self, key: str) -> Path | None:
+        if self.cache_dir is None:
+            return None
+
+        return self.cache_dir / f"{key}.npy"
+
+    def maybe_log_stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+
+        if self.log_interval > 0 and lookups % self.log_interval == 0:
+            self.log_stats()
+
+    def log_stats(self):
+        with self.lock:
+            memory_hits, disk_hits, misses = (
+                self.memory_hits,
+                self.disk_hits,
+                self.misses,
+            )
+            num_entries = len(self.entries)
+
+        logger.info(
+            f"Reference cache: {memory_hits} memory hits, {disk_hits} disk hits, "
+            f"{misses} misses, {num_entries}/{self.max_entries} entries"
+        )
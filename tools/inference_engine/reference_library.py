@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import torch
+from loguru import logger
+
+from tools.file import AUDIO_EXTENSIONS, audio_to_bytes, list_files, read_ref_text
+
+
+@dataclass
+class LibraryEntry:
+    codes: list[torch.Tensor]
+    texts: list[str]
+    # (relative path, size, mtime) of the audio and transcript files, to detect changes
+    fingerprint: list[tuple[str, int, int]]
+
+
+class ReferenceLibrary:
+    """
+    Index of the voices of the `references/` folder, encoded once at startup so that
+    selecting a voice by id never runs the VQ encoder on the request path.
+
+    A voice is either a folder `references/<id>/` of audio files with their `.lab`
+    transcripts (the layout of `load_by_id`), or a single `references/<id>.wav` with
+    `references/<id>.lab` next to it (the layout of the Ukrainian WebUI).
+    The index is persisted in the folder and the folder is polled for changes.
+    """
+
+    def __init__(
+        self,
+        root: str | Path,
+        encode: Callable[[bytes], torch.Tensor],
+        model_id: str = "default",
+    ) -> None:
+        self.root = Path(root)
+        self.encode = encode
+        self.index_path = self.root / f".index-{model_id}.pt"
+        self.entries: dict[str, LibraryEntry] = {}
+
+        self.load_index()
+
+    def get(self, id: str) -> LibraryEntry | None:
+        return self.entries.get(id)
+
+    def find_voices(self) -> dict[str, list[Path]]:
+        voices = {}
+        if not self.root.exists():
+            return voices
+
+        for path in sorted(self.root.iterdir()):
+            if path.name.startswith("."):
+                continue
+
+            if path.is_dir():
+                audios = list_files(path, AUDIO_EXTENSIONS, recursive=True)
+                if audios:
+                    voices[path.name] = audios
+            elif path.suffix in AUDIO_EXTENSIONS and path.with_suffix(".lab").exists():
+                voices[path.stem] = [path]
+
+        return voices
+
+    def fingerprint(self, audios: list[Path]) -> list[tuple[str, int, int]]:
+        files = audios + [audio.with_suffix(".lab") for audio in audios]
+        result = []
+        for file in files:
+            stat = file.stat() if file.exists() else None
+            result.append(
+                (
+                    str(file.relative_to(self.root)),
+                    stat.st_size if stat else -1,
+                    stat.st_mtime_ns if stat else -1,
+                )
+            )
+
+        return result
+
+    @torch.inference_mode()
+    def scan(self) -> bool:
+        """
+        Encode the new and modified voices, returns whether the index changed.
+        Runs in inference mode like the requests, which may be using the encoder concurrently.
+        """
+
+        entries = {}
+        changed = False
+
+        for id, audios in self.find_voices().items():
+            fingerprint = self.fingerprint(audios)
+            entry = self.entries.get(id)
+
+            if entry is None or entry.fingerprint != fingerprint:
+                logger.info(f"Encoding reference voice {id} ({len(audios)} files)")
+                entry = LibraryEntry(
+                    codes=[
+                        self.encode(audio_to_bytes(str(audio))).cpu()
+                        for audio in audios
+                    ],
+                    texts=[
+                        read_ref_text(str(audio.with_suffix(".lab")))
+                        for audio in audios
+                    ],
+                    fingerprint=fingerprint,
+                )
+                changed = True
+
+            entries[id] = entry
+
+        changed = changed or entries.keys() != self.entries.keys()
+        # Swap the whole dict, requests may be reading it
+        self.entries = entries
+
+        if changed:
+            self.save_index()
+            logger.info(f"Reference library: {len(entries)} voices in {self.root}")
+
+        return changed
+
+    def load_index(self):
+        if not self.index_path.exists():
+            return
+
+        try:
+            index = torch.load(self.index_path, weights_only=True)
+            self.entries = {
+                id: LibraryEntry(
+                    codes=entry["codes"],
+                    texts=entry["texts"],
+                    fingerprint=[tuple(f) for f in entry["fingerprint"]],
+                )
+                for id, entry in index.items()
+            }
+            logger.info(f"Loaded {len(self.entries)} voices from {self.index_path}")
+        except Exception as e:
+            logger.warning(f"Failed to load the reference index {self.index_path}: {e}")
+
+    def save_index(self):
+        index = {
+            id: {
+                "codes": entry.codes,
+                "texts": entry.texts,
+                "fingerprint": entry.fingerprint,
+            }
+            for id, entry in self.entries.items()
+        }
+
+        # Write then rename, other workers may be loading it
+        tmp_path = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save(index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+
+    def watch(self, interval: float = 5.0):
+        """
+        Rescan the folder every `interval` seconds in a background thread.
+        """
+
+        def worker():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.scan()
+                except Exception as e:
+                    logger.exception(e)
+
+        threading.Thread(target=worker, daemon=True).start()
@@ -1,5 +1,5 @@
 import io
-from hashlib import sha256
+import threading
 from pathlib import Path
 from typing import Callable, Literal, Tuple
 
@@ -9,18 +9,25 @@ from loguru import logger
 
 from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
 from tools.file import AUDIO_EXTENSIONS, audio_to_bytes, list_files, read_ref_text
+from tools.inference_engine.reference_cache import ReferenceCodeCache
+from tools.inference_engine.reference_library import ReferenceLibrary
 from tools.schema import ServeReferenceAudio
 
 
 class ReferenceLoader:
 
-    def __init__(self) -> None:
+    def __init__(self, reference_cache: ReferenceCodeCache | None = None) -> None:
         """
         Component of the TTSInferenceEngine class.
         Loads and manages the cache for the reference audio and text.
         """
         self.ref_by_id: dict = {}
-        self.ref_by_hash: dict = {}
+        # Encoded references by audio content, shared by all the requests
+        self.reference_cache = reference_cache or ReferenceCodeCache()
+        # Voices of the references folder encoded at startup, see `load_reference_library`
+        self.reference_library: ReferenceLibrary | None = None
+        # The library encodes in a background thread, requests and library share the encoder
+        self.encoder_lock = threading.Lock()
 
         # Make Pylance happy (attribut/method not defined...)
         self.decoder_model: FireflyArchitecture
@@ -39,6 +46,12 @@ class ReferenceLoader:
         use_cache: Literal["on", "off"],
     ) -> Tuple:
 
+        # Precompiled voices don't touch the files nor the encoder
+        if self.reference_library is not None:
+            entry = self.reference_library.get(id)
+            if entry is not None:
+                return entry.codes, entry.texts
+
         # Load the references audio and text by id
         ref_folder = Path("references") / id
         ref_folder.mkdir(parents=True, exist_ok=True)
@@ -49,11 +62,7 @@ class ReferenceLoader:
         if use_cache == "off" or id not in self.ref_by_id:
             # If the references are not already loaded, encode them
             prompt_tokens = [
-                self.encode_reference(
-                    # decoder_model=self.decoder_model,
-                    reference_audio=audio_to_bytes(str(ref_audio)),
-                    enable_reference_audio=True,
-                )
+                self.encode_reference_cached(audio_to_bytes(str(ref_audio)))
                 for ref_audio in ref_audios
             ]
             prompt_texts = [
@@ -75,32 +84,44 @@ class ReferenceLoader:
         use_cache: Literal["on", "off"],
     ) -> Tuple:
 
-        # Load the references audio and text by hash
-        audio_hashes = [sha256(ref.audio).hexdigest() for ref in references]
-
-        cache_used = False
-        prompt_tokens, prompt_texts = [], []
-        for i, ref in enumerate(references):
-            if use_cache == "off" or audio_hashes[i] not in self.ref_by_hash:
-                # If the references are not already loaded, encode them
-                prompt_tokens.append(
-                    self.encode_reference(
-                        reference_audio=ref.audio,
-                        enable_reference_audio=True,
-                    )
-                )
-                prompt_texts.append(ref.text)
-                self.ref_by_hash[audio_hashes[i]] = (prompt_tokens, prompt_texts)
+        # The reference cache is keyed by the audio content, so it is used whatever `use_cache` is
+        prompt_tokens = [self.encode_reference_cached(ref.audio) for ref in references]
+        prompt_texts = [ref.text for ref in references]
 
-            else:
-                # Reuse already encoded references
-                prompt_tokens, prompt_texts = self.ref_by_hash[audio_hashes[i]]
-                cache_used = True
+        return prompt_tokens, prompt_texts
 
-        if cache_used:
-            logger.info("Use same references")
+    def load_reference_library(
+        self, root: str | Path = "references", watch_interval: float = 5.0
+    ):
+        """
+        Encode the voices of `root` once and keep the index up to date with the folder.
+        """
 
-        return prompt_tokens, prompt_texts
+        self.reference_library = ReferenceLibrary(
+            root, self.encode_reference_cached, model_id=self.reference_cache.model_id
+        )
+        self.reference_library.scan()
+
+        if watch_interval > 0:
+            self.reference_library.watch(watch_interval)
+
+    def encode_reference_cached(self, audio: bytes):
+        """
+        Encode a reference audio, reusing the codes of a previous request with the same audio.
+        """
+
+        key = self.reference_cache.make_key(audio)
+        prompt_tokens = self.reference_cache.get(key)
+
+        if prompt_tokens is None:
+            with self.encoder_lock, torch.inference_mode():
+                prompt_tokens = self.encode_reference(
+                    reference_audio=audio,
+                    enable_reference_audio=True,
+                )
+            self.reference_cache.put(key, prompt_tokens)
+
+        return prompt_tokens
 
     def load_audio(self, reference_audio, sr):
         """
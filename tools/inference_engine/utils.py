@@ -1,7 +1,10 @@
+import asyncio
+import concurrent.futures
 import io
+import threading
 import wave
 from dataclasses import dataclass
-from typing import Literal, Optional, Tuple
+from typing import AsyncGenerator, Callable, Iterable, Literal, Optional, Tuple
 
 import numpy as np
 
@@ -37,3 +40,56 @@ def wav_chunk_header(
     buffer.close()
 
     return wav_header_bytes
+
+
+async def iterate_in_thread(
+    generator_fn: Callable[..., Iterable], *args, max_buffered: int = 2, **kwargs
+) -> AsyncGenerator:
+    """
+    Run a blocking generator in a worker thread and iterate it from the event loop,
+    so that waiting for the models never blocks the other connections.
+    At most `max_buffered` items are produced ahead of the consumer, a slow client
+    pauses the generator instead of having the whole output buffered.
+    Exceptions raised by the generator are re-raised in the caller.
+    """
+
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        # Block until the consumer makes room, give up once it is gone
+        future = asyncio.run_coroutine_threadsafe(items.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+
+    def worker():
+        try:
+            for item in generator_fn(*args, **kwargs):
+                # The consumer is gone (e.g. the client disconnected)
+                if stop.is_set() or not put((item, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    try:
+        while True:
+            item, error = await items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,164 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+import torch
+import torch.nn.functional as F
+from loguru import logger
+
+from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
+from fish_speech.utils import autocast_exclude_mps
+
+
+@dataclass
+class DecodeRequest:
+    codes: torch.Tensor
+    response_queue: queue.Queue
+    # Vocoder context of a streamed sequence, None decodes the codes on their own
+    state: dict | None = None
+
+
+class VocoderService:
+    """
+    Decodes the code chunks of all the active requests in a single thread, the chunks
+    submitted within `batch_wait` seconds are padded by length bucket and decoded together.
+    Streamed chunks carry their vocoder context, they are batched with the chunks of the
+    same length whose contexts have the same shapes.
+    """
+
+    def __init__(
+        self,
+        decoder_model: FireflyArchitecture,
+        precision: torch.dtype,
+        max_batch_size: int = 8,
+        batch_wait: float = 0.005,
+    ) -> None:
+        self.decoder_model = decoder_model
+        self.precision = precision
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+
+        self.input_queue: queue.Queue[DecodeRequest] = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def decode(self, codes: torch.Tensor, state: dict | None = None) -> torch.Tensor:
+        """
+        Decode `codes` (num_codebooks, length), blocks until the batch it joined is decoded.
+        With `state`, the codes continue a streamed sequence, see `decode_stream`.
+        """
+
+        response_queue = queue.Queue()
+        self.input_queue.put(
+            DecodeRequest(codes=codes, response_queue=response_queue, state=state)
+        )
+
+        audio = response_queue.get()
+        if isinstance(audio, Exception):
+            raise audio
+
+        return audio
+
+    @staticmethod
+    def length_bucket(length: int) -> int:
+        # Power of two buckets bound the padding to 2x and the number of shapes to compile
+        return 1 << max(length - 1, 0).bit_length()
+
+    def batch_key(self, item: DecodeRequest) -> tuple:
+        if item.state is None:
+            return (self.length_bucket(item.codes.size(1)),)
+
+        # Streamed chunks can't be padded, the context of every layer is stacked instead
+        return (
+            item.codes.size(1),
+            tuple((id(module), tuple(x.shape)) for module, x in item.state.items()),
+        )
+
+    def collect(self) -> list[DecodeRequest]:
+        batch = [self.input_queue.get()]
+        deadline = time.perf_counter() + self.batch_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self.input_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+
+            buckets: dict[tuple, list[DecodeRequest]] = defaultdict(list)
+            for item in batch:
+                buckets[self.batch_key(item)].append(item)
+
+            for key, items in buckets.items():
+                try:
+                    if items[0].state is None:
+                        audios = self.decode_batch(
+                            [item.codes for item in items], key[0]
+                        )
+                    else:
+                        audios = self.decode_stream_batch(items)
+                except Exception as e:
+                    logger.exception(e)
+                    audios = [e] * len(items)
+
+                for item, audio in zip(items, audios):
+                    item.response_queue.put(audio)
+
+            if len(batch) > 1:
+                logger.info(
+                    f"Decoded {len(batch)} chunks in {len(buckets)} vocoder batches"
+                )
+
+    @torch.inference_mode()
+    def decode_batch(self, codes: list[torch.Tensor], length: int):
+        feature_lengths = torch.tensor(
+            [c.size(1) for c in codes], device=self.decoder_model.device
+        )
+        padded = torch.stack([F.pad(c, (0, length - c.size(1))) for c in codes]).to(
+            self.decoder_model.device
+        )
+
+        with autocast_exclude_mps(
+            device_type=self.decoder_model.device.type, dtype=self.precision
+        ):
+            audios, audio_lengths = self.decoder_model.decode(
+                indices=padded, feature_lengths=feature_lengths
+            )
+
+        return [
+            audio[0, :audio_length]
+            for audio, audio_length in zip(audios, audio_lengths)
+        ]
+
+    @torch.inference_mode()
+    def decode_stream_batch(self, items: list[DecodeRequest]):
+        # The contexts have the same shapes, stack them along the batch dimension
+        state = {
+            module: torch.cat([item.state[module] for item in items], dim=0)
+            for module in items[0].state
+        }
+        indices = torch.stack([item.codes for item in items]).to(
+            self.decoder_model.device
+        )
+
+        with autocast_exclude_mps(
+            device_type=self.decoder_model.device.type, dtype=self.precision
+        ):
+            audios = self.decoder_model.decode_stream(indices=indices, state=state)
+
+        # Hand every sequence its row of the updated context
+        for i, item in enumerate(items):
+            item.state.clear()
+            item.state.update({module: x[i : i + 1] for module, x in state.items()})
+
+        return [audio[0] for audio in audios]
@@ -1,17 +1,30 @@
+from dataclasses import dataclass
 from typing import Callable
 
+import numpy as np
 import torch
 from loguru import logger
 
 from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
+from tools.inference_engine.vocoder_service import VocoderService
+from tools.vqgan.onnx_model import OnnxFireflyModel
+
+
+@dataclass
+class OverlapDecodeState:
+    # Last codes of the previous chunk, decoded again as left context
+    context: torch.Tensor | None = None
+    # Audio held back to be crossfaded with the next chunk
+    tail: np.ndarray | None = None
 
 
 class VQManager:
 
     def __init__(self):
         # Make Pylance happy (attribut/method not defined...)
-        self.decoder_model: FireflyArchitecture
+        self.decoder_model: FireflyArchitecture | OnnxFireflyModel
         self.load_audio: Callable
+        self.vocoder_service: VocoderService | None
 
     def decode_vq_tokens(self, codes):
         feature_lengths = torch.tensor(
@@ -19,7 +32,11 @@ class VQManager:
         )
         logger.info(f"VQ features: {codes.shape}")
 
-        if isinstance(self.decoder_model, FireflyArchitecture):
+        # Batched with the chunks of the other requests
+        if self.vocoder_service is not None:
+            return self.vocoder_service.decode(codes)
+
+        if isinstance(self.decoder_model, (FireflyArchitecture, OnnxFireflyModel)):
             return self.decoder_model.decode(
                 indices=codes[None],
                 feature_lengths=feature_lengths,
@@ -27,6 +44,65 @@ class VQManager:
 
         raise ValueError(f"Unknown model type: {type(self.decoder_model)}")
 
+    def decode_vq_tokens_stream(self, codes, state: dict):
+        """
+        Decode the next frames of a streamed sequence, `state` carries the vocoder context
+        between calls and must be a fresh dict for every new sequence.
+        """
+
+        if isinstance(self.decoder_model, FireflyArchitecture):
+            # Batched with the streamed chunks of the other requests
+            if self.vocoder_service is not None:
+                return self.vocoder_service.decode(codes, state=state)
+
+            return self.decoder_model.decode_stream(
+                indices=codes[None], state=state
+            ).squeeze()
+
+        # The exported graph has no streaming state, chunks are decoded independently
+        if isinstance(self.decoder_model, OnnxFireflyModel):
+            return self.decode_vq_tokens(codes=codes)
+
+        raise ValueError(f"Unknown model type: {type(self.decoder_model)}")
+
+    def decode_vq_tokens_overlap(
+        self, codes, state: OverlapDecodeState, context_frames: int
+    ) -> np.ndarray:
+        """
+        Decode a chunk of a longer sequence with `context_frames` frames of the previous chunk
+        as left context, the overlap is trimmed and the start of the chunk is crossfaded with
+        the end of the previous one.
+        The end of the chunk is held back in `state.tail` for the crossfade, it must be
+        flushed once the sequence is finished.
+        """
+
+        frame_length = (
+            self.decoder_model.downsample_factor
+            * self.decoder_model.spec_transform.hop_length
+        )
+        crossfade = self.decoder_model.spec_transform.hop_length
+
+        num_context = 0
+        if state.context is not None:
+            num_context = state.context.size(1)
+            codes = torch.cat([state.context, codes], dim=1)
+
+        audio = self.decode_vq_tokens(codes=codes).float().cpu().numpy()
+        start = num_context * frame_length
+
+        if state.tail is not None:
+            fade = len(state.tail)
+            weight = np.linspace(0, 1, fade, dtype=audio.dtype)
+            head = state.tail * (1 - weight) + audio[start - fade : start] * weight
+            audio = np.concatenate([head, audio[start:]], axis=0)
+
+        # The decoder is causal, so the context frames only need to come from the left
+        state.context = codes[:, -context_frames:]
+        fade = min(crossfade, len(audio))
+        state.tail = audio[-fade:]
+
+        return audio[:-fade]
+
     def encode_reference(self, reference_audio, enable_reference_audio):
         if enable_reference_audio and reference_audio is not None:
             # Load audios, and prepare basic info here
@@ -45,7 +121,7 @@ class VQManager:
             )
 
             # VQ Encoder
-            if isinstance(self.decoder_model, FireflyArchitecture):
+            if isinstance(self.decoder_model, (FireflyArchitecture, OnnxFireflyModel)):
                 prompt_tokens = self.decoder_model.encode(audios, audio_lengths)[0][0]
                 logger.info(f"Encoded prompt: {prompt_tokens.shape}")
             else:
@@ -1,6 +1,8 @@
+import click
 import pyrootutils
 import torch
 import torch.nn.functional as F
+from loguru import logger
 from matplotlib import pyplot as plt
 from transformers import AutoTokenizer
 
@@ -112,7 +114,99 @@ def analyze_one_model(loader, config, weight, max_length):
     return xs, ys, smoothed_ys
 
 
-def main():
+@torch.inference_mode()
+def analyze_kv_cache(loader, model, max_length, kv_cache_int8, chunk_size=512):
+    """
+    Loss of the slow transformer on the semantic tokens, computed through the KV cache:
+    the batch is fed `chunk_size` positions at a time, so every position attends to
+    cached keys and values and the precision of the cache shows up in the loss.
+    """
+
+    device = next(model.parameters()).device
+    with torch.device(device):
+        model.setup_caches(
+            max_batch_size=loader.batch_size,
+            max_seq_len=max_length,
+            dtype=next(model.parameters()).dtype,
+            kv_cache_int8=kv_cache_int8,
+        )
+
+    semantic_loss_sum = torch.zeros(max_length, dtype=torch.float32, device=device)
+    counter = torch.zeros(max_length, dtype=torch.long, device=device)
+
+    for current_step, batch in enumerate(loader):
+        inputs = batch["inputs"].to(device)
+        labels = batch["labels"][:, 0].to(device)
+        length = inputs.size(-1)
+
+        logits = []
+        for start in range(0, length, chunk_size):
+            end = min(start + chunk_size, length)
+            # Right padded, the padding never leaks into the earlier positions
+            result = model.forward_generate(
+                inputs[:, :, start:end],
+                torch.arange(start, end, device=device),
+                kv_len=end,
+                return_all=True,
+            )
+            logits.append(result.logits.float())
+
+        logits = torch.cat(logits, dim=1)
+        is_semantic = (labels >= model.tokenizer.semantic_begin_id) & (
+            labels <= model.tokenizer.semantic_end_id
+        )
+        loss = F.cross_entropy(
+            logits.reshape(-1, logits.size(-1)),
+            labels.masked_fill(~is_semantic, -100).reshape(-1),
+            ignore_index=-100,
+            reduction="none",
+        ).reshape(labels.shape)
+
+        semantic_loss_sum[:length] += (loss * is_semantic).sum(0)
+        counter[:length] += is_semantic.sum(0)
+
+        if current_step == 9:
+            break
+
+    xs, ys = [], []
+    for i, (loss, count) in enumerate(zip(semantic_loss_sum.cpu(), counter.cpu())):
+        if count > 0:
+            xs.append(i)
+            ys.append((loss / count).item())
+
+    return xs, ys, smooth(ys, 0.95)
+
+
+def compare_kv_cache(loader, checkpoint_path, max_length):
+    """
+    Compare the semantic token loss of the int8 KV cache with the bf16 one.
+    """
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = load_model(checkpoint_path, device, torch.bfloat16)[0]
+
+    results = {}
+    for name, kv_cache_int8 in (("bf16", False), ("int8", True)):
+        xs, ys, smoothed_ys = analyze_kv_cache(loader, model, max_length, kv_cache_int8)
+        results[name] = ys
+        logger.info(f"{name} KV cache: mean semantic loss {sum(ys) / len(ys):.4f}")
+        plt.plot(xs, smoothed_ys, label=f"{name} KV cache")
+
+    diffs = [abs(a - b) for a, b in zip(results["bf16"], results["int8"])]
+    logger.info(
+        f"int8 vs bf16: mean abs loss difference {sum(diffs) / len(diffs):.2e}, "
+        f"max {max(diffs):.2e}"
+    )
+
+
+@click.command()
+@click.option(
+    "--compare-kv-int8",
+    is_flag=True,
+    help="Compare the int8 KV cache with the bf16 one instead of the checkpoints",
+)
+@click.option("--checkpoint-path", default="checkpoints/fish-speech-1.5")
+def main(compare_kv_int8: bool, checkpoint_path: str):
     tokenizer = AutoTokenizer.from_pretrained("fishaudio/fish-speech-1")
     max_length = 4096
 
@@ -141,6 +235,12 @@ def main():
     plt.grid(which="both", axis="both")
     plt.xlim(0, max_length)
 
+    if compare_kv_int8:
+        compare_kv_cache(loader, checkpoint_path, max_length)
+        plt.legend()
+        plt.savefig("kv_cache_int8.png")
+        return
+
     tests = [
         (
             "pertrain-medium",
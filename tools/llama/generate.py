@@ -5,7 +5,7 @@ import time
 from contextlib import nullcontext
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Literal, Optional, Tuple, Union
+from typing import Callable, Literal, Optional, Tuple, Union
 
 import click
 import hydra
@@ -43,7 +43,9 @@ from fish_speech.models.text2semantic.llama import (
     BaseTransformer,
     DualARTransformer,
     NaiveTransformer,
+    bucket_kv_len,
 )
+from tools.llama.prefix_cache import PrefixCache
 
 
 def multinomial_sample_one_no_sync(
@@ -124,6 +126,39 @@ def logits_to_probs_agent(
     return probs
 
 
+def logits_to_probs_batch(
+    logits,
+    previous_tokens: Optional[torch.Tensor] = None,
+    temperature: torch.Tensor = 1.0,
+    top_p: torch.Tensor = 1.0,
+    repetition_penalty: torch.Tensor = 1.0,
+) -> torch.Tensor:
+    # Same as logits_to_probs_agent, but every sampling parameter is a [B, 1] tensor
+    # so that each sequence of the batch keeps its own settings
+    if previous_tokens is not None:
+        previous_tokens = previous_tokens.long()
+        score = torch.gather(logits, dim=-1, index=previous_tokens)
+        score = torch.where(
+            score < 0, score * repetition_penalty, score / repetition_penalty
+        )
+        logits.scatter_(dim=-1, index=previous_tokens, src=score)
+
+    # Apply top-p sampling
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+    cum_probs = torch.cumsum(torch.nn.functional.softmax(sorted_logits, dim=-1), dim=-1)
+    sorted_indices_to_remove = cum_probs > top_p
+    sorted_indices_to_remove[..., 0] = False  # keep at least one option
+    indices_to_remove = sorted_indices_to_remove.scatter(
+        dim=-1, index=sorted_indices, src=sorted_indices_to_remove
+    )
+    logits = logits.masked_fill(indices_to_remove, -float("Inf"))
+
+    logits = logits / torch.clamp(temperature, min=1e-5)
+
+    probs = torch.nn.functional.softmax(logits, dim=-1)
+    return probs
+
+
 def sample(
     logits,
     previous_tokens: Optional[torch.Tensor] = None,
@@ -148,16 +183,109 @@ def sample_agent(
     return idx_next, probs
 
 
+def sample_batch(
+    logits,
+    previous_tokens: Optional[torch.Tensor] = None,
+    **sampling_kwargs,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    probs = logits_to_probs_batch(
+        logits=logits[:, -1], previous_tokens=previous_tokens, **sampling_kwargs
+    )
+    idx_next = multinomial_sample_one_no_sync_agent(probs)
+    return idx_next, probs
+
+
+class DecodeState:
+    """
+    Buffers and constant index tensors used by every decode step of a model.
+    They are allocated once and reused across steps and requests.
+    """
+
+    def __init__(self, model: BaseTransformer, max_batch_size: int = 1) -> None:
+        device = next(model.parameters()).device
+        num_codebooks = model.config.num_codebooks
+
+        self.max_batch_size = max_batch_size
+        self.semantic_ids = model.semantic_token_ids_tensor
+        # fast_input_pos[i] is the [1] position tensor of codebook i
+        self.fast_input_pos = torch.arange(
+            num_codebooks, device=device, dtype=torch.long
+        ).view(-1, 1)
+        self.previous_tokens = torch.zeros(
+            (max_batch_size, num_codebooks + 1, model.config.max_seq_len),
+            dtype=torch.int,
+            device=device,
+        )
+
+    def reset_previous_tokens(self, win_size: int):
+        # Later columns are always written before they enter the repetition window
+        self.previous_tokens[:, :, :win_size].zero_()
+
+
+def setup_semantic_only(model: BaseTransformer):
+    # TTS only produces semantic tokens and <|im_end|>
+    model.setup_output_subset(
+        model.semantic_token_ids + [model.tokenizer.get_token_id(IM_END_TOKEN)]
+    )
+    logger.info("Restricted the output vocabulary to semantic tokens")
+
+
+def ensure_cache_rows(model: BaseTransformer, batch_size: int):
+    """
+    Grow the KV caches to at least `batch_size` rows, keeping their paging and int8 layout.
+    """
+    if model.max_batch_size >= batch_size:
+        return
+
+    with torch.device(next(model.parameters()).device):
+        model.setup_caches(
+            max_batch_size=batch_size,
+            max_seq_len=model.config.max_seq_len,
+            dtype=next(model.parameters()).dtype,
+            kv_block_size=model.kv_block_size,
+            kv_num_blocks=model.kv_num_blocks,
+            kv_cache_int8=model.kv_cache_int8,
+        )
+
+
+def get_decode_state(model: BaseTransformer, batch_size: int = 1) -> DecodeState:
+    state = getattr(model, "decode_state", None)
+    if state is None or state.max_batch_size < batch_size:
+        state = DecodeState(model, max_batch_size=batch_size)
+        model.decode_state = state
+
+    return state
+
+
+def to_logits_index(model: BaseTransformer, tokens: torch.Tensor) -> torch.Tensor:
+    # Token ids to positions in the logits, they differ when the vocabulary is restricted
+    if model.token_to_subset is None:
+        return tokens
+
+    return model.token_to_subset[tokens.long()]
+
+
+def to_token_id(model: BaseTransformer, idx: torch.Tensor) -> torch.Tensor:
+    # Positions in the logits to token ids
+    if model.output_subset_ids is None:
+        return idx
+
+    return model.output_subset_ids[idx.long()].to(idx.dtype)
+
+
 def decode_one_token_ar_agent(
     model: DualARTransformer,
     x: torch.Tensor,
     input_pos: torch.Tensor,
     semantic_ids: list,
     previous_tokens: torch.Tensor = None,
+    kv_len: Optional[int] = None,
     **sampling_kwargs,
 ) -> torch.Tensor:
+    state = get_decode_state(model)
+
     # print(x, input_pos)
-    x = model.forward_generate(x, input_pos)
+    x = model.forward_generate(x, input_pos, kv_len=kv_len)
     logits = x.logits  # [:, -1:]
     hidden_states = x.hidden_states  # [:, -1:]
 
@@ -174,16 +302,11 @@ def decode_one_token_ar_agent(
         )[0]
     ]
 
-    # Cleanup the cache
-    for layer in model.fast_layers:
-        layer.attention.kv_cache.k_cache.fill_(0)
-        layer.attention.kv_cache.v_cache.fill_(0)
-
+    # The fast cache is not cleared, stale positions are always masked out
     for codebook_idx in range(model.config.num_codebooks):
-        input_pos = torch.tensor(
-            [codebook_idx], device=hidden_states.device, dtype=torch.long
+        logits = model.forward_generate_fast(
+            hidden_states, state.fast_input_pos[codebook_idx]
         )
-        logits = model.forward_generate_fast(hidden_states, input_pos)
         a = sample_agent(
             logits,
             previous_tokens=(
@@ -197,10 +320,9 @@ def decode_one_token_ar_agent(
         codebooks.append(a)
 
     codebooks = torch.stack(codebooks, dim=1)
-    semantic_ids_tensor = torch.tensor(semantic_ids, device=codebooks.device)
     codebooks[:, 1:, :] = torch.masked_fill(
         codebooks[:, 1:, :],
-        ~torch.isin(codebooks[:, :1, :], semantic_ids_tensor),
+        ~torch.isin(codebooks[:, :1, :], state.semantic_ids),
         CODEBOOK_PAD_TOKEN_ID,
     )
 
@@ -213,9 +335,11 @@ def decode_one_token_naive_agent(
     input_pos: torch.Tensor,
     semantic_ids: list,
     previous_tokens: torch.Tensor = None,
+    kv_len: Optional[int] = None,
     **sampling_kwargs,
 ) -> torch.Tensor:
-    x = model.forward_generate(x, input_pos)
+    state = get_decode_state(model)
+    x = model.forward_generate(x, input_pos, kv_len=kv_len)
 
     codebooks = [
         sample(
@@ -237,10 +361,9 @@ def decode_one_token_naive_agent(
         )
 
     codebooks = torch.stack(codebooks, dim=1)
-    semantic_ids_tensor = torch.tensor(semantic_ids, device=codebooks.device)
     codebooks[:, 1:, :] = torch.masked_fill(
         codebooks[:, 1:, :],
-        ~torch.isin(codebooks[:, :1, :], semantic_ids_tensor),
+        ~torch.isin(codebooks[:, :1, :], state.semantic_ids),
         CODEBOOK_PAD_TOKEN_ID,
     )
 
@@ -253,9 +376,11 @@ def decode_one_token_ar(
     input_pos: torch.Tensor,
     semantic_ids: list,
     previous_tokens: torch.Tensor = None,
+    kv_len: Optional[int] = None,
     **sampling_kwargs,
 ) -> torch.Tensor:
-    x = model.forward_generate(x, input_pos)
+    state = get_decode_state(model)
+    x = model.forward_generate(x, input_pos, kv_len=kv_len)
 
     sampling_kwargs_main = sampling_kwargs.copy()
     # sampling_kwargs_main["temperature"] = 0.1
@@ -263,35 +388,33 @@ def decode_one_token_ar(
     # sampling_kwargs_main["repetition_penalty"] = 1.0
 
     codebooks = [
-        sample(
-            x.logits,
-            previous_tokens=(
-                previous_tokens[0] if previous_tokens is not None else None
-            ),  # Disable repetition penalty for the token codebook
-            **sampling_kwargs_main,
-        )[0]
+        to_token_id(
+            model,
+            sample(
+                x.logits,
+                previous_tokens=(
+                    to_logits_index(model, previous_tokens[0])
+                    if previous_tokens is not None
+                    else None
+                ),  # Disable repetition penalty for the token codebook
+                **sampling_kwargs_main,
+            )[0],
+        )
     ]
 
     hidden_states = x.hidden_states
 
-    # Cleanup the cache
-    for layer in model.fast_layers:
-        layer.attention.kv_cache.k_cache.fill_(0)
-        layer.attention.kv_cache.v_cache.fill_(0)
-
-    input_pos = torch.tensor([0], device=hidden_states.device, dtype=torch.long).clone()
-
-    model.forward_generate_fast(hidden_states, input_pos)
+    # The fast cache is not cleared, stale positions are always masked out
+    model.forward_generate_fast(hidden_states, state.fast_input_pos[0])
     a = codebooks[0] - model.tokenizer.semantic_begin_id
     a[a < 0] = 0
     hidden_states = model.fast_embeddings(a)
     codebooks.append(a)
 
     for codebook_idx in range(1, model.config.num_codebooks):
-        input_pos = torch.tensor(
-            [codebook_idx], device=hidden_states.device, dtype=torch.long
+        logits = model.forward_generate_fast(
+            hidden_states, state.fast_input_pos[codebook_idx]
         )
-        logits = model.forward_generate_fast(hidden_states, input_pos)
         a = sample(
             logits,
             previous_tokens=(
@@ -314,14 +437,76 @@ def decode_one_token_ar(
     return codebooks
 
 
+def decode_one_token_ar_batch(
+    model: DualARTransformer,
+    x: torch.Tensor,
+    input_pos: torch.Tensor,
+    previous_tokens: torch.Tensor = None,
+    batch_idx: Optional[torch.Tensor] = None,
+    kv_len: Optional[int] = None,
+    **sampling_kwargs,
+) -> torch.Tensor:
+    """
+    Batched version of decode_one_token_ar.
+    x: [B, num_codebooks + 1, S], input_pos: [S] or [B, S], previous_tokens: [B, num_codebooks + 1, W].
+    Sampling parameters are [B, 1] tensors. Returns [B, num_codebooks + 1, 1].
+    """
+
+    state = get_decode_state(model)
+    x = model.forward_generate(x, input_pos, batch_idx=batch_idx, kv_len=kv_len)
+
+    codebooks = [
+        to_token_id(
+            model,
+            sample_batch(
+                x.logits,
+                previous_tokens=(
+                    to_logits_index(model, previous_tokens[:, 0])
+                    if previous_tokens is not None
+                    else None
+                ),
+                **sampling_kwargs,
+            )[0],
+        )
+    ]
+
+    hidden_states = x.hidden_states
+
+    # The fast cache is not cleared, stale positions are always masked out
+    model.forward_generate_fast(hidden_states, state.fast_input_pos[0])
+    a = codebooks[0] - model.tokenizer.semantic_begin_id
+    a[a < 0] = 0
+    hidden_states = model.fast_embeddings(a)
+    codebooks.append(a)
+
+    for codebook_idx in range(1, model.config.num_codebooks):
+        logits = model.forward_generate_fast(
+            hidden_states, state.fast_input_pos[codebook_idx]
+        )
+        a = sample_batch(
+            logits,
+            previous_tokens=(
+                previous_tokens[:, codebook_idx + 1]
+                if previous_tokens is not None
+                else None
+            ),
+            **sampling_kwargs,
+        )[0]
+        hidden_states = model.fast_embeddings(a)
+        codebooks.append(a)
+
+    return torch.stack(codebooks, dim=1)
+
+
 def decode_one_token_naive(
     model: NaiveTransformer,
     x: torch.Tensor,
     input_pos: torch.Tensor,
     previous_tokens: torch.Tensor = None,
+    kv_len: Optional[int] = None,
     **sampling_kwargs,
 ) -> torch.Tensor:
-    x = model.forward_generate(x, input_pos)
+    x = model.forward_generate(x, input_pos, kv_len=kv_len)
 
     sampling_kwargs_main = sampling_kwargs.copy()
     sampling_kwargs_main["temperature"] = 0.1
@@ -329,11 +514,14 @@ def decode_one_token_naive(
     sampling_kwargs_main["repetition_penalty"] = 1.0
 
     codebooks = [
-        sample(
-            x.logits,
-            previous_tokens=None,  # Disable repetition penalty for the token codebook
-            **sampling_kwargs_main,
-        )[0]
+        to_token_id(
+            model,
+            sample(
+                x.logits,
+                previous_tokens=None,  # Disable repetition penalty for the token codebook
+                **sampling_kwargs_main,
+            )[0],
+        )
     ]
 
     for i in range(model.config.num_codebooks):
@@ -359,15 +547,24 @@ def decode_n_tokens(
     decode_one_token=decode_one_token_naive,
     **sampling_kwargs,
 ):
-    previous_tokens = torch.zeros(
-        (model.config.num_codebooks + 1, model.config.max_seq_len),
-        dtype=torch.int,
-        device=cur_token.device,
-    )
+    """
+    Decode up to `num_new_tokens` tokens, yielding each one ([num_codebooks + 1, 1]) as soon as it is sampled.
+    """
+
+    # We need to get windowed repeat penalty
+    win_size = 16
+    state = get_decode_state(model)
+    state.reset_previous_tokens(win_size)
+    previous_tokens = state.previous_tokens[0]
+
+    start_pos = int(input_pos[0])
+    im_end_id = model.tokenizer.get_token_id(IM_END_TOKEN)
 
     for i in tqdm(range(num_new_tokens)):
-        # We need to get windowed repeat penalty
-        win_size = 16
+        # Paged KV caches allocate blocks as the sequence grows
+        model.reserve_kv(start_pos + i + 1)
+        kv_len = bucket_kv_len(start_pos + i + 1, model.max_seq_len)
+
         if i < win_size:
             window = previous_tokens[:, :win_size]
         else:
@@ -386,6 +583,7 @@ def decode_n_tokens(
                 input_pos=input_pos,
                 previous_tokens=window,
                 semantic_ids=semantic_ids,
+                kv_len=kv_len,
                 **sampling_kwargs,
             )
 
@@ -395,10 +593,41 @@ def decode_n_tokens(
             model.config.num_codebooks + 1, -1
         )
 
-        if cur_token[0, 0, -1] == model.tokenizer.get_token_id(IM_END_TOKEN):
+        yield previous_tokens[:, i : i + 1]
+
+        if cur_token[0, 0, -1] == im_end_id:
             break
 
-    return previous_tokens[:, : i + 1]
+
+def prefill_kv(
+    model: BaseTransformer,
+    prompt: torch.Tensor,
+    start: int,
+    end: int,
+    chunk_size: int = 0,
+    row: int = 0,
+):
+    """
+    Write the KV entries of the prompt positions [start, end) into the cache row `row`,
+    `chunk_size` tokens at a time (all at once if 0), so that the attention scores
+    never exceed chunk_size x kv_len.
+    """
+
+    if chunk_size <= 0:
+        chunk_size = max(end - start, 1)
+
+    codebook_dim = prompt.size(0)
+    batch_idx = torch.tensor([row], device=prompt.device) if row > 0 else None
+
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        model.reserve_kv(chunk_end, row)
+        model.forward_generate(
+            prompt[:, chunk_start:chunk_end].view(1, codebook_dim, -1),
+            torch.arange(chunk_start, chunk_end, device=prompt.device),
+            batch_idx=batch_idx,
+            kv_len=bucket_kv_len(chunk_end, model.max_seq_len),
+        )
 
 
 @torch.no_grad()
@@ -409,18 +638,59 @@ def generate(
     prompt: torch.Tensor,
     max_new_tokens: int,
     decode_one_token=decode_one_token_naive,
+    num_cached_tokens: int = 0,
     **sampling_kwargs,
 ) -> torch.Tensor:
     """
     Takes a conditioning sequence (prompt) as input and continues to generate as many tokens as requested.
+    The first `num_cached_tokens` tokens of the prompt are already in the KV cache and are not prefilled again.
+    """
+
+    stream = generate_stream(
+        model=model,
+        prompt=prompt,
+        max_new_tokens=max_new_tokens,
+        decode_one_token=decode_one_token,
+        num_cached_tokens=num_cached_tokens,
+        **sampling_kwargs,
+    )
+
+    while True:
+        try:
+            next(stream)
+        except StopIteration as e:
+            return e.value
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def generate_stream(
+    *,
+    model: NaiveTransformer,
+    prompt: torch.Tensor,
+    max_new_tokens: int,
+    decode_one_token=decode_one_token_naive,
+    num_cached_tokens: int = 0,
+    draft_model: Optional[DualARTransformer] = None,
+    num_draft_tokens: int = 4,
+    speculative_stats=None,
+    prefill_chunk_size: int = 0,
+    **sampling_kwargs,
+):
+    """
+    Same as generate, but yields every new token ([num_codebooks + 1, 1]) as soon as it is sampled.
+    The whole sequence is the return value of the generator.
+    With `draft_model`, the tokens are decoded speculatively, see tools/llama/speculative.py.
+    With `prefill_chunk_size` > 0, the prompt is prefilled at most that many tokens at a time.
     """
 
     # create an empty tensor of the expected final shape and fill in the current tokens
     T = prompt.size(1)
     # semantic_id = model.tokenizer.convert_tokens_to_ids("<|semantic|>")
-    semantic_ids = [
-        model.tokenizer.get_token_id(f"<|semantic:{i}|>") for i in range(1024)
-    ]
+    semantic_ids = model.semantic_token_ids
+
+    # Allocate the decode buffers outside of any compiled function
+    get_decode_state(model)
 
     if max_new_tokens:
         if T + max_new_tokens > model.config.max_seq_len:
@@ -441,7 +711,16 @@ def generate(
     )
     empty[:, :T] = prompt
     seq = empty
-    input_pos = torch.arange(0, T, device=device)
+
+    assert 0 <= num_cached_tokens < T, "At least one prompt token must be prefilled"
+
+    # Long prompts are prefilled chunk by chunk, the last chunk samples the first token
+    if prefill_chunk_size > 0:
+        prefill_end = max(num_cached_tokens, T - prefill_chunk_size)
+        prefill_kv(model, prompt, num_cached_tokens, prefill_end, prefill_chunk_size)
+        num_cached_tokens = prefill_end
+
+    input_pos = torch.arange(num_cached_tokens, T, device=device)
 
     # Use non-accelerated version for now, to avoid compilation overhead
     prefill_decode = (
@@ -450,30 +729,53 @@ def generate(
         else decode_one_token_ar
     )
 
+    model.reserve_kv(T)
     next_token = prefill_decode(
         model,
-        prompt.view(1, codebook_dim, -1),
+        prompt[:, num_cached_tokens:].view(1, codebook_dim, -1),
         input_pos,
         semantic_ids=semantic_ids,
+        kv_len=bucket_kv_len(T, model.max_seq_len),
         **sampling_kwargs,
     )
     seq[:, T : T + 1] = next_token
+    yield seq[:, T : T + 1]
 
     input_pos = torch.tensor([T], device=device, dtype=torch.int)
-    x = decode_n_tokens(
-        model,
-        next_token.view(1, codebook_dim, -1),
-        input_pos,
-        max_new_tokens - 1,
-        decode_one_token=decode_one_token,
-        semantic_ids=semantic_ids,
-        **sampling_kwargs,
-    )
-    # x = torch.cat(generated_tokens, dim=1)
-    seq = seq[:, : T + 1 + x.size(1)]
-    seq[:, T + 1 :] = x
+    length = T + 1
+
+    if draft_model is not None:
+        from tools.llama.speculative import decode_n_tokens_speculative
+
+        # The draft model keeps no cache between chunks, its prefill is cheap
+        prefill_kv(draft_model, prompt, 0, T, prefill_chunk_size)
+        tokens = decode_n_tokens_speculative(
+            model,
+            draft_model,
+            next_token.view(1, codebook_dim, -1),
+            input_pos,
+            max_new_tokens - 1,
+            num_draft_tokens=num_draft_tokens,
+            stats=speculative_stats,
+            **sampling_kwargs,
+        )
+    else:
+        tokens = decode_n_tokens(
+            model,
+            next_token.view(1, codebook_dim, -1),
+            input_pos,
+            max_new_tokens - 1,
+            decode_one_token=decode_one_token,
+            semantic_ids=semantic_ids,
+            **sampling_kwargs,
+        )
+
+    for token in tokens:
+        seq[:, length : length + 1] = token
+        yield seq[:, length : length + 1]
+        length += 1
 
-    return seq
+    return seq[:, :length]
 
 
 def decode_n_tokens_agent(
@@ -487,23 +789,55 @@ def decode_n_tokens_agent(
     early_stop_threshold: float = 0.6,
     **sampling_kwargs,
 ):
+    """
+    Decode the samples of the batch together. Finished samples are dropped from the batch
+    (cache rows, repetition windows and inputs are compacted), the yielded tokens keep
+    one row per sample and finished samples repeat their last token.
+    """
+
     batch_size = cur_token.size(0)
-    previous_tokens = torch.zeros(
-        (batch_size, model.config.num_codebooks + 1, model.config.max_seq_len),
-        dtype=torch.int,
-        device=cur_token.device,
-    )
+    state = get_decode_state(model, batch_size)
+    state.reset_previous_tokens(16)
+    previous_tokens = state.previous_tokens[:batch_size]
     finished = torch.zeros(batch_size, dtype=torch.bool, device=cur_token.device)
     finished = finished | (cur_token[:, 0, -1] == im_end_id)
     start_time = time.time()
+    start_pos = int(input_pos[0])
+
+    # Sample index of every row of the active batch
+    live = torch.arange(batch_size, device=cur_token.device)
+    output = cur_token.clone()
+    num_tokens = 0
 
     for i in tqdm(range(num_new_tokens), desc="Decoding: ", total=num_new_tokens):
+        keep = ~finished[live]
+        if not keep.all():
+            rows = keep.nonzero().squeeze(-1).tolist()
+            if not rows:
+                break
+
+            # Rows only move towards the front, a source is never overwritten before it is read
+            for dst, src in enumerate(rows):
+                model.move_cache_row(src, dst)
+
+            # The finished rows left at the back give their blocks back
+            for row in range(len(rows), live.size(0)):
+                model.release_cache_row(row)
+
+            previous_tokens[: len(rows)] = previous_tokens[rows]
+            cur_token = cur_token[rows]
+            live = live[rows]
+
+        num_live = live.size(0)
+        for row in range(num_live):
+            model.reserve_kv(start_pos + i + 1, row)
+
         # We need to get windowed repeat penalty
         win_size = 16
         if i < win_size:
-            window = previous_tokens[:, :, :win_size]
+            window = previous_tokens[:num_live, :, :win_size]
         else:
-            window = previous_tokens[:, :, i - win_size : i]
+            window = previous_tokens[:num_live, :, i - win_size : i]
 
         with sdpa_kernel(
             SDPBackend.MATH
@@ -514,18 +848,19 @@ def decode_n_tokens_agent(
                 input_pos=input_pos,
                 previous_tokens=window,
                 semantic_ids=semantic_ids,
+                kv_len=bucket_kv_len(start_pos + i + 1, model.max_seq_len),
                 **sampling_kwargs,
             )
 
         input_pos += 1
-        cur_token = next_token.view(batch_size, model.config.num_codebooks + 1, -1)
-        previous_tokens[:, :, i : i + 1] = next_token.view(
-            batch_size, model.config.num_codebooks + 1, -1
-        )
+        cur_token = next_token.view(num_live, model.config.num_codebooks + 1, -1)
+        previous_tokens[:num_live, :, i : i + 1] = cur_token
+        output[live] = cur_token
+        num_tokens += num_live
 
-        yield cur_token.cpu()
+        yield output.cpu()
 
-        finished = finished | (cur_token[:, 0, -1] == im_end_id)
+        finished[live] = finished[live] | (cur_token[:, 0, -1] == im_end_id)
         if finished.all() or (
             0 < early_stop_threshold < 1
             and finished.sum() >= round(batch_size * early_stop_threshold)
@@ -534,9 +869,10 @@ def decode_n_tokens_agent(
 
     total_time = time.time() - start_time
     generated_tokens = i + 1
-    tokens_per_second = (generated_tokens / total_time) * batch_size
+    tokens_per_second = num_tokens / total_time
     logger.info(
-        f"Decoded {generated_tokens} x {batch_size} tokens in {total_time:.2f}s ({tokens_per_second:.2f} tokens/s)"
+        f"Decoded {generated_tokens} steps, {num_tokens} tokens over {batch_size} samples "
+        f"in {total_time:.2f}s ({tokens_per_second:.2f} tokens/s)"
     )
 
 
@@ -556,11 +892,12 @@ def generate_agent(
 ):
     """
     Takes a conditioning sequence (prompt) as input and continues to generate as many tokens as requested.
+    The prompt is prefilled once and its KV cache is forked into one batch row per sample.
     """
 
     # create an empty tensor of the expected final shape and fill in the current tokens
     T = prompt.size(1)
-    prompt = prompt[None].repeat(num_samples, 1, 1)
+    prompt = prompt[None]
 
     if T >= model.config.max_seq_len:
         raise ValueError(
@@ -580,36 +917,61 @@ def generate_agent(
     device, dtype = prompt.device, prompt.dtype
 
     codebook_dim = 1 + model.config.num_codebooks
-    input_pos = torch.arange(0, T, device=device)
 
-    # Use non-accelerated version for now, to avoid compilation overhead
-    prefill_decode = (
-        decode_one_token_naive_agent
-        if isinstance(model, NaiveTransformer)
-        else decode_one_token_ar_agent
-    )
-    next_token = prefill_decode(
-        model,
-        prompt,
-        input_pos,
-        semantic_ids=semantic_ids,
-        **sampling_kwargs,
-    ).view(num_samples, codebook_dim, -1)
-    yield next_token.cpu()
+    # Every sample needs its own cache row
+    ensure_cache_rows(model, num_samples)
 
-    input_pos = torch.tensor([T], device=device, dtype=torch.int)
+    # Allocate the decode buffers outside of any compiled function
+    get_decode_state(model, num_samples)
 
-    yield from decode_n_tokens_agent(
-        model,
-        next_token,
-        input_pos,
-        max_new_tokens - 1,
-        im_end_id=im_end_id,
-        semantic_ids=semantic_ids,
-        decode_one_token=decode_one_token,
-        early_stop_threshold=early_stop_threshold,
-        **sampling_kwargs,
-    )
+    try:
+        # Prefill all but the last prompt token once, in the first cache row
+        if T > 1:
+            model.reserve_kv(T - 1)
+            model.forward_generate(
+                prompt[:, :, : T - 1],
+                torch.arange(0, T - 1, device=device),
+                kv_len=bucket_kv_len(T - 1, model.max_seq_len),
+            )
+            model.fork_cache_row(0, list(range(1, num_samples)), T - 1)
+
+        for row in range(num_samples):
+            model.reserve_kv(T, row)
+
+        # Use non-accelerated version for now, to avoid compilation overhead
+        prefill_decode = (
+            decode_one_token_naive_agent
+            if isinstance(model, NaiveTransformer)
+            else decode_one_token_ar_agent
+        )
+        # Every sample feeds the last prompt token to draw its own first token
+        next_token = prefill_decode(
+            model,
+            prompt[:, :, T - 1 :].expand(num_samples, -1, -1),
+            torch.tensor([T - 1], device=device),
+            semantic_ids=semantic_ids,
+            kv_len=bucket_kv_len(T, model.max_seq_len),
+            **sampling_kwargs,
+        ).view(num_samples, codebook_dim, -1)
+        yield next_token.cpu()
+
+        input_pos = torch.tensor([T], device=device, dtype=torch.int)
+
+        yield from decode_n_tokens_agent(
+            model,
+            next_token,
+            input_pos,
+            max_new_tokens - 1,
+            im_end_id=im_end_id,
+            semantic_ids=semantic_ids,
+            decode_one_token=decode_one_token,
+            early_stop_threshold=early_stop_threshold,
+            **sampling_kwargs,
+        )
+    finally:
+        # Paged caches: the forked rows give their blocks back, even if the caller stops early
+        for row in range(1, num_samples):
+            model.release_cache_row(row)
 
 
 def encode_tokens(
@@ -684,16 +1046,20 @@ def load_model(checkpoint_path, device, precision, compile=False, is_agent=False
     model = model.to(device)
     # Встановлюємо precision після переміщення на GPU
     model = model.to(dtype=precision)
-    
+
     logger.info(f"Model device: {next(model.parameters()).device}")
     logger.info(f"Model dtype: {next(model.parameters()).dtype}")
     logger.info(f"Restored model from checkpoint")
 
     if isinstance(model, DualARTransformer):
-        decode_one_token = decode_one_token_ar_agent if is_agent else decode_one_token_ar
+        decode_one_token = (
+            decode_one_token_ar_agent if is_agent else decode_one_token_ar
+        )
         logger.info("Using DualARTransformer")
     else:
-        decode_one_token = decode_one_token_naive_agent if is_agent else decode_one_token_naive
+        decode_one_token = (
+            decode_one_token_naive_agent if is_agent else decode_one_token_naive
+        )
         logger.info("Using NaiveTransformer")
 
     if compile:
@@ -715,42 +1081,22 @@ class GenerateResponse:
     text: Optional[str] = None
 
 
-def generate_long(
+def encode_long_prompts(
     *,
     model,
     device: str | torch.device,
-    decode_one_token: callable,
     text: str,
-    num_samples: int = 1,
-    max_new_tokens: int = 0,
-    top_p: int = 0.7,
-    repetition_penalty: float = 1.5,
-    temperature: float = 0.7,
-    compile: bool = False,
     iterative_prompt: bool = True,
-    max_length: int = 2048,
     chunk_length: int = 150,
-    prompt_text: Optional[str | list[str]] = None,
-    prompt_tokens: Optional[torch.Tensor | list[torch.Tensor]] = None,
+    prompt_text: Optional[list[str]] = None,
+    prompt_tokens: Optional[list[torch.Tensor]] = None,
 ):
-    assert 0 < top_p <= 1, "top_p must be in (0, 1]"
-    assert 0 < repetition_penalty < 2, "repetition_penalty must be in (0, 2)"
-    assert 0 < temperature < 2, "temperature must be in (0, 2)"
-
-    use_prompt = prompt_text is not None and prompt_tokens is not None
-    if use_prompt and isinstance(prompt_text, str):
-        prompt_text = [prompt_text]
-        prompt_tokens = [prompt_tokens]
-
-    assert use_prompt is False or len(prompt_text) == len(
-        prompt_tokens
-    ), "Prompt text and tokens must have the same length"
+    """
+    Split the text into chunks and encode the system prompt, the reference prompts and the chunks.
+    Returns the chunk texts, the encoded prompts and the encoded chunks.
+    """
 
-    model_size = sum(p.numel() for p in model.parameters() if p.requires_grad)
     tokenizer = model.tokenizer
-    im_end_id = tokenizer.get_token_id("<|im_end|>")
-
-    encoded = []
     texts = split_text(text, chunk_length) if iterative_prompt else [text]
     encoded_prompts = [
         Conversation(
@@ -769,7 +1115,7 @@ def generate_long(
         .to(device)
     ]
 
-    if use_prompt:
+    if prompt_text is not None and prompt_tokens is not None:
         for idx, (t, c) in enumerate(zip(prompt_text, prompt_tokens)):
             encoded_prompts.append(
                 encode_tokens(
@@ -781,6 +1127,7 @@ def generate_long(
                 )
             )
 
+    encoded = []
     for idx, text in enumerate(texts):
         encoded.append(
             encode_tokens(
@@ -792,6 +1139,392 @@ def generate_long(
         )
         logger.info(f"Encoded text: {text}")
 
+    return texts, encoded_prompts, encoded
+
+
+def select_context(
+    global_encoded: list[torch.Tensor],
+    encoded_prompts: list[torch.Tensor],
+    use_prompt: bool,
+    max_length: int,
+) -> list[torch.Tensor]:
+    """
+    Pick the segments of the conversation that fit in the context window.
+    """
+
+    lengths = reversed([seg.size(1) for seg in global_encoded])
+
+    # Pick last 2000 tokens
+    count = 0
+    for i, length in enumerate(lengths):
+        count += length
+        if count + length > max_length - 1024 - sum(
+            t.shape[1] for t in encoded_prompts
+        ):
+            break
+
+    if i != 0 and i % 2 == 0:
+        i -= 1
+
+    # Rotate the list, always make sure first segment is included to avoid drift
+    if i < len(global_encoded) - 2:
+        partial_encoded = global_encoded[:2] + global_encoded[-i:]
+    else:
+        partial_encoded = global_encoded
+
+    if use_prompt:
+        partial_encoded = encoded_prompts + partial_encoded
+
+    return partial_encoded
+
+
+def reusable_prefix_length(
+    cached_segments: list[torch.Tensor],
+    cached_length: int,
+    partial_encoded: list[torch.Tensor],
+) -> int:
+    """
+    Number of leading tokens of `partial_encoded` that are still valid in the KV cache.
+    The cache holds the first `cached_length` tokens of `cached_segments`, segments are compared by identity
+    since the context is always rebuilt from the same tensors.
+    """
+
+    length = 0
+    for cached, seg in zip(cached_segments, partial_encoded):
+        if cached is not seg:
+            break
+
+        length += seg.size(1)
+
+    # The last token is always prefilled to sample the next one
+    total = sum(seg.size(1) for seg in partial_encoded)
+
+    return min(length, cached_length, total - 1)
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def generate_long_batched(
+    *,
+    model: DualARTransformer,
+    texts: list[str],
+    encoded_prompts: list[torch.Tensor],
+    encoded: list[torch.Tensor],
+    use_prompt: bool,
+    num_samples: int,
+    max_new_tokens: int,
+    max_length: int,
+    temperature: float,
+    top_p: float,
+    repetition_penalty: float,
+    prefix_cache: Optional[PrefixCache] = None,
+    stream_frames: int = 0,
+    should_stop: Optional[Callable[[], bool]] = None,
+    prefill_chunk_size: int = 0,
+    decode_one_token=decode_one_token_ar_batch,
+):
+    """
+    generate_long for several samples at once, sample i lives in the KV cache row i.
+    The first chunk is prefilled once and its cache is forked into the other rows, then the
+    samples of every chunk are decoded as a batch. The responses come in the same order as
+    in generate_long: the first sample is sent (and streamed) as it is decoded, the other
+    samples follow once it is complete.
+    """
+
+    device = next(model.parameters()).device
+    max_seq_len = model.config.max_seq_len
+    im_end_id = model.tokenizer.get_token_id(IM_END_TOKEN)
+    win_size = 16
+
+    ensure_cache_rows(model, num_samples)
+    state = get_decode_state(model, num_samples)
+    previous_tokens = state.previous_tokens[:num_samples]
+
+    def as_tensor(value):
+        return torch.full((num_samples, 1), value, device=device, dtype=torch.float)
+
+    sampling_kwargs = dict(
+        temperature=as_tensor(temperature),
+        top_p=as_tensor(top_p),
+        repetition_penalty=as_tensor(repetition_penalty),
+    )
+
+    global_encoded = [[] for _ in range(num_samples)]
+    cached_segments = [[] for _ in range(num_samples)]
+    cached_length = [0] * num_samples
+    # Responses of the other samples, sent after the first one
+    held_responses = [[] for _ in range(num_samples)]
+
+    # The first chunk is prefilled in row 0 only, so is the cached prefix
+    prefix_key = None
+    if prefix_cache is not None and use_prompt:
+        prefix_key = PrefixCache.make_key(encoded_prompts)
+        prefix_length = sum(t.size(1) for t in encoded_prompts)
+
+        if prefix_cache.restore(model, prefix_key):
+            cached_segments[0] = list(encoded_prompts)
+            cached_length[0] = prefix_length
+
+    try:
+        for seg_idx, seg in enumerate(encoded):
+            if should_stop is not None and should_stop():
+                raise RequestCancelled()
+
+            logger.info(
+                f"Generating sentence {seg_idx + 1}/{len(encoded)} of {num_samples} samples"
+            )
+
+            partial_encoded, prompts = [], []
+            for row in range(num_samples):
+                global_encoded[row].append(seg)
+                partial_encoded.append(
+                    select_context(
+                        global_encoded[row], encoded_prompts, use_prompt, max_length
+                    )
+                )
+                prompts.append(torch.cat(partial_encoded[row], dim=1))
+
+            lengths = [prompt.size(1) for prompt in prompts]
+            if max(lengths) >= max_seq_len:
+                raise ValueError(
+                    f"Input sequence length {max(lengths)} exceeds max_seq_len {max_seq_len}"
+                )
+
+            num_new_tokens = [
+                (
+                    min(max_new_tokens, max_seq_len - T)
+                    if max_new_tokens
+                    else max_seq_len - T
+                )
+                for T in lengths
+            ]
+
+            t0 = time.perf_counter()
+
+            # Prefill all but the last prompt token, the first chunk is the same for every sample
+            rows = [0] if seg_idx == 0 else range(num_samples)
+            for row in rows:
+                num_cached_tokens = reusable_prefix_length(
+                    cached_segments[row], cached_length[row], partial_encoded[row]
+                )
+                prefill_kv(
+                    model,
+                    prompts[row],
+                    num_cached_tokens,
+                    lengths[row] - 1,
+                    prefill_chunk_size,
+                    row=row,
+                )
+
+            if seg_idx == 0:
+                model.fork_cache_row(0, list(range(1, num_samples)), lengths[0] - 1)
+
+            # Every sample feeds its last prompt token to draw its own first token
+            for row in range(num_samples):
+                model.reserve_kv(lengths[row], row)
+
+            cur_tokens = decode_one_token_ar_batch(
+                model,
+                torch.stack([prompt[:, -1:] for prompt in prompts]),
+                torch.tensor([[T - 1] for T in lengths], device=device),
+                kv_len=bucket_kv_len(max(lengths), model.max_seq_len),
+                **sampling_kwargs,
+            )
+
+            generated = [[cur_tokens[row]] for row in range(num_samples)]
+            positions = list(lengths)
+            live = [
+                row
+                for row in range(num_samples)
+                if cur_tokens[row, 0, -1] != im_end_id and num_new_tokens[row] > 1
+            ]
+            state.reset_previous_tokens(win_size)
+            num_streamed = 0
+
+            i = 0
+            while live:
+                if should_stop is not None and should_stop():
+                    raise RequestCancelled()
+
+                idx = torch.tensor(live, device=device)
+                if i < win_size:
+                    window = previous_tokens[idx, :, :win_size]
+                else:
+                    window = previous_tokens[idx, :, i - win_size : i]
+
+                for row in live:
+                    model.reserve_kv(positions[row] + 1, row)
+
+                with sdpa_kernel(SDPBackend.MATH):
+                    next_tokens = decode_one_token(
+                        model,
+                        cur_tokens[idx],
+                        torch.tensor([[positions[row]] for row in live], device=device),
+                        previous_tokens=window,
+                        # The finished samples are left out of the batch
+                        batch_idx=None if live == list(range(len(live))) else idx,
+                        kv_len=bucket_kv_len(
+                            max(positions[row] for row in live) + 1, model.max_seq_len
+                        ),
+                        **{key: value[idx] for key, value in sampling_kwargs.items()},
+                    )
+
+                cur_tokens[idx] = next_tokens
+                previous_tokens[idx, :, i : i + 1] = next_tokens
+                ended = (next_tokens[:, 0, -1] == im_end_id).tolist()
+                i += 1
+
+                still_live = []
+                for j, row in enumerate(live):
+                    generated[row].append(next_tokens[j])
+                    positions[row] += 1
+                    if not ended[j] and len(generated[row]) < num_new_tokens[row]:
+                        still_live.append(row)
+                live = still_live
+
+                # The first generated token is not part of the codes
+                if (
+                    stream_frames > 0
+                    and 0 in live
+                    and len(generated[0]) - 1 - num_streamed >= stream_frames
+                ):
+                    codes = torch.cat(generated[0][1 + num_streamed :], dim=1)[
+                        1:
+                    ].clone()
+                    assert (codes >= 0).all(), f"Negative code found: {codes}"
+                    yield GenerateResponse(
+                        action="sample", codes=codes, text=texts[seg_idx]
+                    )
+                    num_streamed += codes.size(1)
+
+            if seg_idx == 0 and prefix_key is not None:
+                prefix_cache.store(model, prefix_key, prefix_length)
+
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+
+            t = time.perf_counter() - t0
+            tokens_generated = sum(len(tokens) for tokens in generated)
+            logger.info(
+                f"Generated {tokens_generated} tokens over {num_samples} samples in {t:.02f} seconds, "
+                f"{tokens_generated / t:.02f} tokens/sec"
+            )
+
+            for row in range(num_samples):
+                y = torch.cat(generated[row], dim=1)
+                # The <im_end> token is kept for the context, the first token is not a code
+                global_encoded[row].append(y.clone())
+
+                # The last sampled token is never fed to the model, so its KV entry is missing
+                cached_segments[row] = partial_encoded[row] + [global_encoded[row][-1]]
+                cached_length[row] = lengths[row] + y.size(1) - 1
+
+                streamed = num_streamed if row == 0 else 0
+                codes = y[1:, 1 + streamed :].clone()
+                assert (codes >= 0).all(), f"Negative code found: {codes}"
+
+                response = GenerateResponse(
+                    action="sample", codes=codes, text=texts[seg_idx]
+                )
+                if row > 0:
+                    held_responses[row].append(response)
+                elif streamed == 0 or codes.size(1) > 0:
+                    yield response
+    finally:
+        # Only the first row is continued by the next request, the others are released
+        # even when the request is cancelled or fails
+        for row in range(1, num_samples):
+            model.release_cache_row(row)
+
+    # This indicates the end of every sample
+    yield GenerateResponse(action="next")
+    for row in range(1, num_samples):
+        yield from held_responses[row]
+        yield GenerateResponse(action="next")
+
+
+def generate_long(
+    *,
+    model,
+    device: str | torch.device,
+    decode_one_token: callable,
+    text: str,
+    num_samples: int = 1,
+    max_new_tokens: int = 0,
+    top_p: int = 0.7,
+    repetition_penalty: float = 1.5,
+    temperature: float = 0.7,
+    compile: bool = False,
+    iterative_prompt: bool = True,
+    max_length: int = 2048,
+    chunk_length: int = 150,
+    prompt_text: Optional[str | list[str]] = None,
+    prompt_tokens: Optional[torch.Tensor | list[torch.Tensor]] = None,
+    prefix_cache: Optional[PrefixCache] = None,
+    stream_frames: int = 0,
+    should_stop: Optional[Callable[[], bool]] = None,
+    draft_model: Optional[DualARTransformer] = None,
+    num_draft_tokens: int = 4,
+    prefill_chunk_size: int = 0,
+    decode_one_token_batch=decode_one_token_ar_batch,
+):
+    """
+    Generate the codes of `text` chunk by chunk.
+    With `num_samples` > 1, the samples of a DualARTransformer are decoded as a batch with
+    `decode_one_token_batch`, see generate_long_batched.
+    With `stream_frames` > 0, the codes of a chunk are sent every `stream_frames` frames while it is being decoded.
+    `should_stop` is polled between decode steps and chunks, `RequestCancelled` is raised once it returns True.
+    With `draft_model`, `num_draft_tokens` frames are proposed by the draft model and verified at once.
+    With `prefill_chunk_size` > 0, long prompts are prefilled in chunks of that many tokens.
+    """
+
+    assert 0 < top_p <= 1, "top_p must be in (0, 1]"
+    assert 0 < repetition_penalty < 2, "repetition_penalty must be in (0, 2)"
+    assert 0 < temperature < 2, "temperature must be in (0, 2)"
+
+    use_prompt = prompt_text is not None and prompt_tokens is not None
+    if use_prompt and isinstance(prompt_text, str):
+        prompt_text = [prompt_text]
+        prompt_tokens = [prompt_tokens]
+
+    assert use_prompt is False or len(prompt_text) == len(
+        prompt_tokens
+    ), "Prompt text and tokens must have the same length"
+
+    model_size = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+    texts, encoded_prompts, encoded = encode_long_prompts(
+        model=model,
+        device=device,
+        text=text,
+        iterative_prompt=iterative_prompt,
+        chunk_length=chunk_length,
+        prompt_text=prompt_text if use_prompt else None,
+        prompt_tokens=prompt_tokens if use_prompt else None,
+    )
+
+    # Speculative decoding and the naive model decode one sample at a time
+    if num_samples > 1 and isinstance(model, DualARTransformer) and draft_model is None:
+        yield from generate_long_batched(
+            model=model,
+            texts=texts,
+            encoded_prompts=encoded_prompts,
+            encoded=encoded,
+            use_prompt=use_prompt,
+            num_samples=num_samples,
+            max_new_tokens=max_new_tokens,
+            max_length=max_length,
+            temperature=temperature,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            prefix_cache=prefix_cache,
+            stream_frames=stream_frames,
+            should_stop=should_stop,
+            prefill_chunk_size=prefill_chunk_size,
+            decode_one_token=decode_one_token_batch,
+        )
+        return
+
     # Move temperature, top_p, repetition_penalty to device
     # This is important so that changing params doesn't trigger recompile
     temperature = torch.tensor(temperature, device=device, dtype=torch.float)
@@ -800,6 +1533,21 @@ def generate_long(
         repetition_penalty, device=device, dtype=torch.float
     )
 
+    # Segments whose KV entries are kept in the cache between chunks and samples,
+    # only the appended tokens are prefilled unless the context has been rotated
+    cached_segments = []
+    cached_length = 0
+
+    # The system and reference prompts may already be cached by a previous request
+    prefix_key = None
+    if prefix_cache is not None and use_prompt:
+        prefix_key = PrefixCache.make_key(encoded_prompts)
+        prefix_length = sum(t.size(1) for t in encoded_prompts)
+
+        if prefix_cache.restore(model, prefix_key):
+            cached_segments = list(encoded_prompts)
+            cached_length = prefix_length
+
     for sample_idx in range(num_samples):
         if torch.cuda.is_available():
             torch.cuda.synchronize()
@@ -808,6 +1556,9 @@ def generate_long(
         seg_idx = 0
 
         while seg_idx < len(encoded):
+            if should_stop is not None and should_stop():
+                raise RequestCancelled()
+
             logger.info(
                 f"Generating sentence {seg_idx + 1}/{len(encoded)} of sample {sample_idx + 1}/{num_samples}"
             )
@@ -815,46 +1566,79 @@ def generate_long(
             seg = encoded[seg_idx]
             global_encoded.append(seg)
 
-            lengths = reversed([seg.size(1) for seg in global_encoded])
-
-            # Pick last 2000 tokens
-            count = 0
-            for i, length in enumerate(lengths):
-                count += length
-                if count + length > max_length - 1024 - sum(
-                    t.shape[1] for t in encoded_prompts
-                ):
-                    break
-
-            if i != 0 and i % 2 == 0:
-                i -= 1
-
-            # Rotate the list, always make sure first segment is included to avoid drift
-            if i < len(global_encoded) - 2:
-                partial_encoded = global_encoded[:2] + global_encoded[-i:]
-            else:
-                partial_encoded = global_encoded
-
-            if use_prompt:
-                partial_encoded = encoded_prompts + partial_encoded
+            partial_encoded = select_context(
+                global_encoded, encoded_prompts, use_prompt, max_length
+            )
 
             cat_encoded = torch.cat(partial_encoded, dim=1)
             prompt_length = cat_encoded.size(1)
 
+            num_cached_tokens = reusable_prefix_length(
+                cached_segments, cached_length, partial_encoded
+            )
+            logger.info(
+                f"Reusing {num_cached_tokens} cached tokens, prefilling {prompt_length - num_cached_tokens} tokens"
+            )
+
             t0 = time.perf_counter()
-            y = generate(
+            speculative_stats = None
+            if draft_model is not None:
+                from tools.llama.speculative import SpeculativeStats
+
+                speculative_stats = SpeculativeStats()
+
+            stream = generate_stream(
                 model=model,
                 prompt=cat_encoded,
                 max_new_tokens=max_new_tokens,
                 decode_one_token=decode_one_token,
+                num_cached_tokens=num_cached_tokens,
+                draft_model=draft_model,
+                num_draft_tokens=num_draft_tokens,
+                speculative_stats=speculative_stats,
+                prefill_chunk_size=prefill_chunk_size,
                 temperature=temperature,
                 top_p=top_p,
                 repetition_penalty=repetition_penalty,
             )
 
+            # The first generated token is not part of the codes
+            pending = None
+            num_streamed = 0
+            while True:
+                try:
+                    token = next(stream)
+                except StopIteration as e:
+                    y = e.value
+                    break
+
+                if should_stop is not None and should_stop():
+                    stream.close()
+                    raise RequestCancelled()
+
+                if stream_frames <= 0:
+                    continue
+
+                if pending is None:
+                    pending = []
+                    continue
+
+                pending.append(token)
+                if len(pending) >= stream_frames:
+                    codes = torch.cat(pending, dim=1)[1:].clone()
+                    assert (codes >= 0).all(), f"Negative code found: {codes}"
+                    yield GenerateResponse(
+                        action="sample", codes=codes, text=texts[seg_idx]
+                    )
+                    num_streamed += len(pending)
+                    pending = []
+
             if sample_idx == 0 and seg_idx == 0 and compile:
                 logger.info(f"Compilation time: {time.perf_counter() - t0:.2f} seconds")
 
+            if sample_idx == 0 and seg_idx == 0 and prefix_key is not None:
+                prefix_cache.store(model, prefix_key, prefix_length)
+
             if torch.cuda.is_available():
                 torch.cuda.synchronize()
 
@@ -868,6 +1652,8 @@ def generate_long(
             logger.info(
                 f"Bandwidth achieved: {model_size * tokens_sec / 1e9:.02f} GB/s"
             )
+            if speculative_stats is not None:
+                speculative_stats.log()
 
             if torch.cuda.is_available():
                 logger.info(
@@ -876,15 +1662,23 @@ def generate_long(
 
             # Put the generated tokens
             # since there is <im_end>, we remove last token
-            codes = y[1:, prompt_length + 1 :].clone()
+            codes = y[1:, prompt_length + 1 + num_streamed :].clone()
             assert (codes >= 0).all(), f"Negative code found"
 
             decoded = y[:, prompt_length:].clone()
             # But for global encoding, we should keep the <im_end> token
 
             global_encoded.append(decoded)
+
+            # The last sampled token is never fed to the model, so its KV entry is missing
+            cached_segments = partial_encoded + [decoded]
+            cached_length = y.size(1) - 1
+
             assert (codes >= 0).all(), f"Negative code found: {codes}"
-            yield GenerateResponse(action="sample", codes=codes, text=texts[seg_idx])
+            if num_streamed == 0 or codes.size(1) > 0:
+                yield GenerateResponse(
+                    action="sample", codes=codes, text=texts[seg_idx]
+                )
             seg_idx += 1
 
         # This indicates the end of the current sample
@@ -897,10 +1691,25 @@ class WrappedGenerateResponse:
     response: Optional[GenerateResponse | Exception] = None
 
 
+class RequestCancelled(Exception):
+    def __init__(self) -> None:
+        super().__init__("Request cancelled or past its deadline")
+
+
 @dataclass
 class GenerateRequest:
     request: dict
     response_queue: queue.Queue
+    # Set by the server when the client goes away
+    cancel_event: Optional[threading.Event] = None
+    # `time.monotonic()` after which the request is abandoned
+    deadline: Optional[float] = None
+
+    def cancelled(self) -> bool:
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return True
+
+        return self.deadline is not None and time.monotonic() >= self.deadline
 
 
 def launch_thread_safe_queue(
@@ -908,22 +1717,72 @@ def launch_thread_safe_queue(
     device,
     precision,
     compile: bool = False,
+    max_batch_size: int = 1,
+    prefix_cache_size: int = 0,
+    kv_block_size: int = 0,
+    kv_num_blocks: int = 0,
+    kv_cache_int8: bool = False,
+    semantic_only: bool = False,
+    draft_checkpoint_path=None,
+    num_draft_tokens: int = 4,
+    prefill_chunk_size: int = 0,
 ):
     input_queue = queue.Queue()
     init_event = threading.Event()
 
     def worker():
+        # The scheduler compiles its own batched decode function
         model, decode_one_token = load_model(
-            checkpoint_path, device, precision, compile=compile
+            checkpoint_path, device, precision, compile=compile and max_batch_size == 1
         )
         with torch.device(device):
             model.setup_caches(
-                max_batch_size=1,
+                max_batch_size=max_batch_size,
                 max_seq_len=model.config.max_seq_len,
                 dtype=next(model.parameters()).dtype,
+                kv_block_size=kv_block_size,
+                kv_num_blocks=kv_num_blocks,
+                kv_cache_int8=kv_cache_int8,
             )
+
+        if semantic_only:
+            setup_semantic_only(model)
+
+        draft_model = None
+        if draft_checkpoint_path is not None:
+            if max_batch_size > 1:
+                logger.warning(
+                    "Speculative decoding is not supported with continuous batching, "
+                    "the draft model is not used"
+                )
+            else:
+                from tools.llama.speculative import load_draft_model
+
+                draft_model = load_draft_model(
+                    draft_checkpoint_path, model, device, precision, semantic_only
+                )
+
         init_event.set()
 
+        # Budget in MB, shared by all requests of this worker
+        prefix_cache = (
+            PrefixCache(prefix_cache_size * 1024 * 1024) if prefix_cache_size else None
+        )
+
+        if max_batch_size > 1:
+            from tools.llama.scheduler import ContinuousBatchScheduler
+
+            logger.info(f"Continuous batching enabled, max batch size {max_batch_size}")
+            ContinuousBatchScheduler(
+                model,
+                input_queue,
+                max_batch_size,
+                compile=compile,
+                prefix_cache=prefix_cache,
+                prefill_chunk_size=prefill_chunk_size,
+            ).run()
+            return
+
         while True:
             item: GenerateRequest | None = input_queue.get()
             if item is None:
@@ -932,9 +1791,23 @@ def launch_thread_safe_queue(
             kwargs = item.request
             response_queue = item.response_queue
 
+            # Abandoned while waiting in the queue
+            if item.cancelled():
+                response_queue.put(
+                    WrappedGenerateResponse(status="error", response=RequestCancelled())
+                )
+                continue
+
             try:
                 for chunk in generate_long(
-                    model=model, decode_one_token=decode_one_token, **kwargs
+                    model=model,
+                    decode_one_token=decode_one_token,
+                    prefix_cache=prefix_cache,
+                    should_stop=item.cancelled,
+                    draft_model=draft_model,
+                    num_draft_tokens=num_draft_tokens,
+                    prefill_chunk_size=prefill_chunk_size,
+                    **kwargs,
                 ):
                     response_queue.put(
                         WrappedGenerateResponse(status="success", response=chunk)
@@ -1031,6 +1904,15 @@ def launch_thread_safe_queue_agent(
 @click.option("--half/--no-half", default=False)
 @click.option("--iterative-prompt/--no-iterative-prompt", default=True)
 @click.option("--chunk-length", type=int, default=100)
+@click.option("--semantic-only/--no-semantic-only", default=False)
+@click.option("--kv-cache-int8/--no-kv-cache-int8", default=False)
+@click.option(
+    "--draft-checkpoint-path",
+    type=click.Path(path_type=Path, exists=True),
+    default=None,
+    help="Small model of the same family used for speculative decoding",
+)
+@click.option("--num-draft-tokens", type=int, default=4)
 def main(
     text: str,
     prompt_text: Optional[list[str]],
@@ -1047,6 +1929,10 @@ def main(
     half: bool,
     iterative_prompt: bool,
     chunk_length: int,
+    semantic_only: bool,
+    kv_cache_int8: bool,
+    draft_checkpoint_path: Optional[Path],
+    num_draft_tokens: int,
 ) -> None:
 
     precision = torch.half if half else torch.bfloat16
@@ -1066,7 +1952,20 @@ def main(
             max_batch_size=1,
             max_seq_len=model.config.max_seq_len,
             dtype=next(model.parameters()).dtype,
+            kv_cache_int8=kv_cache_int8,
         )
+
+    if semantic_only:
+        setup_semantic_only(model)
+
+    draft_model = None
+    if draft_checkpoint_path is not None:
+        from tools.llama.speculative import load_draft_model
+
+        draft_model = load_draft_model(
+            draft_checkpoint_path, model, device, precision, semantic_only
+        )
+
     if torch.cuda.is_available():
         torch.cuda.synchronize()
 
@@ -1080,6 +1979,15 @@ def main(
     if torch.cuda.is_available():
         torch.cuda.manual_seed(seed)
 
+    # The samples are decoded as a batch, its size varies as they finish
+    decode_one_token_batch = decode_one_token_ar_batch
+    if compile and num_samples > 1:
+        decode_one_token_batch = torch.compile(
+            decode_one_token_ar_batch,
+            dynamic=True,
+            backend="inductor" if torch.cuda.is_available() else "aot_eager",
+        )
+
     generator = generate_long(
         model=model,
         device=device,
@@ -1095,6 +2003,9 @@ def main(
         chunk_length=chunk_length,
         prompt_text=prompt_text,
         prompt_tokens=prompt_tokens,
+        draft_model=draft_model,
+        num_draft_tokens=num_draft_tokens,
+        decode_one_token_batch=decode_one_token_batch,
     )
 
     idx = 0
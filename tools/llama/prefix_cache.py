@@ -0,0 +1,93 @@
+import hashlib
+from collections import OrderedDict
+
+import torch
+from loguru import logger
+
+from fish_speech.models.text2semantic.llama import BaseTransformer
+
+
+class PrefixCache:
+    """
+    LRU cache of the KV entries of prompt prefixes (system prompt + reference text/codes),
+    shared by all requests of a llama worker and bounded by a memory budget in bytes.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries: OrderedDict[str, list[tuple[torch.Tensor, torch.Tensor]]] = (
+            OrderedDict()
+        )
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(segments: list[torch.Tensor]) -> str:
+        """
+        Content hash of the prefix tokens, the KV entries only depend on them.
+        """
+
+        h = hashlib.sha256()
+        for seg in segments:
+            h.update(str(tuple(seg.shape)).encode())
+            h.update(seg.cpu().numpy().tobytes())
+
+        return h.hexdigest()
+
+    @staticmethod
+    def entry_bytes(kv: list[tuple[torch.Tensor, torch.Tensor]]) -> int:
+        return sum(
+            k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv
+        )
+
+    def restore(self, model: BaseTransformer, key: str, row: int = 0) -> int:
+        """
+        Write the cached prefix into batch row `row`, returns the number of restored tokens.
+        """
+
+        kv = self.entries.get(key)
+        if kv is None:
+            self.misses += 1
+            return 0
+
+        self.entries.move_to_end(key)
+        model.restore_kv_prefix(kv, row)
+        self.hits += 1
+
+        length = kv[0][0].size(1)
+        logger.info(
+            f"Prefix cache hit, restored {length} tokens ({self.hits} hits, {self.misses} misses)"
+        )
+
+        return length
+
+    def store(self, model: BaseTransformer, key: str, length: int, row: int = 0):
+        """
+        Snapshot the first `length` positions of batch row `row` under `key`.
+        """
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        kv = model.snapshot_kv_prefix(length, row)
+        size = self.entry_bytes(kv)
+
+        if size > self.max_bytes:
+            logger.warning(
+                f"Prefix of {length} tokens ({size / 1e6:.02f} MB) exceeds the prefix cache budget"
+            )
+            return
+
+        while self.used_bytes + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.used_bytes -= self.entry_bytes(evicted)
+
+        self.entries[key] = kv
+        self.used_bytes += size
+        logger.info(
+            f"Cached prefix of {length} tokens, {len(self.entries)} entries, "
+            f"{self.used_bytes / 1e6:.02f}/{self.max_bytes / 1e6:.02f} MB"
+        )
@@ -0,0 +1,575 @@
+import queue
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from loguru import logger
+
+from fish_speech.models.text2semantic.llama import DualARTransformer, bucket_kv_len
+from fish_speech.tokenizer import IM_END_TOKEN
+from tools.llama.generate import (
+    GenerateRequest,
+    GenerateResponse,
+    RequestCancelled,
+    WrappedGenerateResponse,
+    decode_one_token_ar_batch,
+    encode_long_prompts,
+    get_decode_state,
+    prefill_kv,
+    reusable_prefix_length,
+    select_context,
+)
+from tools.llama.prefix_cache import PrefixCache
+
+# Same window as the repetition penalty in decode_n_tokens
+WINDOW_SIZE = 16
+LOG_INTERVAL = 10.0
+
+
+@dataclass
+class BatchSequence:
+    """
+    State of one request inside the running batch.
+    A request is a list of text chunks, every chunk is prefilled and then decoded
+    until <|im_end|> or until its token budget is exhausted.
+    """
+
+    request: GenerateRequest
+    texts: list[str]
+    encoded_prompts: list[torch.Tensor]
+    encoded: list[torch.Tensor]
+    use_prompt: bool
+    num_samples: int
+    max_new_tokens: int
+    max_length: int
+
+    # Sampling parameters, [1, 1] tensors so that they can be concatenated into the batch
+    temperature: torch.Tensor
+    top_p: torch.Tensor
+    repetition_penalty: torch.Tensor
+
+    sample_idx: int = 0
+    seg_idx: int = 0
+    global_encoded: list[torch.Tensor] = field(default_factory=list)
+
+    # Segments whose KV entries are kept in the cache row of this sequence
+    cached_segments: list[torch.Tensor] = field(default_factory=list)
+    cached_length: int = 0
+    prefix_key: Optional[str] = None
+
+    # Frames per streamed response, 0 sends whole chunks
+    stream_frames: int = 0
+    num_streamed: int = 0
+
+    # State of the current chunk
+    partial_encoded: list[torch.Tensor] = field(default_factory=list)
+    prompt: Optional[torch.Tensor] = None
+    # Next prompt position to prefill, the chunk is decoded once cur_token is set
+    prefill_pos: int = 0
+    prompt_length: int = 0
+    num_new_tokens: int = 0
+    num_steps: int = 0
+    input_pos: int = 0
+    cur_token: Optional[torch.Tensor] = None
+    generated: list[torch.Tensor] = field(default_factory=list)
+    start_time: float = 0.0
+
+    def send(self, response: GenerateResponse | Exception):
+        self.request.response_queue.put(
+            WrappedGenerateResponse(
+                status="error" if isinstance(response, Exception) else "success",
+                response=response,
+            )
+        )
+
+
+class ContinuousBatchScheduler:
+    """
+    Iteration-level scheduler for the llama worker.
+    New requests are admitted into the running batch between decode steps, finished
+    sequences are retired, and every decode step runs the whole batch at once.
+    The active sequence i always occupies the KV cache row i.
+    With `prefill_chunk_size` > 0, long prompts are prefilled one chunk per step,
+    interleaved with the decode steps of the other sequences.
+    """
+
+    def __init__(
+        self,
+        model: DualARTransformer,
+        input_queue: queue.Queue,
+        max_batch_size: int,
+        compile: bool = False,
+        prefix_cache: Optional[PrefixCache] = None,
+        prefill_chunk_size: int = 0,
+    ) -> None:
+        if not isinstance(model, DualARTransformer):
+            raise ValueError("Continuous batching requires a DualARTransformer")
+
+        assert (
+            model.max_batch_size >= max_batch_size
+        ), "Call setup_caches with max_batch_size before starting the scheduler"
+
+        self.model = model
+        self.input_queue = input_queue
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.prefill_chunk_size = prefill_chunk_size
+        self.device = next(model.parameters()).device
+        self.codebook_dim = 1 + model.config.num_codebooks
+        self.im_end_id = model.tokenizer.get_token_id(IM_END_TOKEN)
+
+        # Prefill runs one sequence at a time with a variable length, keep it eager
+        self.prefill_one_token = decode_one_token_ar_batch
+        self.decode_one_token = decode_one_token_ar_batch
+        if compile:
+            logger.info("Compiling batched decode function...")
+            self.decode_one_token = torch.compile(
+                decode_one_token_ar_batch,
+                dynamic=True,
+                backend="inductor" if torch.cuda.is_available() else "aot_eager",
+            )
+
+        # Allocate the decode buffers outside of the compiled function, the decoded
+        # tokens of the sequence in cache row i are kept in row i of previous_tokens
+        self.previous_tokens = get_decode_state(model, max_batch_size).previous_tokens
+
+        self.active: list[BatchSequence] = []
+        self.stopped = False
+
+        self.tokens_since_log = 0
+        self.last_log_time = time.perf_counter()
+
+    @torch.inference_mode()
+    def run(self):
+        while not self.stopped or self.active:
+            self.admit()
+
+            if not self.active:
+                continue
+
+            self.step()
+
+    def admit(self):
+        """
+        Admit queued requests into the free rows of the batch.
+        Blocks only when there is nothing to decode.
+        """
+
+        while not self.stopped and len(self.active) < self.max_batch_size:
+            try:
+                item: GenerateRequest | None = self.input_queue.get(
+                    block=not self.active
+                )
+            except queue.Empty:
+                break
+
+            if item is None:
+                self.stopped = True
+                break
+
+            # Abandoned while waiting in the queue
+            if item.cancelled():
+                item.response_queue.put(
+                    WrappedGenerateResponse(status="error", response=RequestCancelled())
+                )
+                continue
+
+            try:
+                seq = self.create_sequence(item, **item.request)
+            except Exception as e:
+                logger.exception("Failed to create a sequence")
+                item.response_queue.put(
+                    WrappedGenerateResponse(status="error", response=e)
+                )
+                continue
+
+            self.active.append(seq)
+            row = len(self.active) - 1
+
+            if seq.prefix_key is not None and self.prefix_cache.restore(
+                self.model, seq.prefix_key, row
+            ):
+                seq.cached_segments = list(seq.encoded_prompts)
+                seq.cached_length = sum(t.size(1) for t in seq.encoded_prompts)
+
+            if not self.start_chunk(seq, row):
+                self.retire([row])
+
+    def create_sequence(
+        self,
+        request: GenerateRequest,
+        *,
+        device: str | torch.device = None,
+        text: str,
+        num_samples: int = 1,
+        max_new_tokens: int = 0,
+        top_p: float = 0.7,
+        repetition_penalty: float = 1.5,
+        temperature: float = 0.7,
+        compile: bool = False,
+        iterative_prompt: bool = True,
+        max_length: int = 2048,
+        chunk_length: int = 150,
+        prompt_text: Optional[str | list[str]] = None,
+        prompt_tokens: Optional[torch.Tensor | list[torch.Tensor]] = None,
+        stream_frames: int = 0,
+    ) -> BatchSequence:
+        # Same arguments and checks as generate_long
+        assert 0 < top_p <= 1, "top_p must be in (0, 1]"
+        assert 0 < repetition_penalty < 2, "repetition_penalty must be in (0, 2)"
+        assert 0 < temperature < 2, "temperature must be in (0, 2)"
+
+        use_prompt = prompt_text is not None and prompt_tokens is not None
+        if use_prompt and isinstance(prompt_text, str):
+            prompt_text = [prompt_text]
+            prompt_tokens = [prompt_tokens]
+
+        assert use_prompt is False or len(prompt_text) == len(
+            prompt_tokens
+        ), "Prompt text and tokens must have the same length"
+
+        texts, encoded_prompts, encoded = encode_long_prompts(
+            model=self.model,
+            device=self.device,
+            text=text,
+            iterative_prompt=iterative_prompt,
+            chunk_length=chunk_length,
+            prompt_text=prompt_text if use_prompt else None,
+            prompt_tokens=prompt_tokens if use_prompt else None,
+        )
+
+        def as_tensor(value):
+            return torch.tensor([[value]], device=self.device, dtype=torch.float)
+
+        return BatchSequence(
+            request=request,
+            texts=texts,
+            encoded_prompts=encoded_prompts,
+            encoded=encoded,
+            use_prompt=use_prompt,
+            prefix_key=(
+                PrefixCache.make_key(encoded_prompts)
+                if self.prefix_cache is not None and use_prompt
+                else None
+            ),
+            num_samples=num_samples,
+            stream_frames=stream_frames,
+            max_new_tokens=max_new_tokens,
+            max_length=max_length,
+            temperature=as_tensor(temperature),
+            top_p=as_tensor(top_p),
+            repetition_penalty=as_tensor(repetition_penalty),
+        )
+
+    def sampling_kwargs(self, sequences: list[BatchSequence]) -> dict:
+        return dict(
+            temperature=torch.cat([seq.temperature for seq in sequences]),
+            top_p=torch.cat([seq.top_p for seq in sequences]),
+            repetition_penalty=torch.cat([seq.repetition_penalty for seq in sequences]),
+        )
+
+    def start_chunk(self, seq: BatchSequence, row: int) -> bool:
+        """
+        Prefill the next chunk of `seq` into the KV cache row `row`.
+        Returns False if the sequence failed and must be retired.
+        """
+
+        try:
+            seq.global_encoded.append(seq.encoded[seq.seg_idx])
+            partial_encoded = select_context(
+                seq.global_encoded, seq.encoded_prompts, seq.use_prompt, seq.max_length
+            )
+            prompt = torch.cat(partial_encoded, dim=1)
+            T = prompt.size(1)
+            max_seq_len = self.model.config.max_seq_len
+
+            if T >= max_seq_len:
+                raise ValueError(
+                    f"Input sequence length {T} exceeds max_seq_len {max_seq_len}"
+                )
+
+            if seq.max_new_tokens:
+                num_new_tokens = min(seq.max_new_tokens, max_seq_len - T)
+            else:
+                num_new_tokens = max_seq_len - T
+
+            num_cached_tokens = reusable_prefix_length(
+                seq.cached_segments, seq.cached_length, partial_encoded
+            )
+
+            seq.partial_encoded = partial_encoded
+            seq.prompt = prompt
+            seq.prefill_pos = num_cached_tokens
+            seq.prompt_length = T
+            seq.num_new_tokens = num_new_tokens
+            seq.num_steps = 0
+            seq.num_streamed = 0
+            seq.input_pos = T
+            seq.cur_token = None
+            # Later columns are always written before they enter the window
+            self.previous_tokens[row, :, :WINDOW_SIZE].zero_()
+            seq.start_time = time.perf_counter()
+        except Exception as e:
+            logger.exception("Failed to prefill a sequence")
+            seq.send(e)
+            return False
+
+        # Long prompts are left to the decode loop, see prefill_step
+        if 0 < self.prefill_chunk_size < T - num_cached_tokens:
+            return True
+
+        return self.finish_prefill(seq, row)
+
+    def finish_prefill(self, seq: BatchSequence, row: int) -> bool:
+        """
+        Prefill the remaining prompt tokens of `seq` and sample the first token of the chunk.
+        Returns False if the sequence failed or finished and must be retired.
+        """
+
+        try:
+            T = seq.prompt_length
+            self.model.reserve_kv(T, row)
+            next_token = self.prefill_one_token(
+                self.model,
+                seq.prompt[:, seq.prefill_pos :].view(1, self.codebook_dim, -1),
+                torch.arange(seq.prefill_pos, T, device=self.device),
+                batch_idx=torch.tensor([row], device=self.device),
+                kv_len=bucket_kv_len(T, self.model.max_seq_len),
+                **self.sampling_kwargs([seq]),
+            )[0]
+            seq.prefill_pos = T
+            seq.cur_token = next_token
+            seq.generated = [next_token]
+        except Exception as e:
+            logger.exception("Failed to prefill a sequence")
+            seq.send(e)
+            return False
+
+        if seq.num_new_tokens <= 1:
+            return self.finish_chunk(seq, row)
+
+        return True
+
+    def prefill_step(self) -> list[int]:
+        """
+        Prefill one chunk of the first sequence still prefilling its prompt, so that
+        a long prompt only delays the decode steps by one chunk at a time.
+        Returns the rows to retire.
+        """
+
+        for row, seq in enumerate(self.active):
+            if seq.cur_token is not None:
+                continue
+
+            if seq.prompt_length - seq.prefill_pos <= self.prefill_chunk_size:
+                return [] if self.finish_prefill(seq, row) else [row]
+
+            try:
+                end = seq.prefill_pos + self.prefill_chunk_size
+                prefill_kv(self.model, seq.prompt, seq.prefill_pos, end, row=row)
+                seq.prefill_pos = end
+            except Exception as e:
+                logger.exception("Failed to prefill a sequence")
+                seq.send(e)
+                return [row]
+
+            return []
+
+        return []
+
+    def finish_chunk(self, seq: BatchSequence, row: int) -> bool:
+        """
+        Send the codes of the finished chunk and start the next one.
+        Returns False once the request has no chunk left.
+        """
+
+        y = torch.cat(seq.generated, dim=1)
+        t = time.perf_counter() - seq.start_time
+        logger.info(
+            f"Generated {y.size(1)} tokens in {t:.02f} seconds for sentence "
+            f"{seq.seg_idx + 1}/{len(seq.encoded)} of sample {seq.sample_idx + 1}/{seq.num_samples}"
+        )
+
+        # Same layout as generate_long: the first token is dropped from the codes,
+        # the <|im_end|> token is kept in the context
+        codes = y[1:, 1 + seq.num_streamed :].clone()
+        assert (codes >= 0).all(), f"Negative code found: {codes}"
+        seq.global_encoded.append(y.clone())
+
+        # The last sampled token is never fed to the model, so its KV entry is missing
+        seq.cached_segments = seq.partial_encoded + [seq.global_encoded[-1]]
+        seq.cached_length = seq.prompt_length + y.size(1) - 1
+
+        if seq.sample_idx == 0 and seq.seg_idx == 0 and seq.prefix_key is not None:
+            self.prefix_cache.store(
+                self.model,
+                seq.prefix_key,
+                sum(t.size(1) for t in seq.encoded_prompts),
+                row,
+            )
+
+        if seq.num_streamed == 0 or codes.size(1) > 0:
+            seq.send(
+                GenerateResponse(
+                    action="sample", codes=codes, text=seq.texts[seq.seg_idx]
+                )
+            )
+        seq.seg_idx += 1
+
+        if seq.seg_idx >= len(seq.encoded):
+            # This indicates the end of the current sample
+            seq.send(GenerateResponse(action="next"))
+            seq.sample_idx += 1
+            seq.seg_idx = 0
+            seq.global_encoded = []
+
+            if seq.sample_idx >= seq.num_samples:
+                return False
+
+        if seq.request.cancelled():
+            seq.send(RequestCancelled())
+            return False
+
+        return self.start_chunk(seq, row)
+
+    def window(self, seq: BatchSequence, row: int) -> torch.Tensor:
+        # Repetition penalty window of the sequence in cache row `row`
+        start = max(seq.num_steps - WINDOW_SIZE, 0)
+        return self.previous_tokens[row, :, start : start + WINDOW_SIZE]
+
+    def stream_codes(self, seq: BatchSequence):
+        # The first generated token is not part of the codes
+        start = 1 + seq.num_streamed
+        codes = torch.cat(seq.generated[start:], dim=1)[1:].clone()
+        assert (codes >= 0).all(), f"Negative code found: {codes}"
+        seq.send(
+            GenerateResponse(action="sample", codes=codes, text=seq.texts[seq.seg_idx])
+        )
+        seq.num_streamed += codes.size(1)
+
+    def step(self):
+        # Free the rows of the requests whose client is gone or whose deadline has passed
+        cancelled = [
+            row for row, seq in enumerate(self.active) if seq.request.cancelled()
+        ]
+        if cancelled:
+            logger.info(f"Cancelling {len(cancelled)} requests")
+            for row in cancelled:
+                self.active[row].send(RequestCancelled())
+            self.retire(cancelled)
+
+            if not self.active:
+                return
+
+        retired = self.prefill_step()
+
+        # Sequences still prefilling their prompt skip the decode step
+        rows = [
+            row
+            for row, seq in enumerate(self.active)
+            if seq.cur_token is not None and row not in retired
+        ]
+        sequences = [self.active[row] for row in rows]
+        if not sequences:
+            self.retire(retired)
+            return
+
+        # The decoding sequences are usually the first rows of the cache
+        batch_idx = (
+            None
+            if rows == list(range(len(rows)))
+            else torch.tensor(rows, device=self.device)
+        )
+
+        try:
+            x = torch.stack([seq.cur_token for seq in sequences])
+            input_pos = torch.tensor(
+                [[seq.input_pos] for seq in sequences],
+                device=self.device,
+                dtype=torch.long,
+            )
+            windows = torch.stack(
+                [self.window(seq, row) for row, seq in zip(rows, sequences)]
+            )
+
+            for row, seq in zip(rows, sequences):
+                self.model.reserve_kv(seq.input_pos + 1, row)
+
+            with (
+                torch.backends.cuda.sdp_kernel(
+                    enable_flash=False, enable_mem_efficient=False, enable_math=True
+                )
+                if torch.cuda.is_available()
+                else nullcontext()
+            ):
+                next_tokens = self.decode_one_token(
+                    self.model,
+                    x,
+                    input_pos,
+                    previous_tokens=windows,
+                    batch_idx=batch_idx,
+                    kv_len=bucket_kv_len(
+                        max(seq.input_pos for seq in sequences) + 1,
+                        self.model.max_seq_len,
+                    ),
+                    **self.sampling_kwargs(sequences),
+                )
+
+            ended = (next_tokens[:, 0, -1] == self.im_end_id).tolist()
+        except Exception as e:
+            logger.exception("Batched decode step failed")
+            for seq in sequences:
+                seq.send(e)
+            self.retire(retired + rows)
+            return
+
+        for i, (row, seq) in enumerate(zip(rows, sequences)):
+            token = next_tokens[i]
+            self.previous_tokens[row, :, seq.num_steps : seq.num_steps + 1] = token
+            seq.num_steps += 1
+            seq.input_pos += 1
+            seq.cur_token = token
+            seq.generated.append(token)
+
+            if ended[i] or seq.num_steps >= seq.num_new_tokens - 1:
+                if not self.finish_chunk(seq, row):
+                    retired.append(row)
+            elif (
+                seq.stream_frames > 0
+                and len(seq.generated) - 1 - seq.num_streamed >= seq.stream_frames
+            ):
+                self.stream_codes(seq)
+
+        self.retire(retired)
+        self.log_throughput(len(sequences))
+
+    def retire(self, rows: list[int]):
+        # Move the last active sequence into every freed row, from the end of the batch
+        for row in sorted(rows, reverse=True):
+            last = len(self.active) - 1
+            if row != last:
+                self.model.move_cache_row(last, row)
+                self.active[row] = self.active[last]
+
+                # Only the columns the window can still read are carried over
+                length = max(self.active[row].num_steps, WINDOW_SIZE)
+                self.previous_tokens[row, :, :length] = self.previous_tokens[
+                    last, :, :length
+                ]
+            else:
+                self.model.release_cache_row(row)
+
+            self.active.pop()
+
+    def log_throughput(self, batch_size: int):
+        self.tokens_since_log += batch_size
+        elapsed = time.perf_counter() - self.last_log_time
+
+        if elapsed >= LOG_INTERVAL:
+            logger.info(
+                f"Batch size {len(self.active)}, {self.tokens_since_log / elapsed:.02f} tokens/sec"
+            )
+            self.tokens_since_log = 0
+            self.last_log_time = time.perf_counter()
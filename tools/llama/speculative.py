@@ -0,0 +1,342 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+from loguru import logger
+
+from fish_speech.models.text2semantic.llama import DualARTransformer, bucket_kv_len
+from fish_speech.tokenizer import IM_END_TOKEN
+from tools.llama.generate import (
+    get_decode_state,
+    load_model,
+    logits_to_probs,
+    multinomial_sample_one_no_sync,
+    setup_semantic_only,
+    to_logits_index,
+    to_token_id,
+)
+
+# Same window as the repetition penalty in decode_n_tokens
+WINDOW_SIZE = 16
+
+
+@dataclass
+class SpeculativeStats:
+    num_rounds: int = 0
+    # Draft frames proposed and accepted as a whole
+    num_proposed: int = 0
+    num_accepted: int = 0
+    num_tokens: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.num_accepted / max(self.num_proposed, 1)
+
+    @property
+    def tokens_per_round(self) -> float:
+        return self.num_tokens / max(self.num_rounds, 1)
+
+    def log(self):
+        logger.info(
+            f"Draft acceptance rate: {self.acceptance_rate:.2%} "
+            f"({self.num_accepted}/{self.num_proposed}), "
+            f"{self.tokens_per_round:.02f} tokens per target forward"
+        )
+
+
+def check_draft_model(model: DualARTransformer, draft_model: DualARTransformer):
+    if not isinstance(model, DualARTransformer) or not isinstance(
+        draft_model, DualARTransformer
+    ):
+        raise ValueError("Speculative decoding requires two DualARTransformer models")
+
+    for key in ("vocab_size", "num_codebooks", "codebook_size"):
+        if getattr(model.config, key) != getattr(draft_model.config, key):
+            raise ValueError(
+                f"The draft model has a different {key}: "
+                f"{getattr(draft_model.config, key)} != {getattr(model.config, key)}"
+            )
+
+    if model.semantic_token_ids != draft_model.semantic_token_ids:
+        raise ValueError("The draft model uses a different tokenizer")
+
+
+def load_draft_model(
+    checkpoint_path,
+    model: DualARTransformer,
+    device,
+    precision,
+    semantic_only: bool = False,
+) -> DualARTransformer:
+    """
+    Load a small DualARTransformer that shares the tokenizer and codebooks of `model`.
+    Its logits must cover the same tokens, so `semantic_only` must match the target model.
+    """
+
+    draft_model, _ = load_model(checkpoint_path, device, precision)
+    check_draft_model(model, draft_model)
+
+    if draft_model.config.max_seq_len < model.config.max_seq_len:
+        raise ValueError(
+            f"The draft model supports {draft_model.config.max_seq_len} positions, "
+            f"the target model {model.config.max_seq_len}"
+        )
+
+    with torch.device(device):
+        draft_model.setup_caches(
+            max_batch_size=1,
+            max_seq_len=model.config.max_seq_len,
+            dtype=next(draft_model.parameters()).dtype,
+        )
+
+    if semantic_only:
+        setup_semantic_only(draft_model)
+
+    logger.info(f"Loaded draft model from {checkpoint_path}")
+    return draft_model
+
+
+def window_at(previous_tokens: torch.Tensor, i: int) -> torch.Tensor:
+    # Repetition window of step i, the same as in decode_n_tokens: the columns from
+    # step i onwards are still zero there, here they may hold draft tokens
+    if i >= WINDOW_SIZE:
+        return previous_tokens[:, i - WINDOW_SIZE : i]
+
+    window = previous_tokens[:, :WINDOW_SIZE].clone()
+    window[:, i:] = 0
+    return window
+
+
+def speculative_sample(
+    p: torch.Tensor, q: torch.Tensor, idx: torch.Tensor
+) -> tuple[torch.Tensor, bool]:
+    """
+    Keep the draft token `idx` drawn from `q` with probability min(1, p[idx] / q[idx]),
+    otherwise draw from the residual max(p - q, 0). Either way the token follows `p`.
+    """
+
+    idx = idx.long()
+    if bool(torch.rand((), device=p.device) * q[idx] < p[idx]):
+        return idx.to(torch.int), True
+
+    residual = torch.clamp(p - q, min=0)
+    if not bool(residual.sum() > 0):
+        residual = p
+
+    return multinomial_sample_one_no_sync(residual), False
+
+
+def propose_frame(
+    model: DualARTransformer,
+    x: torch.Tensor,
+    input_pos: torch.Tensor,
+    previous_tokens: torch.Tensor,
+    kv_len: int,
+    **sampling_kwargs,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    decode_one_token_ar that also returns the distributions its tokens were drawn from:
+    the frame [num_codebooks + 1, 1], the semantic token probabilities and the
+    [num_codebooks - 1, codebook_size] probabilities of the sampled codebooks.
+    """
+
+    state = get_decode_state(model)
+    x = model.forward_generate(x, input_pos, kv_len=kv_len)
+
+    semantic_probs = logits_to_probs(
+        x.logits[0, -1],
+        previous_tokens=to_logits_index(model, previous_tokens[0]),
+        **sampling_kwargs,
+    )
+    codebooks = [to_token_id(model, multinomial_sample_one_no_sync(semantic_probs))]
+
+    model.forward_generate_fast(x.hidden_states, state.fast_input_pos[0])
+    a = codebooks[0] - model.tokenizer.semantic_begin_id
+    a[a < 0] = 0
+    hidden_states = model.fast_embeddings(a)
+    codebooks.append(a)
+
+    codebook_probs = []
+    for codebook_idx in range(1, model.config.num_codebooks):
+        logits = model.forward_generate_fast(
+            hidden_states, state.fast_input_pos[codebook_idx]
+        )
+        probs = logits_to_probs(
+            logits[0, -1],
+            previous_tokens=previous_tokens[codebook_idx + 1],
+            **sampling_kwargs,
+        )
+        a = multinomial_sample_one_no_sync(probs)
+        hidden_states = model.fast_embeddings(a)
+        codebooks.append(a)
+        codebook_probs.append(probs)
+
+    return (
+        torch.stack(codebooks, dim=0),
+        semantic_probs,
+        torch.stack(codebook_probs, dim=0),
+    )
+
+
+def verify_frame(
+    model: DualARTransformer,
+    logits: torch.Tensor,
+    hidden_states: torch.Tensor,
+    previous_tokens: torch.Tensor,
+    draft: Optional[tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None,
+    **sampling_kwargs,
+) -> tuple[torch.Tensor, bool]:
+    """
+    Sample a frame of the target model from its slow logits and hidden state at one position.
+    The tokens of the `draft` frame are kept while they pass the rejection test, the first
+    rejected token is drawn from the residual and the rest of the frame from the target model.
+    Returns the frame and whether the whole draft frame was accepted.
+    """
+
+    state = get_decode_state(model)
+    accepted = draft is not None
+
+    probs = logits_to_probs(
+        logits,
+        previous_tokens=to_logits_index(model, previous_tokens[0]),
+        **sampling_kwargs,
+    )
+    if accepted:
+        draft_frame, draft_semantic_probs, draft_codebook_probs = draft
+        idx, accepted = speculative_sample(
+            probs, draft_semantic_probs, to_logits_index(model, draft_frame[0])
+        )
+    else:
+        idx = multinomial_sample_one_no_sync(probs)
+    codebooks = [to_token_id(model, idx)]
+
+    model.forward_generate_fast(hidden_states, state.fast_input_pos[0])
+    a = codebooks[0] - model.tokenizer.semantic_begin_id
+    a[a < 0] = 0
+    hidden_states = model.fast_embeddings(a)
+    codebooks.append(a)
+
+    for codebook_idx in range(1, model.config.num_codebooks):
+        logits = model.forward_generate_fast(
+            hidden_states, state.fast_input_pos[codebook_idx]
+        )
+        probs = logits_to_probs(
+            logits[0, -1],
+            previous_tokens=previous_tokens[codebook_idx + 1],
+            **sampling_kwargs,
+        )
+        if accepted:
+            a, accepted = speculative_sample(
+                probs,
+                draft_codebook_probs[codebook_idx - 1],
+                draft_frame[codebook_idx + 1],
+            )
+        else:
+            a = multinomial_sample_one_no_sync(probs)
+        hidden_states = model.fast_embeddings(a)
+        codebooks.append(a)
+
+    return torch.stack(codebooks, dim=0), accepted
+
+
+def decode_n_tokens_speculative(
+    model: DualARTransformer,
+    draft_model: DualARTransformer,
+    cur_token: torch.Tensor,
+    input_pos: torch.Tensor,
+    num_new_tokens: int,
+    num_draft_tokens: int = 4,
+    stats: Optional[SpeculativeStats] = None,
+    **sampling_kwargs,
+):
+    """
+    Same as decode_n_tokens, but the draft model proposes `num_draft_tokens` frames that the
+    target model checks in a single forward pass, then rejection sampling keeps the frames
+    of the target distribution. Every frame is read as the token sequence semantic token,
+    codebooks, so the output has exactly the distribution of the target model.
+    The KV cache of the draft model must hold the prompt up to `cur_token` (excluded).
+    """
+
+    state = get_decode_state(model)
+    state.reset_previous_tokens(WINDOW_SIZE)
+    # Column i holds the token sampled at step i, as in decode_n_tokens
+    previous_tokens = state.previous_tokens[0]
+    get_decode_state(draft_model)
+
+    device = cur_token.device
+    codebook_dim = model.config.num_codebooks + 1
+    im_end_id = model.tokenizer.get_token_id(IM_END_TOKEN)
+    stats = stats if stats is not None else SpeculativeStats()
+
+    # Position of cur_token, the last sampled token
+    start_pos = int(input_pos[0])
+    cur_token = cur_token.view(codebook_dim, 1)
+    # Tokens that are not in the draft KV cache yet, and the position of the first one
+    draft_input = cur_token
+    draft_pos = start_pos
+
+    n = 0
+    while n < num_new_tokens:
+        pos = start_pos + n
+        k = min(num_draft_tokens, num_new_tokens - n)
+
+        # The draft model proposes k frames, one token at a time
+        proposals = []
+        for i in range(k):
+            draft_model.reserve_kv(pos + i + 1)
+            frame, semantic_probs, codebook_probs = propose_frame(
+                draft_model,
+                draft_input.view(1, codebook_dim, -1),
+                torch.arange(draft_pos, pos + i + 1, device=device),
+                previous_tokens=window_at(previous_tokens, n + i),
+                kv_len=bucket_kv_len(pos + i + 1, draft_model.max_seq_len),
+                **sampling_kwargs,
+            )
+            previous_tokens[:, n + i : n + i + 1] = frame
+            proposals.append((frame, semantic_probs, codebook_probs))
+            draft_input = frame
+            draft_pos = pos + i + 1
+
+        # The target model scores cur_token and the k proposals at once
+        model.reserve_kv(pos + k + 1)
+        x = model.forward_generate(
+            torch.cat([cur_token] + [p[0] for p in proposals], dim=1).view(
+                1, codebook_dim, -1
+            ),
+            torch.arange(pos, pos + k + 1, device=device),
+            kv_len=bucket_kv_len(pos + k + 1, model.max_seq_len),
+            return_all=True,
+        )
+
+        num_accepted = 0
+        for i in range(k + 1):
+            frame, accepted = verify_frame(
+                model,
+                x.logits[0, i],
+                x.hidden_states[:, i : i + 1],
+                previous_tokens=window_at(previous_tokens, n),
+                draft=proposals[i] if i < k else None,
+                **sampling_kwargs,
+            )
+            previous_tokens[:, n : n + 1] = frame
+            n += 1
+            stats.num_tokens += 1
+
+            yield previous_tokens[:, n - 1 : n]
+
+            if frame[0, -1] == im_end_id or n >= num_new_tokens or not accepted:
+                break
+
+            num_accepted += 1
+
+        stats.num_rounds += 1
+        stats.num_proposed += k
+        stats.num_accepted += num_accepted
+
+        if frame[0, -1] == im_end_id:
+            break
+
+        # The draft KV cache is valid up to the last accepted proposal it was fed
+        cur_token = frame
+        draft_pos = min(draft_pos, pos + num_accepted + 1)
+        draft_input = previous_tokens[:, draft_pos - start_pos - 1 : n]
@@ -34,6 +34,7 @@ def parse_args():
     parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--half", action="store_true")
     parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--decode-context-frames", type=int, default=0)
     parser.add_argument("--max-gradio-length", type=int, default=0)
     parser.add_argument("--theme", type=str, default="light")
 
@@ -66,6 +67,7 @@ if __name__ == "__main__":
         config_name=args.decoder_config_name,
         checkpoint_path=args.decoder_checkpoint_path,
         device=args.device,
+        optimize=True,
     )
 
     logger.info("Decoder model loaded, warming up...")
@@ -76,6 +78,7 @@ if __name__ == "__main__":
         decoder_model=decoder_model,
         compile=args.compile,
         precision=args.precision,
+        decode_context_frames=args.decode_context_frames,
     )
 
     # Dry run to check if the model is loaded correctly and avoid the first-time latency
@@ -9,6 +9,7 @@ from loguru import logger
 pyrootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
 
 from tools.inference_engine import TTSInferenceEngine
+from tools.inference_engine.reference_cache import ReferenceCodeCache, checkpoint_id
 from tools.llama.generate import launch_thread_safe_queue
 from tools.schema import ServeTTSRequest
 from tools.vqgan.inference import load_model as load_decoder_model
@@ -85,6 +86,7 @@ if __name__ == "__main__":
         config_name=args.decoder_config_name,
         checkpoint_path=args.decoder_checkpoint_path,
         device=args.device,
+        optimize=True,
     )
 
     logger.info("Decoder model loaded, warming up...")
@@ -94,8 +96,15 @@ if __name__ == "__main__":
         decoder_model=decoder_model,
         compile=args.compile,
         precision=args.precision,
+        # The voice index is only valid for the decoder that encoded it
+        reference_cache=ReferenceCodeCache(
+            model_id=checkpoint_id(args.decoder_checkpoint_path)
+        ),
     )
 
+    # Encode the reference voices once, requests then select them by id
+    inference_engine.load_reference_library(references_dir)
+
     # Додамо перевірку, де знаходиться модель
     logger.info(f"Checking model device - Decoder: {next(decoder_model.parameters()).device}")
 
@@ -161,8 +161,8 @@ class ServeReferenceAudio(BaseModel):
 class ServeTTSRequest(BaseModel):
     text: str
     chunk_length: Annotated[int, conint(ge=100, le=300, strict=True)] = 200
-    # Audio format
-    format: Literal["wav", "pcm", "mp3"] = "wav"
+    # Audio format, opus is sent in an Ogg container
+    format: Literal["wav", "pcm", "mp3", "flac", "opus"] = "wav"
     # References audios for in-context learning
     references: list[ServeReferenceAudio] = []
     # Reference id
@@ -175,6 +175,8 @@ class ServeTTSRequest(BaseModel):
     normalize: bool = True
     # not usually used below
     streaming: bool = False
+    # When streaming, send audio every N frames instead of every text chunk, 0 disables it
+    stream_frames: Annotated[int, conint(ge=0, strict=True)] = 0
     max_new_tokens: int = 1024
     top_p: Annotated[float, Field(ge=0.1, le=1.0, strict=True)] = 0.7
     repetition_penalty: Annotated[float, Field(ge=0.9, le=2.0, strict=True)] = 1.2
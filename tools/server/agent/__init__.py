@@ -3,6 +3,7 @@ from functools import partial
 
 import ormsgpack
 
+from tools.inference_engine.utils import iterate_in_thread
 from tools.server.agent.generate import generate_responses
 from tools.server.agent.pre_generation_utils import prepare_messages
 
@@ -33,8 +34,10 @@ async def streaming_generator(req, llama_queue, tokenizer, config, device, json_
     Streaming response wrapper for the chat endpoint.
     Returns the response in chunks.
     """
-    generator = execute_request(llama_queue, tokenizer, config, req, device)
-    for i in generator:
+    generator = iterate_in_thread(
+        execute_request, llama_queue, tokenizer, config, req, device
+    )
+    async for i in generator:
         if json_mode:
             body = i.model_dump_json().encode("utf-8")
             yield b"data: " + body + b"\n\n"
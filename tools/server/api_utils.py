@@ -1,3 +1,4 @@
+import threading
 from argparse import ArgumentParser
 from http import HTTPStatus
 from typing import Annotated, Any
@@ -7,8 +8,10 @@ from baize.datastructures import ContentType
 from kui.asgi import HTTPException, HttpRequest
 
 from tools.inference_engine import TTSInferenceEngine
+from tools.inference_engine.utils import iterate_in_thread
 from tools.schema import ServeTTSRequest
 from tools.server.inference import inference_wrapper as inference
+from tools.server.stream_encoders import get_stream_encoder
 
 
 def parse_args():
@@ -26,9 +29,44 @@ def parse_args():
         default="checkpoints/fish-speech-1.5/firefly-gan-vq-fsq-8x1024-21hz-generator.pth",
     )
     parser.add_argument("--decoder-config-name", type=str, default="firefly_gan_vq")
+    # The onnx backend runs the graphs of tools/vqgan/export_onnx.py on CPU
+    parser.add_argument(
+        "--decoder-backend", type=str, choices=["torch", "onnx"], default="torch"
+    )
+    parser.add_argument(
+        "--decoder-onnx-dir", type=str, default="checkpoints/fish-speech-1.5/onnx"
+    )
+    parser.add_argument("--onnx-threads", type=int, default=0)
     parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--half", action="store_true")
     parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--compile-decoder", action="store_true")
+    # On-disk cache of the compiled kernels, shared by all the compiled models
+    parser.add_argument("--compile-cache-dir", type=str, default=None)
+    parser.add_argument("--max-batch-size", type=int, default=1)
+    # Prefill long prompts this many tokens at a time, 0 prefills them at once
+    parser.add_argument("--prefill-chunk-size", type=int, default=0)
+    # Memory budget of the reference prompt KV cache in MB, 0 disables it
+    parser.add_argument("--prefix-cache-size", type=int, default=0)
+    # Paged KV cache, 0 keeps the dense cache
+    parser.add_argument("--kv-block-size", type=int, default=0)
+    parser.add_argument("--kv-num-blocks", type=int, default=0)
+    # Store the KV cache as int8 with per head and token scales
+    parser.add_argument("--kv-cache-int8", action="store_true")
+    parser.add_argument("--semantic-only", action="store_true")
+    # Small model proposing --num-draft-tokens frames for speculative decoding
+    parser.add_argument("--draft-checkpoint-path", type=str, default=None)
+    parser.add_argument("--num-draft-tokens", type=int, default=4)
+    # Frames of left context when decoding chunks, 0 decodes them independently
+    parser.add_argument("--decode-context-frames", type=int, default=0)
+    # Decode the chunks of concurrent requests together, waiting up to --vocoder-batch-wait ms
+    parser.add_argument("--vocoder-batch-size", type=int, default=1)
+    parser.add_argument("--vocoder-batch-wait", type=float, default=5)
+    # Encoded reference audios kept in memory, and the directory shared by the workers
+    parser.add_argument("--reference-cache-size", type=int, default=256)
+    parser.add_argument("--reference-cache-dir", type=str, default=None)
+    # Seconds after which a TTS request is abandoned, 0 disables it
+    parser.add_argument("--request-timeout", type=float, default=0)
     parser.add_argument("--max-text-length", type=int, default=0)
     parser.add_argument("--listen", type=str, default="127.0.0.1:8080")
     parser.add_argument("--workers", type=int, default=1)
@@ -56,9 +94,22 @@ class MsgPackRequest(HttpRequest):
 
 
 async def inference_async(req: ServeTTSRequest, engine: TTSInferenceEngine):
-    for chunk in inference(req, engine):
-        if isinstance(chunk, bytes):
-            yield chunk
+    encoder = get_stream_encoder(
+        req.format, engine.decoder_model.spec_transform.sample_rate
+    )
+
+    # Stops the generation when the response is abandoned, e.g. the client disconnected
+    cancel_event = threading.Event()
+
+    # The engine blocks on the model queues, keep it off the event loop
+    try:
+        async for chunk in iterate_in_thread(
+            inference, req, engine, encoder, cancel_event
+        ):
+            if isinstance(chunk, bytes) and len(chunk) > 0:
+                yield chunk
+    finally:
+        cancel_event.set()
 
 
 async def buffer_to_async_generator(buffer):
@@ -72,5 +123,7 @@ def get_content_type(audio_format):
         return "audio/flac"
     elif audio_format == "mp3":
         return "audio/mpeg"
+    elif audio_format == "opus":
+        return "audio/ogg"
     else:
         return "application/octet-stream"
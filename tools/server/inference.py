@@ -1,3 +1,4 @@
+import threading
 from http import HTTPStatus
 
 import numpy as np
@@ -5,20 +6,30 @@ from kui.asgi import HTTPException
 
 from tools.inference_engine import TTSInferenceEngine
 from tools.schema import ServeTTSRequest
+from tools.server.stream_encoders import StreamEncoder
 
 AMPLITUDE = 32768  # Needs an explaination
 
 
-def inference_wrapper(req: ServeTTSRequest, engine: TTSInferenceEngine):
+def inference_wrapper(
+    req: ServeTTSRequest,
+    engine: TTSInferenceEngine,
+    encoder: StreamEncoder | None = None,
+    cancel_event: threading.Event | None = None,
+):
     """
     Wrapper for the inference function.
     Used in the API server.
+    With `encoder`, the streamed segments are encoded as they come and the final audio is not sent.
+    Setting `cancel_event` stops the generation once the client is gone.
     """
     count = 0
-    for result in engine.inference(req):
+    for result in engine.inference(req, cancel_event):
         match result.code:
             case "header":
-                if isinstance(result.audio, tuple):
+                if encoder is not None:
+                    yield encoder.start()
+                elif isinstance(result.audio, tuple):
                     yield result.audio[1]
 
             case "error":
@@ -29,12 +40,16 @@ def inference_wrapper(req: ServeTTSRequest, engine: TTSInferenceEngine):
 
             case "segment":
                 count += 1
-                if isinstance(result.audio, tuple):
+                if encoder is not None:
+                    yield encoder.encode(result.audio[1])
+                elif isinstance(result.audio, tuple):
                     yield (result.audio[1] * AMPLITUDE).astype(np.int16).tobytes()
 
             case "final":
                 count += 1
-                if isinstance(result.audio, tuple):
+                if encoder is not None:
+                    yield encoder.finish()
+                elif isinstance(result.audio, tuple):
                     yield result.audio[1]
                 return None  # Stop the generator
 
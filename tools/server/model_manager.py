@@ -1,8 +1,11 @@
+from pathlib import Path
+
 import torch
 from funasr import AutoModel
 from loguru import logger
 
 from tools.inference_engine import TTSInferenceEngine
+from tools.inference_engine.reference_cache import ReferenceCodeCache, checkpoint_id
 from tools.llama.generate import (
     launch_thread_safe_queue,
     launch_thread_safe_queue_agent,
@@ -10,6 +13,7 @@ from tools.llama.generate import (
 from tools.schema import ServeTTSRequest
 from tools.server.inference import inference_wrapper as inference
 from tools.vqgan.inference import load_model as load_decoder_model
+from tools.vqgan.onnx_model import OnnxFireflyModel
 
 ASR_MODEL_NAME = "iic/SenseVoiceSmall"
 
@@ -25,12 +29,50 @@ class ModelManager:
         llama_checkpoint_path: str,
         decoder_checkpoint_path: str,
         decoder_config_name: str,
+        max_batch_size: int = 1,
+        prefill_chunk_size: int = 0,
+        prefix_cache_size: int = 0,
+        kv_block_size: int = 0,
+        kv_num_blocks: int = 0,
+        kv_cache_int8: bool = False,
+        semantic_only: bool = False,
+        draft_checkpoint_path: str | None = None,
+        num_draft_tokens: int = 4,
+        decode_context_frames: int = 0,
+        vocoder_batch_size: int = 1,
+        vocoder_batch_wait: float = 5,
+        compile_decoder: bool = False,
+        decoder_backend: str = "torch",
+        decoder_onnx_dir: str | None = None,
+        onnx_threads: int = 0,
+        reference_cache_size: int = 256,
+        reference_cache_dir: str | None = None,
+        request_timeout: float = 0,
     ) -> None:
 
         self.mode = mode
         self.device = device
         self.half = half
         self.compile = compile
+        self.max_batch_size = max_batch_size
+        self.prefill_chunk_size = prefill_chunk_size
+        self.prefix_cache_size = prefix_cache_size
+        self.kv_block_size = kv_block_size
+        self.kv_num_blocks = kv_num_blocks
+        self.kv_cache_int8 = kv_cache_int8
+        self.semantic_only = semantic_only
+        self.draft_checkpoint_path = draft_checkpoint_path
+        self.num_draft_tokens = num_draft_tokens
+        self.decode_context_frames = decode_context_frames
+        self.vocoder_batch_size = vocoder_batch_size
+        self.vocoder_batch_wait = vocoder_batch_wait
+        self.compile_decoder = compile_decoder
+        self.decoder_backend = decoder_backend
+        self.decoder_onnx_dir = decoder_onnx_dir
+        self.onnx_threads = onnx_threads
+        self.reference_cache_size = reference_cache_size
+        self.reference_cache_dir = reference_cache_dir
+        self.request_timeout = request_timeout
 
         self.precision = torch.half if half else torch.bfloat16
 
@@ -53,15 +95,34 @@ class ModelManager:
         self.load_decoder_model(
             decoder_config_name, decoder_checkpoint_path, self.device
         )
+        # The cached codes are only valid for the encoder that produced them
+        reference_cache = ReferenceCodeCache(
+            max_entries=self.reference_cache_size,
+            cache_dir=self.reference_cache_dir,
+            model_id=(
+                checkpoint_id(
+                    Path(self.decoder_onnx_dir) / "encoder.onnx",
+                    Path(self.decoder_onnx_dir) / "decoder.onnx",
+                )
+                if self.decoder_backend == "onnx"
+                else checkpoint_id(decoder_checkpoint_path)
+            ),
+        )
         self.tts_inference_engine = TTSInferenceEngine(
             llama_queue=self.llama_queue,
             decoder_model=self.decoder_model,
             precision=self.precision,
             compile=self.compile,
+            decode_context_frames=self.decode_context_frames,
+            vocoder_batch_size=self.vocoder_batch_size,
+            vocoder_batch_wait=self.vocoder_batch_wait / 1000,
+            reference_cache=reference_cache,
+            request_timeout=self.request_timeout,
         )
 
-        # Warm up the models
+        # Encode the voices of the references folder, then warm up the models
         if self.mode == "tts":
+            self.tts_inference_engine.load_reference_library("references")
             self.warm_up(self.tts_inference_engine)
 
     def load_asr_model(self, device, hub="ms") -> None:
@@ -83,6 +144,15 @@ class ModelManager:
                 device=device,
                 precision=precision,
                 compile=compile,
+                max_batch_size=self.max_batch_size,
+                prefill_chunk_size=self.prefill_chunk_size,
+                prefix_cache_size=self.prefix_cache_size,
+                kv_block_size=self.kv_block_size,
+                kv_num_blocks=self.kv_num_blocks,
+                kv_cache_int8=self.kv_cache_int8,
+                semantic_only=self.semantic_only,
+                draft_checkpoint_path=self.draft_checkpoint_path,
+                num_draft_tokens=self.num_draft_tokens,
             )
         elif mode == "agent":
             self.llama_queue, self.tokenizer, self.config = (
@@ -99,10 +169,19 @@ class ModelManager:
         logger.info("LLAMA model loaded.")
 
     def load_decoder_model(self, config_name, checkpoint_path, device) -> None:
+        if self.decoder_backend == "onnx":
+            self.decoder_model = OnnxFireflyModel(
+                self.decoder_onnx_dir, num_threads=self.onnx_threads
+            )
+            logger.info("ONNX decoder model loaded.")
+            return
+
         self.decoder_model = load_decoder_model(
             config_name=config_name,
             checkpoint_path=checkpoint_path,
             device=device,
+            optimize=True,
+            compile=self.compile_decoder,
         )
         logger.info("Decoder model loaded.")
 
@@ -0,0 +1,173 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import soundfile as sf
+
+from tools.inference_engine.utils import wav_chunk_header
+
+AMPLITUDE = 32768
+# Opus only supports a few sample rates
+OPUS_SAMPLE_RATE = 48000
+
+
+def to_pcm16(audio: np.ndarray) -> bytes:
+    return (
+        (np.clip(audio, -1, 1 - 1 / AMPLITUDE) * AMPLITUDE).astype(np.int16).tobytes()
+    )
+
+
+class StreamEncoder(ABC):
+    """
+    Encodes the audio segments of a streamed synthesis as they are produced:
+    `start` returns the container header, `encode` the frames of a segment that are
+    ready, `finish` whatever the encoder still buffers.
+    """
+
+    def __init__(self, sample_rate: int) -> None:
+        self.sample_rate = sample_rate
+
+    def start(self) -> bytes:
+        return b""
+
+    @abstractmethod
+    def encode(self, audio: np.ndarray) -> bytes: ...
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class PCMEncoder(StreamEncoder):
+    def encode(self, audio: np.ndarray) -> bytes:
+        return to_pcm16(audio)
+
+
+class WavEncoder(PCMEncoder):
+    def start(self) -> bytes:
+        return wav_chunk_header(sample_rate=self.sample_rate)
+
+
+class MP3Encoder(StreamEncoder):
+    def __init__(self, sample_rate: int, bit_rate: int = 64) -> None:
+        super().__init__(sample_rate)
+
+        import lameenc
+
+        self.encoder = lameenc.Encoder()
+        self.encoder.set_bit_rate(bit_rate)
+        self.encoder.set_in_sample_rate(sample_rate)
+        self.encoder.set_channels(1)
+        self.encoder.set_quality(2)
+
+    def encode(self, audio: np.ndarray) -> bytes:
+        return bytes(self.encoder.encode(to_pcm16(audio)))
+
+    def finish(self) -> bytes:
+        return bytes(self.encoder.flush())
+
+
+class EncodedStream:
+    """
+    Write-only file object for soundfile that hands out the encoded bytes as soon as
+    they are written. Rewrites of bytes that were already sent, like the header
+    update libsndfile does on close, are dropped: both FLAC and Ogg accept a header
+    without the total length.
+    """
+
+    def __init__(self) -> None:
+        self.pending = bytearray()
+        self.position = 0
+        self.size = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        end = self.position + len(data)
+
+        if end > self.size:
+            if self.position > self.size:
+                self.pending += bytes(self.position - self.size)
+            self.pending += data[max(self.size - self.position, 0) :]
+            self.size = end
+
+        self.position = end
+        return len(data)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        return b""
+
+    def take(self) -> bytes:
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
+
+
+class SoundFileEncoder(StreamEncoder):
+    """
+    FLAC and Ogg/Opus through libsndfile, Opus input is resampled to 48 kHz.
+    """
+
+    def __init__(self, sample_rate: int, format: str, subtype: str) -> None:
+        super().__init__(sample_rate)
+
+        self.resampler = None
+        output_rate = sample_rate
+        if subtype == "OPUS" and sample_rate != OPUS_SAMPLE_RATE:
+            import soxr
+
+            self.resampler = soxr.ResampleStream(
+                sample_rate, OPUS_SAMPLE_RATE, 1, dtype="float32"
+            )
+            output_rate = OPUS_SAMPLE_RATE
+
+        self.stream = EncodedStream()
+        self.file = sf.SoundFile(
+            self.stream,
+            mode="w",
+            samplerate=output_rate,
+            channels=1,
+            format=format,
+            subtype=subtype,
+        )
+
+    def encode(self, audio: np.ndarray) -> bytes:
+        audio = audio.astype(np.float32)
+        if self.resampler is not None:
+            audio = self.resampler.resample_chunk(audio)
+
+        self.file.write(audio)
+        return self.stream.take()
+
+    def finish(self) -> bytes:
+        if self.resampler is not None:
+            self.file.write(
+                self.resampler.resample_chunk(np.zeros(0, np.float32), last=True)
+            )
+
+        self.file.close()
+        return self.stream.take()
+
+
+def get_stream_encoder(audio_format: str, sample_rate: int) -> StreamEncoder:
+    if audio_format == "wav":
+        return WavEncoder(sample_rate)
+    elif audio_format == "pcm":
+        return PCMEncoder(sample_rate)
+    elif audio_format == "mp3":
+        return MP3Encoder(sample_rate)
+    elif audio_format == "flac":
+        return SoundFileEncoder(sample_rate, "FLAC", "PCM_16")
+    elif audio_format == "opus":
+        return SoundFileEncoder(sample_rate, "OGG", "OPUS")
+
+    raise ValueError(f"Unsupported streaming format: {audio_format}")
@@ -1,5 +1,7 @@
+import asyncio
 import io
 import os
+import threading
 import time
 from http import HTTPStatus
 
@@ -30,6 +32,7 @@ from tools.server.api_utils import (
 from tools.server.inference import inference_wrapper as inference
 from tools.server.model_manager import ModelManager
 from tools.server.model_utils import batch_asr, cached_vqgan_batch_encode, vqgan_decode
+from tools.server.stream_encoders import get_stream_encoder
 
 MAX_NUM_SAMPLES = int(os.getenv("NUM_SAMPLES", 1))
 
@@ -49,7 +52,9 @@ async def vqgan_encode(req: Annotated[ServeVQGANEncodeRequest, Body(exclusive=Tr
 
     # Encode the audio
     start_time = time.time()
-    tokens = cached_vqgan_batch_encode(decoder_model, req.audios)
+    tokens = await asyncio.to_thread(
+        cached_vqgan_batch_encode, decoder_model, req.audios
+    )
     logger.info(f"[EXEC] VQGAN encode time: {(time.time() - start_time) * 1000:.2f}ms")
 
     # Return the response
@@ -68,7 +73,7 @@ async def vqgan_decode(req: Annotated[ServeVQGANDecodeRequest, Body(exclusive=Tr
     # Decode the audio
     tokens = [torch.tensor(token, dtype=torch.int) for token in req.tokens]
     start_time = time.time()
-    audios = vqgan_decode(decoder_model, tokens)
+    audios = await asyncio.to_thread(vqgan_decode, decoder_model, tokens)
     logger.info(f"[EXEC] VQGAN decode time: {(time.time() - start_time) * 1000:.2f}ms")
     audios = [audio.astype(np.float16).tobytes() for audio in audios]
 
@@ -94,8 +99,13 @@ async def asr(req: Annotated[ServeASRRequest, Body(exclusive=True)]):
     if any(audios.shape[-1] >= 30 * req.sample_rate for audios in audios):
         raise HTTPException(status_code=400, content="Audio length is too long")
 
-    transcriptions = batch_asr(
-        asr_model, lock, audios=audios, sr=req.sample_rate, language=req.language
+    transcriptions = await asyncio.to_thread(
+        batch_asr,
+        asr_model,
+        lock,
+        audios=audios,
+        sr=req.sample_rate,
+        language=req.language,
     )
     logger.info(f"[EXEC] ASR time: {(time.time() - start_time) * 1000:.2f}ms")
 
@@ -121,13 +131,6 @@ async def tts(req: Annotated[ServeTTSRequest, Body(exclusive=True)]):
             content=f"Text is too long, max length is {app_state.max_text_length}",
         )
 
-    # Check if streaming is enabled
-    if req.streaming and req.format != "wav":
-        raise HTTPException(
-            HTTPStatus.BAD_REQUEST,
-            content="Streaming only supports WAV format",
-        )
-
     # Perform TTS
     if req.streaming:
         return StreamResponse(
@@ -138,17 +141,34 @@ async def tts(req: Annotated[ServeTTSRequest, Body(exclusive=True)]):
             content_type=get_content_type(req.format),
         )
     else:
-        fake_audios = next(inference(req, engine))
-        buffer = io.BytesIO()
-        sf.write(
-            buffer,
-            fake_audios,
-            sample_rate,
-            format=req.format,
-        )
+        # The handler is cancelled when the client disconnects
+        cancel_event = threading.Event()
+        try:
+            fake_audios = await asyncio.to_thread(
+                lambda: next(inference(req, engine, cancel_event=cancel_event))
+            )
+        finally:
+            cancel_event.set()
+
+        if req.format in ("wav", "flac", "mp3"):
+            buffer = io.BytesIO()
+            await asyncio.to_thread(
+                sf.write,
+                buffer,
+                fake_audios,
+                sample_rate,
+                format=req.format,
+            )
+            audio = buffer.getvalue()
+        else:
+            # soundfile can't write raw PCM or Ogg/Opus at the model sample rate
+            encoder = get_stream_encoder(req.format, sample_rate)
+            audio = await asyncio.to_thread(
+                lambda: encoder.start() + encoder.encode(fake_audios) + encoder.finish()
+            )
 
         return StreamResponse(
-            iterable=buffer_to_async_generator(buffer.getvalue()),
+            iterable=buffer_to_async_generator(audio),
             headers={
                 "Content-Disposition": f"attachment; filename=audio.{req.format}",
             },
@@ -184,7 +204,7 @@ async def chat(req: Annotated[ServeChatRequest, Body(exclusive=True)]):
 
     # Return the response in the correct format
     if req.streaming is False:
-        result = response_generator()
+        result = await asyncio.to_thread(response_generator)
         if json_mode:
             return JSONResponse(result.model_dump())
         else:
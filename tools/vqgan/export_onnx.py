@@ -0,0 +1,180 @@
+import math
+from pathlib import Path
+
+import click
+import torch
+import torch.nn.functional as F
+from loguru import logger
+from torch import nn
+
+from fish_speech.models.vqgan.modules.firefly import FireflyArchitecture
+from tools.vqgan.inference import load_model
+
+
+class DecoderGraph(nn.Module):
+    """
+    Codes (B, N, T) to waveform (B, 1, T * downsample_factor * hop_length).
+    """
+
+    def __init__(self, model: FireflyArchitecture) -> None:
+        super().__init__()
+        self.quantizer = model.quantizer
+        self.head = model.head
+
+    def forward(self, indices):
+        return self.head(self.quantizer.decode(indices))
+
+
+class EncoderGraph(nn.Module):
+    """
+    Waveform (B, 1, L) to codes (B, N, L // hop_length // downsample_factor).
+    The STFT is written as a strided conv with a windowed DFT basis since complex
+    tensors cannot be exported.
+    """
+
+    def __init__(self, model: FireflyArchitecture) -> None:
+        super().__init__()
+        self.backbone = model.backbone
+        self.quantizer = model.quantizer
+
+        spec = model.spec_transform
+        self.hop_length = spec.hop_length
+        self.win_length = spec.win_length
+
+        n_fft = spec.n_fft
+        freqs = torch.arange(n_fft // 2 + 1, dtype=torch.float64)[:, None]
+        time = torch.arange(n_fft, dtype=torch.float64)[None, :]
+        angle = 2 * math.pi * freqs * time / n_fft
+        window = torch.hann_window(spec.win_length, dtype=torch.float64)
+        window = F.pad(
+            window,
+            ((n_fft - spec.win_length) // 2, (n_fft - spec.win_length + 1) // 2),
+        )
+
+        basis = torch.cat([torch.cos(angle), -torch.sin(angle)], dim=0) * window
+        self.register_buffer("basis", basis[:, None, :].float(), persistent=False)
+        self.register_buffer("fb", spec.fb.float(), persistent=False)
+
+    def forward(self, audios):
+        length = audios.shape[-1]
+        y = F.pad(
+            audios,
+            (
+                (self.win_length - self.hop_length) // 2,
+                (self.win_length - self.hop_length + 1) // 2,
+            ),
+            mode="reflect",
+        )
+
+        spec = F.conv1d(y, self.basis, stride=self.hop_length)
+        real, imag = spec.chunk(2, dim=1)
+        linear = torch.sqrt(real.pow(2) + imag.pow(2) + 1e-6)
+
+        mels = torch.matmul(linear.transpose(-1, -2), self.fb).transpose(-1, -2)
+        mels = torch.log(torch.clamp(mels, min=1e-5))
+
+        # Same as the mel mask of `FireflyArchitecture.encode`
+        mel_mask = torch.arange(mels.shape[-1], device=mels.device) < (
+            length // self.hop_length
+        )
+        mels = mels * mel_mask.float()
+
+        features = self.backbone(mels) * mel_mask.float()
+        return self.quantizer.encode(features)
+
+
+def add_metadata(path: Path, model: FireflyArchitecture):
+    try:
+        import onnx
+    except ImportError as e:
+        raise ImportError(
+            "Exporting the decoder requires the onnx extra: pip install -e .[onnx]"
+        ) from e
+
+    graph = onnx.load(str(path))
+    for key, value in {
+        "sample_rate": model.spec_transform.sample_rate,
+        "hop_length": model.spec_transform.hop_length,
+        "downsample_factor": model.downsample_factor,
+    }.items():
+        entry = graph.metadata_props.add()
+        entry.key = key
+        entry.value = str(value)
+
+    onnx.save(graph, str(path))
+
+
+@torch.no_grad()
+def export(
+    model: FireflyArchitecture,
+    output_dir: Path,
+    opset: int = 17,
+    skip_encoder: bool = False,
+):
+    """
+    Write the decoder (and encoder) graphs of `model` to `output_dir`, see OnnxFireflyModel.
+    """
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    num_codebooks = (
+        model.quantizer.residual_fsq.groups
+        * model.quantizer.residual_fsq.rvqs[0].num_quantizers
+    )
+
+    decoder_path = output_dir / "decoder.onnx"
+    torch.onnx.export(
+        DecoderGraph(model),
+        (torch.zeros(1, num_codebooks, 32, dtype=torch.long),),
+        str(decoder_path),
+        input_names=["indices"],
+        output_names=["audios"],
+        dynamic_axes={
+            "indices": {0: "batch", 2: "frames"},
+            "audios": {0: "batch", 2: "samples"},
+        },
+        opset_version=opset,
+    )
+    add_metadata(decoder_path, model)
+    logger.info(f"Exported decoder to {decoder_path}")
+
+    if not skip_encoder:
+        encoder_path = output_dir / "encoder.onnx"
+        frame_length = model.downsample_factor * model.spec_transform.hop_length
+        torch.onnx.export(
+            EncoderGraph(model),
+            (torch.zeros(1, 1, frame_length * 32),),
+            str(encoder_path),
+            input_names=["audios"],
+            output_names=["indices"],
+            dynamic_axes={
+                "audios": {0: "batch", 2: "samples"},
+                "indices": {0: "batch", 2: "frames"},
+            },
+            opset_version=opset,
+        )
+        add_metadata(encoder_path, model)
+        logger.info(f"Exported encoder to {encoder_path}")
+
+
+@click.command()
+@click.option("--config-name", default="firefly_gan_vq")
+@click.option(
+    "--checkpoint-path",
+    default="checkpoints/fish-speech-1.5/firefly-gan-vq-fsq-8x1024-21hz-generator.pth",
+)
+@click.option(
+    "--output-dir",
+    "-o",
+    default="checkpoints/fish-speech-1.5/onnx",
+    type=click.Path(path_type=Path),
+)
+@click.option("--opset", default=17)
+@click.option("--skip-encoder", is_flag=True)
+def main(config_name, checkpoint_path, output_dir, opset, skip_encoder):
+    model = load_model(config_name, checkpoint_path, device="cpu", optimize=True)
+    export(model, output_dir, opset=opset, skip_encoder=skip_encoder)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,7 +17,13 @@ from tools.file import AUDIO_EXTENSIONS
 OmegaConf.register_new_resolver("eval", eval)
 
 
-def load_model(config_name, checkpoint_path, device="cuda"):
+def load_model(
+    config_name,
+    checkpoint_path,
+    device="cuda",
+    optimize: bool = False,
+    compile: bool = False,
+):
     hydra.core.global_hydra.GlobalHydra.instance().clear()
     with initialize(version_base="1.3", config_path="../../fish_speech/configs"):
         cfg = compose(config_name=config_name)
@@ -41,6 +47,10 @@ def load_model(config_name, checkpoint_path, device="cuda"):
     model.to(device)
 
     logger.info(f"Loaded model: {result}")
+
+    if optimize:
+        model.optimize_for_inference(compile=compile)
+
     return model
 
 
@@ -66,7 +76,7 @@ def load_model(config_name, checkpoint_path, device="cuda"):
     default="cuda",
 )
 def main(input_path, output_path, config_name, checkpoint_path, device):
-    model = load_model(config_name, checkpoint_path, device=device)
+    model = load_model(config_name, checkpoint_path, device=device, optimize=True)
 
     if input_path.suffix in AUDIO_EXTENSIONS:
         logger.info(f"Processing in-place reconstruction of {input_path}")
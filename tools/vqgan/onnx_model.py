@@ -0,0 +1,91 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from loguru import logger
+
+
+class OnnxFireflyModel:
+    """
+    Runs the encoder/decoder graphs written by `tools/vqgan/export_onnx.py` with onnxruntime on CPU.
+    It exposes the `encode` / `decode` interface of `FireflyArchitecture`, so it can be used
+    as the decoder model of the inference engine.
+    """
+
+    def __init__(self, onnx_dir: str | Path, num_threads: int = 0) -> None:
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError(
+                "The ONNX decoder backend requires the onnx extra: pip install -e .[onnx]"
+            ) from e
+
+        onnx_dir = Path(onnx_dir)
+
+        options = ort.SessionOptions()
+        # 0 lets onnxruntime pick the number of physical cores
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.decoder = ort.InferenceSession(
+            str(onnx_dir / "decoder.onnx"),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+
+        encoder_path = onnx_dir / "encoder.onnx"
+        self.encoder = (
+            ort.InferenceSession(
+                str(encoder_path),
+                sess_options=options,
+                providers=["CPUExecutionProvider"],
+            )
+            if encoder_path.exists()
+            else None
+        )
+
+        metadata = self.decoder.get_modelmeta().custom_metadata_map
+        self.spec_transform = SimpleNamespace(
+            sample_rate=int(metadata["sample_rate"]),
+            hop_length=int(metadata["hop_length"]),
+        )
+        self.downsample_factor = int(metadata["downsample_factor"])
+        self.device = torch.device("cpu")
+
+        logger.info(
+            f"Loaded ONNX decoder from {onnx_dir}, "
+            f"encoder {'found' if self.encoder is not None else 'not found'}"
+        )
+
+    def encode(self, audios, audio_lengths):
+        if self.encoder is None:
+            raise RuntimeError("The ONNX encoder was not exported")
+
+        (indices,) = self.encoder.run(
+            None, {"audios": audios.float().cpu().numpy().astype(np.float32)}
+        )
+
+        feature_lengths = (
+            audio_lengths.cpu() // self.spec_transform.hop_length
+        ) // self.downsample_factor
+
+        return torch.from_numpy(indices), feature_lengths
+
+    def decode(self, indices, feature_lengths):
+        (audios,) = self.decoder.run(
+            None, {"indices": indices.cpu().numpy().astype(np.int64)}
+        )
+        audios = torch.from_numpy(audios)
+
+        audio_lengths = (
+            feature_lengths.cpu()
+            * self.downsample_factor
+            * self.spec_transform.hop_length
+        )
+
+        # Same as the audio mask of `FireflyArchitecture.decode`
+        mask = torch.arange(audios.shape[-1]) < audio_lengths[:, None]
+        audios = audios * mask[:, None, :]
+
+        return audios, audio_lengths
@@ -31,24 +31,23 @@ def inference_wrapper(
     processed_text = text_processor.process_text(text)
 
     # Визначаємо, який референс використовувати
+    reference_id = None
     if custom_audio is not None and custom_text.strip():
         # Використовуємо користувацький референс
         with open(custom_audio, "rb") as audio_file:
             audio_bytes = audio_file.read()
         references = [ServeReferenceAudio(audio=audio_bytes, text=custom_text.strip())]
     elif reference_name in references_dict:
-        # Використовуємо вибраний референс зі списку
-        reference = references_dict[reference_name]
-        with open(reference.wav_path, "rb") as audio_file:
-            audio_bytes = audio_file.read()
-        references = [ServeReferenceAudio(audio=audio_bytes, text=reference.lab_text)]
+        # Вибраний референс зі списку вже закодований у бібліотеці референсів
+        references = []
+        reference_id = reference_name
     else:
         references = []
 
     req = ServeTTSRequest(
         text=processed_text,
         normalize=False,
-        reference_id=None,
+        reference_id=reference_id,
         references=references,
         max_new_tokens=max_new_tokens,
         chunk_length=chunk_length,